@@ -0,0 +1,26 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Microbenchmarks for Mailing Set.
+
+Run them from the root of the repository with:
+
+    python -m benchmarks
+
+See benchmarks/__main__.py for the options, including comparing the results
+against a stored baseline.
+"""
@@ -0,0 +1,129 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Command line entry point of the benchmarks.
+
+Usage:
+    python -m benchmarks [-k PATTERN] [--baseline FILE] [--save FILE]
+
+Runs the benchmark cases, prints the time of each one, and if a baseline is
+given, exits with status 1 when any case is slower than its baseline by more
+than its threshold: the one it was registered with, or else --threshold. The
+baseline is first scaled by the speed of this machine relative to when it was
+recorded, as measured by a reference workload timed before each case, and a
+case must also be slower by at least its minimum slowdown, or else
+--min-delta.
+"""
+import argparse
+import os
+import sys
+
+import cases
+import harness
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def main(argv=None):
+    """Runs the benchmarks.
+
+    Args:
+        argv: Command line arguments, excluding the program name. Defaults to
+            sys.argv[1:].
+
+    Returns:
+        Exit status: 0 on success, 1 if any case regressed.
+    """
+    options = _parse_args(argv)
+    names = harness.names(options.patterns)
+    if options.list:
+        for name in names:
+            print(name)
+        return 0
+
+    results = harness.run(names, repeat=options.repeat,
+                          min_time=options.min_time, report=_print_result)
+    if options.save:
+        harness.save(options.save, results)
+
+    if not options.baseline:
+        return 0
+    baseline = harness.load(options.baseline)
+    regressions = harness.compare(results, baseline, options.threshold,
+                                  harness.thresholds(), options.min_delta,
+                                  harness.min_deltas())
+    for (name, before, now) in regressions:
+        print('REGRESSION %s: %s -> %s (%+.0f%%)' % (
+            name, _format(before), _format(now), (now / before - 1) * 100))
+    return 1 if regressions else 0
+
+
+def _parse_args(argv):
+    """Parses command line arguments."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Runs the benchmarks.')
+    parser.add_argument('-k', dest='patterns', action='append',
+                        metavar='PATTERN',
+                        help='only run cases matching this pattern, like '
+                        'parser.*; may be given more than once')
+    parser.add_argument('--list', action='store_true',
+                        help='list the cases instead of running them')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to time each case (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per timing (default: '
+                        '%(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as JSON; use '
+                        '--save %s to update the stored baseline' % (
+                            os.path.relpath(BASELINE),))
+    parser.add_argument('--baseline', metavar='FILE', nargs='?',
+                        const=BASELINE,
+                        help='compare against the results in FILE (default: '
+                        'the stored baseline)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction by which a case may be slower than the '
+                        'baseline before it fails, for cases without a '
+                        'threshold of their own (default: %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=harness.MIN_DELTA,
+                        metavar='SECONDS',
+                        help='seconds by which a case must be slower than the '
+                        'baseline before it fails, for cases without a '
+                        'minimum of their own (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def _print_result(name, stats):
+    """Prints the statistics of one case."""
+    print('%-30s best %10s  median %10s  (%d loops)' % (
+        name, _format(stats['best']), _format(stats['median']),
+        stats['loops']))
+    sys.stdout.flush()
+
+
+def _format(seconds):
+    """Formats a duration with a unit suited to its magnitude."""
+    for (unit, scale) in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.3g %s' % (seconds / scale, unit)
+    return '%.3g ns' % (seconds / 1e-9,)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark cases for the hot paths of Mailing Set.
+
+The cases cover parsing expressions, loading the list directory and membership
+files, building the alias table, and prefixing subjects with both the Mailman
+handler and SubjectTagger, each at a few input shapes. Loading a few huge
+lists or tens of thousands of small ones is timed once per repeat and depends
+on the disk, so those cases are allowed to vary by twice the default
+threshold. The list directories are generated
+by dataset.generate into temporary directories which are removed when the
+process exits.
+"""
+import atexit
+import email.message
+import functools
+import shutil
+import tempfile
+
+from mailingset import parser
+from mailingset.mailman import subject_prefix
+from mailingset.state import MailingSetState
+from mailingset.subject import SubjectTagger
+
+import dataset
+from harness import case
+
+
+def _dataset(**params):
+    """Generates a list directory into a temporary directory.
+
+    Args:
+        params: Keyword arguments for dataset.generate.
+
+    Returns:
+        A ConfigParser object configured to load it.
+    """
+    path = tempfile.mkdtemp(prefix='mailingset-bench-')
+    atexit.register(shutil.rmtree, path, True)
+    return dataset.generate(path, **params)
+
+
+def _leaf_resolver(count):
+    """Creates a parser resolver for leaves list0 through list<count-1>."""
+    leaves = {}
+    for index in range(count):
+        addrs = set('user%d@example.com' % (index + i,) for i in range(10))
+        leaves['list%d' % (index,)] = ('L%d' % (index,), addrs)
+    return leaves.__getitem__
+
+
+@case('parser.shallow')
+def parser_shallow():
+    resolver = _leaf_resolver(2)
+    return lambda: parser.parse(resolver, 'list0_&_list1')
+
+
+@case('parser.deep')
+def parser_deep():
+    # {list0_&_{list1_|_{list2_&_{...}}}} alternating operators 30 levels deep
+    depth = 30
+    resolver = _leaf_resolver(depth + 1)
+    address = 'list%d' % (depth,)
+    for index in reversed(range(depth)):
+        operator = '_&_' if index % 2 else '_|_'
+        address = '{list%d%s%s}' % (index, operator, address)
+    return lambda: parser.parse(resolver, address)
+
+
+@case('parser.wide')
+def parser_wide():
+    width = 200
+    resolver = _leaf_resolver(width)
+    address = '_|_'.join('list%d' % (index,) for index in range(width))
+    return lambda: parser.parse(resolver, address)
+
+
+@case('state.load_small')
+def state_load_small():
+    config = _dataset(lists=20, members=50)
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_huge', threshold=0.5)
+def state_load_huge():
+    config = _dataset(lists=200, members=1000)
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_huge_csv', threshold=0.5)
+def state_load_huge_csv():
+    config = _dataset(lists=200, members=1000, members_file='members.csv')
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_huge_jsonl_gz', threshold=0.5)
+def state_load_huge_jsonl_gz():
+    config = _dataset(lists=200, members=1000,
+                      members_file='members.jsonl.gz')
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_many', threshold=0.5)
+def state_load_many():
+    config = _dataset(lists=20000, members=5, tail=None)
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_many_csv', threshold=0.5)
+def state_load_many_csv():
+    config = _dataset(lists=20000, members=5, tail=None,
+                      members_file='members.csv')
+    return lambda: MailingSetState(config)
+
+
+@case('state.load_many_jsonl_gz', threshold=0.5)
+def state_load_many_jsonl_gz():
+    config = _dataset(lists=20000, members=5, tail=None,
+                      members_file='members.jsonl.gz')
+    return lambda: MailingSetState(config)
+
+
+@case('state.aliases')
+def state_aliases():
+    state = MailingSetState(_dataset(lists=20, members=500))
+    return lambda: state._load_aliases(state._read_lists())
+
+
+# Subjects of each kind, timed with the Mailman handler and with SubjectTagger
+SUBJECTS = [
+    ('ascii', 'Re: [nest] Dinner on Friday'),
+    ('tagged', '[nest] Dinner on Friday'),
+    ('same_charset', '=?utf-8?q?Caf=C3=A9_on_Friday?= =?utf-8?q?_=E2=98=95?='),
+    ('mixed_charsets', 'Re: =?iso-8859-1?q?Caf=E9?= and '
+                       '=?utf-8?q?cr=C3=A8me_br=C3=BBl=C3=A9e?=')]
+
+
+def _subject_case(tagger, subject):
+    """Times prefixing the given subject with a list tag."""
+    def process():
+        msg = email.message.Message()
+        msg['Subject'] = subject
+        tagger.process('[nest] ', msg)
+    return process
+
+
+def _register_subject_cases():
+    """Registers a case for each subject and tagger."""
+    for (kind, subject) in SUBJECTS:
+        case('subject.%s' % (kind,))(functools.partial(
+            _subject_case, subject_prefix.SubjectPrefix(), subject))
+        case('subject.tagger.%s' % (kind,))(functools.partial(
+            _subject_case, SubjectTagger(), subject))
+
+
+_register_subject_cases()
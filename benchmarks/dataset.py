@@ -0,0 +1,246 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Generates synthetic list directories shaped like a large organization.
+
+The generated directory can be loaded by MailingSetState, so that load time,
+memory and evaluation latency can be measured at scales well beyond the sample
+lists in tests/lists. See generate for the parameters, and scale.py for a
+report of how these grow with them.
+"""
+import configparser
+import csv
+import gzip
+import json
+import os
+import random
+
+
+DOMAIN = 'bench.local'
+
+FIRST_NAMES = ['Ada', 'Alan', 'Barbara', 'Donald', 'Edsger', 'Frances',
+               'Grace', 'John', 'Ken', 'Leslie', 'Margaret', 'Niklaus',
+               'Radia', 'Shafi', 'Tony', 'Whitfield']
+
+# Syllables combined into last names, so that every person can be given a
+# distinct last name
+SYLLABLES = ['ba', 'de', 'ki', 'lo', 'mu', 'na', 're', 'so', 'ta', 'vi', 'zo',
+             'ha', 'pe', 'gu', 'fi', 'xa']
+
+
+def generate(path, lists=100, members=200, tail=1.5, people=None, depth=2,
+             nested=0.1, sharing=2, collisions=0.05, named=0.7, seed=0,
+             members_file=None):
+    """Writes a list directory and symbols file for MailingSetState.
+
+    Args:
+        path: Existing directory in which to create the lists directory and
+            symbols file.
+        lists: Number of mailing lists.
+        members: Mean number of direct members of a list of people.
+        tail: Shape of the Pareto distribution of list sizes; smaller is a
+            heavier tail, with a few lists much larger than the mean. None
+            gives every list exactly the mean number of members.
+        people: Number of distinct people to draw members from. Defaults to a
+            quarter of the total memberships, so that people are on several
+            lists.
+        depth: Levels of nesting above the lists of people. Must not exceed
+            MailingSetState.NEST_LIMIT.
+        nested: Fraction of lists that contain other lists, spread evenly over
+            the levels of nesting.
+        sharing: Number of lists one level up that include each nested list.
+        collisions: Fraction of named people who share their full name with
+            another person, making their name ambiguous in the alias table.
+        named: Fraction of members listed as "Name <addr>" rather than as a
+            bare address.
+        seed: Seed for the random choices, so that the same parameters always
+            generate the same directory.
+        members_file: If given, the lists are written to a consolidated
+            membership file of this name instead of a list directory. Its
+            extension chooses the format, like members.csv or
+            members.jsonl.gz.
+
+    Returns:
+        A ConfigParser object configured to load the written files.
+    """
+    rand = random.Random(seed)
+    if people is None:
+        people = max(1, lists * members // 4)
+
+    # Split the lists into levels: level 0 holds people, and each level above
+    # it holds lists from the level below
+    composite = int(lists * nested) if depth else 0
+    levels = [lists - composite]
+    for level in range(depth):
+        levels.append(composite // depth + (level < composite % depth))
+    levels = [count for count in levels if count]
+
+    names = _names(rand, people, collisions)
+    direct = []
+    below = []
+    for (level, count) in enumerate(levels):
+        current = ['list%d' % (len(direct) + i,) for i in range(count)]
+        for listname in current:
+            size = _list_size(rand, members, tail, people)
+            if level:
+                # Lists above the people mostly hold lists, plus a few people
+                size = max(1, size // 10)
+            chosen = rand.sample(range(people), size)
+            direct.append((listname, [_line(rand, p, names, named)
+                                      for p in chosen]))
+        if level:
+            parents = dict(direct[-count:])
+            children = dict((name, set()) for name in current)
+            for child in below:
+                for parent in rand.sample(current, min(sharing, count)):
+                    children[parent].add(child)
+            # Every list on this level nests at least one, so that the
+            # nesting really is depth levels deep
+            for parent in current:
+                if not children[parent]:
+                    children[parent].add(rand.choice(below))
+                parents[parent].extend('%s@%s' % (child, DOMAIN)
+                                       for child in sorted(children[parent]))
+            direct[-count:] = [(name, parents[name]) for name in current]
+        below = current
+
+    if members_file is not None:
+        return _write_file(path, direct, members_file)
+    return _write(path, direct)
+
+
+def _list_size(rand, members, tail, people):
+    """Draws the number of direct members of a list of people."""
+    if tail is None:
+        size = members
+    else:
+        # The mean of paretovariate(tail) is tail/(tail-1); scale it to members
+        size = int(members * (tail - 1) / tail * rand.paretovariate(tail))
+    return max(1, min(size, people))
+
+
+def _names(rand, people, collisions):
+    """Chooses a full name for every person, with some full names shared."""
+    names = []
+    for person in range(people):
+        if names and rand.random() < collisions:
+            names.append(rand.choice(names))
+        else:
+            names.append('%s %s' % (rand.choice(FIRST_NAMES),
+                                    _last_name(person)))
+    return names
+
+
+def _last_name(person):
+    """Spells a distinct last name for every person number."""
+    syllables = []
+    while True:
+        (person, digit) = divmod(person, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if not person:
+            break
+    return ''.join(syllables).capitalize()
+
+
+def _line(rand, person, names, named):
+    """Formats the list file line of a person, named with probability named."""
+    addr = 'u%d@example.com' % (person,)
+    if rand.random() < named:
+        return '%s <%s>' % (names[person], addr)
+    return addr
+
+
+def _write(path, direct):
+    """Writes the lists to a list directory, and the symbols.
+
+    Args:
+        path: Directory in which to create them.
+        direct: List of pairs (listname,lines) of the members of every list.
+
+    Returns:
+        A ConfigParser object configured to load them.
+    """
+    lists_path = os.path.join(path, 'lists')
+    os.mkdir(lists_path)
+    for (listname, lines) in direct:
+        with open(os.path.join(lists_path, listname), 'w') as list_file:
+            list_file.writelines(line + '\n' for line in lines)
+
+    config = _write_symbols(path, direct)
+    config.set('data', 'lists_dir', lists_path)
+    return config
+
+
+def _write_file(path, direct, filename):
+    """Writes the lists to a consolidated membership file, and the symbols.
+
+    Args:
+        path: Directory in which to create them.
+        direct: List of pairs (listname,lines) of the members of every list.
+        filename: Name of the membership file, whose extension chooses its
+            format.
+
+    Returns:
+        A ConfigParser object configured to load them.
+    """
+    members_path = os.path.join(path, filename)
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(members_path, 'wb') as members_file:
+        if '.csv' in filename:
+            writer = csv.writer(members_file)
+            writer.writerow(['list', 'name', 'address'])
+            for (listname, lines) in direct:
+                writer.writerows((listname,) + _split(line) for line in lines)
+        else:
+            for (listname, lines) in direct:
+                for line in lines:
+                    (name, addr) = _split(line)
+                    members_file.write(json.dumps(
+                        {'list': listname, 'name': name, 'address': addr}))
+                    members_file.write('\n')
+
+    config = _write_symbols(path, direct)
+    config.set('data', 'members_file', members_path)
+    return config
+
+
+def _split(line):
+    """Separates a generated line into its name, or '', and address."""
+    if line.endswith('>'):
+        (name, addr) = line[:-1].split(' <')
+        return (name, addr)
+    return ('', line)
+
+
+def _write_symbols(path, direct):
+    """Writes the symbols file.
+
+    Returns:
+        A ConfigParser object configured to load it, which is missing the
+        location of the lists.
+    """
+    symbols_path = os.path.join(path, 'symbols.txt')
+    with open(symbols_path, 'w') as symbols_file:
+        for (index, (listname, _)) in enumerate(direct):
+            symbols_file.write('%s:L%d\n' % (listname, index))
+
+    config = configparser.ConfigParser()
+    config.add_section('incoming')
+    config.set('incoming', 'domain', DOMAIN)
+    config.add_section('data')
+    config.set('data', 'symbols_file', symbols_path)
+    return config
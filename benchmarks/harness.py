@@ -0,0 +1,271 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Running benchmark cases and comparing their results against a baseline.
+
+A case is registered with the case decorator on a setup function. The setup
+function does any preparation that should not be timed, and returns a function
+taking no arguments which does the work to be timed. A case whose timings vary
+more than most, such as one reading files, may be registered with a threshold
+of its own for compare.
+
+Results are a dict of case name to a dict of statistics, in seconds per call of
+the timed function, along with the time of a fixed reference workload run just
+before the case:
+
+    {"parser.deep": {"best": 2.1e-05, "median": 2.2e-05, "loops": 10000,
+                     "reference": 0.04}}
+
+Comparing against a baseline scales its timings by how much faster or slower
+the reference workload ran now, going by the median reference time over the
+cases of each run, so that a baseline recorded on one machine can be checked
+against runs on another. Results are saved as JSON along with the Python
+version.
+
+Timings of a few microseconds vary by tens of percent from run to run, so cases
+shorter than SHORT_TIME are timed more times, and a case only counts as a
+regression if it is slower by at least a minimum amount of time as well as by
+its threshold.
+"""
+import collections
+import fnmatch
+import json
+import platform
+import timeit
+
+
+# Registered cases, by name in the order they were registered
+_CASES = collections.OrderedDict()
+
+# Thresholds and minimum slowdowns of the registered cases that have their own,
+# by name
+_THRESHOLDS = {}
+_MIN_DELTAS = {}
+
+# Seconds per call under which a case is timed SHORT_REPEAT times as often
+SHORT_TIME = 1e-4
+SHORT_REPEAT = 5
+
+# Default seconds per call by which a case must be slower than its baseline to
+# count as a regression, whatever its threshold
+MIN_DELTA = 2e-6
+
+
+def case(name, threshold=None, min_delta=None):
+    """Registers a benchmark case.
+
+    Args:
+        name: Name of the case, like 'parser.deep'.
+        threshold: Fraction by which the case may be slower than its baseline
+            before it counts as a regression, or None to use the default
+            threshold of the comparison.
+        min_delta: Seconds per call by which the case must be slower than its
+            baseline to count as a regression, or None to use the default
+            minimum of the comparison.
+
+    Returns:
+        A decorator for the setup function of the case.
+    """
+    def register(setup):
+        _CASES[name] = setup
+        if threshold is not None:
+            _THRESHOLDS[name] = threshold
+        if min_delta is not None:
+            _MIN_DELTAS[name] = min_delta
+        return setup
+    return register
+
+
+def thresholds():
+    """Gets the thresholds of the registered cases that have their own.
+
+    Returns:
+        A dict of case name to threshold, to pass to compare.
+    """
+    return dict(_THRESHOLDS)
+
+
+def min_deltas():
+    """Gets the minimum slowdowns of the registered cases that have their own.
+
+    Returns:
+        A dict of case name to minimum slowdown in seconds, to pass to compare.
+    """
+    return dict(_MIN_DELTAS)
+
+
+def names(patterns=None):
+    """Lists the names of registered cases.
+
+    Args:
+        patterns: List of shell-style patterns, like ['parser.*']. If given,
+            only the cases matching one of them are listed.
+
+    Returns:
+        A list of case names in the order they were registered.
+    """
+    return [name for name in _CASES
+            if not patterns
+            or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+
+
+def run(case_names, repeat=5, min_time=0.2, report=None):
+    """Times benchmark cases.
+
+    The timed function of each case is called in a loop long enough to take at
+    least min_time, and the loop is timed repeat times, or SHORT_REPEAT times
+    as many if a call takes less than SHORT_TIME. The reference workload is
+    timed just before.
+
+    Args:
+        case_names: Names of the cases to run.
+        repeat: Number of times to time each loop of a case that is not short.
+        min_time: Minimum seconds each loop should take.
+        report: Function called with the name and statistics of each case as
+            it finishes, or None.
+
+    Returns:
+        The results, as described in the module docstring.
+    """
+    results = collections.OrderedDict()
+    for name in case_names:
+        func = _CASES[name]()
+        reference = reference_time(repeat)
+        timer = timeit.Timer(func)
+        loops = _calibrate(timer, min_time)
+        times = [t / loops for t in timer.repeat(repeat, loops)]
+        if min(times) < SHORT_TIME:
+            times.extend(t / loops for t in
+                         timer.repeat(repeat * (SHORT_REPEAT - 1), loops))
+        times.sort()
+        results[name] = {
+            'best': times[0],
+            'median': times[len(times) // 2],
+            'loops': loops,
+            'reference': reference}
+        if report is not None:
+            report(name, results[name])
+    return results
+
+
+def _calibrate(timer, min_time):
+    """Finds a number of loops taking at least min_time, by powers of 10."""
+    loops = 1
+    while timer.timeit(loops) < min_time and loops < 10 ** 9:
+        loops *= 10
+    return loops
+
+
+def reference_time(repeat=5):
+    """Times the reference workload, to gauge the speed of this machine.
+
+    The workload is plain Python building and sorting strings, dicts and sets,
+    like the cases do.
+
+    Args:
+        repeat: Number of times to time it.
+
+    Returns:
+        The best time of the workload in seconds.
+    """
+    return min(timeit.repeat(_reference_workload, number=1, repeat=repeat))
+
+
+def _reference_workload():
+    """A fixed amount of work timed by reference_time."""
+    for _ in range(20):
+        names = dict(('user%d@example.com' % (i,), i) for i in range(2000))
+        members = set(name.upper() for name in names)
+        sorted(members)
+
+
+def compare(results, baseline, threshold=0.25, thresholds=None,
+            min_delta=MIN_DELTA, min_deltas=None):
+    """Finds the cases which got slower than their baseline.
+
+    The best time of each case is compared, since it is the least affected by
+    other activity on the machine. If both the results and the baseline have
+    reference times, the baseline times are first multiplied by the median
+    reference time now over that of the baseline.
+
+    Args:
+        results: The results of a run.
+        baseline: The results of a baseline run. Cases missing from it are not
+            compared.
+        threshold: Fraction by which a case may be slower than its baseline
+            before it counts as a regression.
+        thresholds: Dict of case name to a threshold which overrides the
+            default for that case, or None.
+        min_delta: Seconds per call by which a case must be slower than its
+            baseline to count as a regression.
+        min_deltas: Dict of case name to a minimum slowdown which overrides the
+            default for that case, or None.
+
+    Returns:
+        A list of (name,baseline,now) triples, with the best time of the case
+        in the baseline, scaled, and now, for every case that regressed.
+    """
+    thresholds = thresholds or {}
+    min_deltas = min_deltas or {}
+    regressions = []
+    scale = 1.0
+    (reference, recorded) = (_reference(results), _reference(baseline))
+    if reference and recorded:
+        scale = reference / recorded
+    for (name, stats) in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['best'] * scale
+        allowed = thresholds.get(name, threshold)
+        now = stats['best']
+        if (now > before * (1 + allowed)
+                and now - before >= min_deltas.get(name, min_delta)):
+            regressions.append((name, before, now))
+    return regressions
+
+
+def _reference(results):
+    """Returns the median reference time of results, or None if none."""
+    times = sorted(stats['reference'] for stats in results.values()
+                   if stats.get('reference'))
+    return times[len(times) // 2] if times else None
+
+
+def save(path, results):
+    """Writes results to a JSON file.
+
+    Args:
+        path: Path of the file.
+        results: The results of a run.
+    """
+    document = {'python': platform.python_version(), 'results': results}
+    with open(path, 'w') as out:
+        json.dump(document, out, indent=2, separators=(',', ': '))
+        out.write('\n')
+
+
+def load(path):
+    """Reads results written by save.
+
+    Args:
+        path: Path of the file.
+
+    Returns:
+        The results.
+    """
+    with open(path) as results_file:
+        return json.load(results_file)['results']
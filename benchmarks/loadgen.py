@@ -0,0 +1,469 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Drives the whole SMTP service under load and measures its throughput.
+
+Usage:
+    python -m benchmarks.loadgen [--clients N] [--messages N] [...]
+
+The service is started on a local port with a generated list directory, and
+sends its outgoing mail to a fake relay in the same process, which accepts
+every message and counts the deliveries. N concurrent clients then send
+messages to random set expressions over the generated lists, each waiting for
+the reply to one message before sending the next, and the tool reports
+messages and recipients per second, the p50 and p99 latency of a message from
+connecting to the final reply, and the peak RSS of the process.
+
+The clients, the service and the relay share a process and a reactor. To load a
+server running elsewhere, such as one with worker processes, first write the
+lists and a config for it with --write-lists DIR and a fixed --relay-port, start
+the server with DIR/mailingset.conf, and then run again with --target and the
+same --lists, --members and --relay-port.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+
+from twisted.internet import defer
+from twisted.internet import reactor as default_reactor
+from twisted.mail import smtp
+from twisted.python import log
+from zope.interface import implementer
+
+from mailingset.service import SetSMTPFactory
+
+import dataset
+import scale
+
+
+# Port on which the config written by --write-lists listens
+TARGET_PORT = 2525
+
+
+class RelayStats(object):
+    """Counts of what a FakeRelay has received."""
+
+    def __init__(self):
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+
+
+class FakeRelay(smtp.SMTPFactory):
+    """SMTP server that accepts every message and only counts it."""
+
+    def __init__(self, *a, **kw):
+        smtp.SMTPFactory.__init__(self, *a, **kw)
+        self.stats = RelayStats()
+
+    def buildProtocol(self, addr):
+        """Builds the protocol governing the connection to the given address.
+
+        Specified by IProtocolFactory interface.
+
+        Args:
+            addr: The (host,port) pair of the newly established connection.
+
+        Returns:
+            The protocol, an implementation of IProtocol.
+        """
+        protocol = smtp.ESMTP()
+        protocol.factory = self
+        protocol.delivery = _RelayDelivery(self.stats)
+        return protocol
+
+
+@implementer(smtp.IMessageDelivery)
+class _RelayDelivery(object):
+    """Accepts every sender and recipient on behalf of FakeRelay."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.counted = False
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        self.counted = False
+        return origin
+
+    def validateTo(self, user):
+        self.stats.recipients += 1
+        return self._message
+
+    def _message(self):
+        """Creates the message for one recipient.
+
+        The SMTP server delivers a copy of the message to each recipient, so
+        only the first copy in a transaction is counted.
+        """
+        counted = self.counted
+        self.counted = True
+        return _RelayMessage(None if counted else self.stats)
+
+
+@implementer(smtp.IMessage)
+class _RelayMessage(object):
+    """Counts one message received by FakeRelay, unless stats is None."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def lineReceived(self, line):
+        if self.stats is not None:
+            self.stats.bytes += len(line) + 1
+
+    def eomReceived(self):
+        if self.stats is not None:
+            self.stats.messages += 1
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
+
+
+def server_config(config, relay_port):
+    """Completes a dataset config with what the service needs to run.
+
+    Args:
+        config: ConfigParser object returned by dataset.generate.
+        relay_port: Port on localhost of the relay for outgoing mail.
+
+    Returns:
+        The same config.
+    """
+    config.set('incoming', 'accept_from', '127.0.0.1')
+    config.add_section('outgoing')
+    config.set('outgoing', 'server', '127.0.0.1')
+    config.set('outgoing', 'port', str(relay_port))
+    config.set('outgoing', 'envelope_sender', 'mailingset@' + dataset.DOMAIN)
+    return config
+
+
+def message(size, index):
+    """Builds a message with a body of about the given number of bytes.
+
+    Args:
+        size: Size of the body in bytes.
+        index: Number of the message, used in its Message-ID.
+
+    Returns:
+        The message as a string.
+    """
+    lines = ['From: Load Generator <loadgen@example.com>',
+             'Subject: Load test message %d' % (index,),
+             'Message-ID: <loadgen.%d@example.com>' % (index,),
+             '']
+    line = 'x' * 76
+    lines.extend([line] * (size // (len(line) + 1)))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def random_expressions(listnames, rand):
+    """Yields endless random unions of one to three lists.
+
+    Args:
+        listnames: Names of the lists to combine.
+        rand: random.Random object to choose with.
+    """
+    while True:
+        leaves = rand.sample(listnames, rand.randint(1, min(3, len(listnames))))
+        yield '_|_'.join(leaves)
+
+
+def weighted_expressions(mix, rand):
+    """Yields endless expressions drawn from a weighted mix.
+
+    Args:
+        mix: List of pairs (expression,weight).
+        rand: random.Random object to choose with.
+    """
+    total = sum(weight for (_, weight) in mix)
+    while True:
+        point = rand.uniform(0, total)
+        for (expression, weight) in mix:
+            point -= weight
+            if point <= 0:
+                break
+        yield expression
+
+
+class Results(object):
+    """Outcome of a load run.
+
+    Attributes:
+        latencies: Seconds taken by every message that was accepted.
+        failures: Number of messages that were rejected or failed.
+        seconds: Duration of the run.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.failures = 0
+        self.seconds = 0.0
+
+    def summary(self, relay_stats=None):
+        """Summarizes the run.
+
+        Args:
+            relay_stats: RelayStats of the relay that received the outgoing
+                mail, or None if it is unknown.
+
+        Returns:
+            A dict of 'messages', 'failures', 'messages_per_second',
+            'latency_p50', 'latency_p99' and 'peak_rss_bytes', plus
+            'recipients' and 'recipients_per_second' if relay_stats is given.
+        """
+        latencies = sorted(self.latencies)
+        seconds = self.seconds or float('inf')
+        summary = collections.OrderedDict([
+            ('messages', len(latencies)),
+            ('failures', self.failures),
+            ('messages_per_second', len(latencies) / seconds),
+            ('latency_p50', _percentile(latencies, 0.5)),
+            ('latency_p99', _percentile(latencies, 0.99)),
+            ('peak_rss_bytes', peak_rss())])
+        if relay_stats is not None:
+            summary['recipients'] = relay_stats.recipients
+            summary['recipients_per_second'] = relay_stats.recipients / seconds
+        return summary
+
+
+def _percentile(values, fraction):
+    """Picks the given percentile out of a sorted list, or None if empty."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss():
+    """Measures the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and Mac OS X reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def drive(host, port, expressions, sizes, clients, count, rand,
+          domain=dataset.DOMAIN, reactor=default_reactor):
+    """Sends messages to an SMTP server from concurrent clients.
+
+    Args:
+        host: Host of the server.
+        port: Port of the server.
+        expressions: Iterator of set expressions to send to.
+        sizes: List of message body sizes in bytes to choose from.
+        clients: Number of clients sending at the same time.
+        count: Total number of messages to send.
+        rand: random.Random object to choose sizes with.
+        domain: Domain of the server's mailing list addresses.
+        reactor: Reactor with which to connect.
+
+    Returns:
+        A Deferred firing with the Results once every message has been sent.
+    """
+    results = Results()
+    remaining = [count]
+    start = timeit.default_timer()
+
+    def send_next(_=None):
+        """Sends a message, then the next one, until none remain."""
+        if not remaining[0]:
+            return None
+        remaining[0] -= 1
+        index = count - remaining[0]
+        to_addr = '%s@%s' % (next(expressions), domain)
+        body = message(rand.choice(sizes), index)
+        sent = timeit.default_timer()
+        sending = smtp.sendmail(host, 'loadgen@example.com', [to_addr], body,
+                                port=port, reactor=reactor)
+        def accepted(_):
+            results.latencies.append(timeit.default_timer() - sent)
+        def failed(failure):
+            results.failures += 1
+            log.msg('Failed to send to %s: %s' % (
+                to_addr, failure.getErrorMessage()))
+        sending.addCallbacks(accepted, failed)
+        return sending.addCallback(send_next)
+
+    def finish(_):
+        results.seconds = timeit.default_timer() - start
+        return results
+
+    senders = [send_next() for _ in range(min(clients, count))]
+    return defer.gatherResults(senders).addCallback(finish)
+
+
+def main(argv=None):
+    """Runs a load test and prints its results.
+
+    Args:
+        argv: Command line arguments, excluding the program name. Defaults to
+            sys.argv[1:].
+
+    Returns:
+        Exit status: 0 on success, 1 if any message failed.
+    """
+    options = _parse_args(argv)
+    rand = random.Random(options.seed)
+    params = dict(scale.BASE, lists=options.lists, members=options.members)
+    listnames = sorted('list%d' % (index,) for index in range(options.lists))
+    if options.write_lists:
+        return write_lists(options.write_lists, params, options.relay_port)
+
+    relay = FakeRelay()
+    relay_port = default_reactor.listenTCP(options.relay_port, relay,
+                                           interface='127.0.0.1')
+
+    if options.target:
+        # The server elsewhere loads the lists written by --write-lists
+        (host, port) = options.target
+    else:
+        path = tempfile.mkdtemp(prefix='mailingset-loadgen-')
+        try:
+            config = dataset.generate(path, **params)
+            server_config(config, relay_port.getHost().port)
+            factory = SetSMTPFactory(config, smtp.sendmail)
+            (host, port) = ('127.0.0.1', default_reactor.listenTCP(
+                0, factory, interface='127.0.0.1').getHost().port)
+        finally:
+            # The state is loaded, so the files are no longer needed
+            shutil.rmtree(path, True)
+
+    if options.expressions:
+        expressions = weighted_expressions(options.expressions, rand)
+    else:
+        expressions = random_expressions(listnames, rand)
+
+    outcome = {}
+    def report(results):
+        outcome['summary'] = results.summary(relay.stats)
+    running = drive(host, port, expressions, options.sizes, options.clients,
+                    options.messages, rand)
+    running.addCallback(report)
+    running.addErrback(log.err)
+    running.addBoth(lambda _: default_reactor.stop())
+    default_reactor.run()
+
+    summary = outcome.get('summary')
+    if summary is None:
+        return 1
+    for (key, value) in summary.items():
+        print('%-22s %s' % (key, value))
+    if options.save:
+        with open(options.save, 'w') as out:
+            json.dump(summary, out, indent=2, separators=(',', ': '))
+            out.write('\n')
+    return 1 if summary['failures'] else 0
+
+
+def write_lists(path, params, relay_port):
+    """Writes generated lists and a config for a server to load them, for use
+    with --target. The server listens on TARGET_PORT.
+
+    Args:
+        path: Directory in which to write them, which is created if missing.
+        params: Keyword arguments to dataset.generate.
+        relay_port: Port on localhost of the relay for outgoing mail.
+
+    Returns:
+        Exit status 0.
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    config = server_config(dataset.generate(path, **params), relay_port)
+    config.set('incoming', 'port', str(TARGET_PORT))
+    config_path = os.path.join(path, 'mailingset.conf')
+    with open(config_path, 'w') as out:
+        config.write(out)
+    print('Wrote lists and config to %s' % (config_path,))
+    return 0
+
+
+def _parse_args(argv):
+    """Parses command line arguments."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadgen',
+                                     description='Drives the SMTP service '
+                                     'under load.')
+    parser.add_argument('--clients', type=int, default=10,
+                        help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='messages to send in total (default: '
+                        '%(default)s)')
+    parser.add_argument('--size', dest='sizes', type=int, action='append',
+                        metavar='BYTES',
+                        help='message body size, chosen at random among those '
+                        'given; may be given more than once (default: 2000)')
+    parser.add_argument('--expression', dest='expressions', action='append',
+                        type=_expression, metavar='EXPR[:WEIGHT]',
+                        help='send to this set expression, like '
+                        'list1_|_list2:3; may be given more than once '
+                        '(default: random unions of up to three lists)')
+    parser.add_argument('--lists', type=int, default=100,
+                        help='lists to generate (default: %(default)s)')
+    parser.add_argument('--members', type=int, default=200,
+                        help='mean members per list (default: %(default)s)')
+    parser.add_argument('--target', type=_host_port, metavar='HOST:PORT',
+                        help='load a server running elsewhere instead of '
+                        'starting one; it must use lists written by '
+                        '--write-lists')
+    parser.add_argument('--write-lists', metavar='DIR',
+                        help='write the generated lists and a config using '
+                        'them to DIR for a server to load with --target, and '
+                        'exit without sending; needs --relay-port')
+    parser.add_argument('--relay-port', type=int, default=0,
+                        help='port of the fake relay (default: any free port)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the random choices (default: '
+                        '%(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    options = parser.parse_args(argv)
+    if options.write_lists and not options.relay_port:
+        parser.error('--write-lists needs --relay-port')
+    options.sizes = options.sizes or [2000]
+    return options
+
+
+def _expression(text):
+    """Parses an --expression argument into a pair (expression,weight)."""
+    (expression, _, weight) = text.partition(':')
+    try:
+        return (expression, float(weight or 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected EXPR[:WEIGHT]: %s' % text)
+
+
+def _host_port(text):
+    """Parses a --target argument into a pair (host,port)."""
+    (host, _, port) = text.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected HOST:PORT: %s' % text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
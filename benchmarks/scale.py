@@ -0,0 +1,177 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Reports how MailingSetState scales with the shape of the list directory.
+
+Usage:
+    python -m benchmarks.scale [--sweep PARAM=V1,V2,...] [--save FILE]
+
+Each sweep varies one parameter of dataset.generate while the others keep the
+values in BASE, and reports for every value the time to load the state, the
+memory it holds, and the latency of evaluating random expressions over its
+lists. Without --sweep, every sweep in SWEEPS is run.
+"""
+import argparse
+import collections
+import gc
+import json
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from mailingset import memory
+from mailingset import parser
+from mailingset.state import MailingSetState
+
+import dataset
+
+
+# Parameters of dataset.generate shared by every sweep
+BASE = {'lists': 500, 'members': 200, 'depth': 2, 'collisions': 0.05,
+        'named': 0.7}
+
+# Default values to sweep each parameter over
+SWEEPS = collections.OrderedDict([
+    ('lists', [100, 500, 2000]),
+    ('members', [50, 200, 1000]),
+    ('depth', [0, 2, 6]),
+    ('sharing', [1, 2, 8]),
+    ('collisions', [0.0, 0.05, 0.5]),
+    ('named', [0.0, 0.7, 1.0])])
+
+# Shapes of the random expressions evaluated against each dataset
+EXPRESSIONS = ['%s', '%s_|_%s', '%s_&_%s', '{%s_|_%s}_-_%s']
+
+
+def measure(params, evaluations=500, seed=0):
+    """Generates a dataset, then loads and queries it.
+
+    Args:
+        params: Keyword arguments for dataset.generate.
+        evaluations: Number of random expressions to evaluate.
+        seed: Seed for the choice of expressions.
+
+    Returns:
+        A dict of 'load_seconds', the time to construct MailingSetState;
+        'memory_bytes', the size of its components; and 'eval_p50' and
+        'eval_p99', percentiles of the seconds to evaluate an expression.
+    """
+    path = tempfile.mkdtemp(prefix='mailingset-scale-')
+    try:
+        config = dataset.generate(path, **params)
+        gc.collect()
+        start = timeit.default_timer()
+        state = MailingSetState(config)
+        load_seconds = timeit.default_timer() - start
+    finally:
+        shutil.rmtree(path, True)
+
+    rand = random.Random(seed)
+    listnames = sorted(state.components()['lists'])
+    latencies = []
+    for _ in range(evaluations):
+        shape = rand.choice(EXPRESSIONS)
+        leaves = tuple(rand.choice(listnames)
+                       for _ in range(shape.count('%s')))
+        start = timeit.default_timer()
+        try:
+            parser.parse(state, shape % leaves)
+        except SyntaxError:
+            # Intersections and differences may be empty, which still takes
+            # the full evaluation
+            pass
+        latencies.append(timeit.default_timer() - start)
+    latencies.sort()
+
+    return {
+        'load_seconds': load_seconds,
+        'memory_bytes': memory.deep_size(state.components()),
+        'eval_p50': _percentile(latencies, 0.5),
+        'eval_p99': _percentile(latencies, 0.99)}
+
+
+def _percentile(values, fraction):
+    """Picks the given percentile out of a sorted list."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv=None):
+    """Runs the sweeps and prints their results.
+
+    Args:
+        argv: Command line arguments, excluding the program name. Defaults to
+            sys.argv[1:].
+
+    Returns:
+        Exit status.
+    """
+    options = _parse_args(argv)
+    sweeps = options.sweeps or SWEEPS.items()
+    results = collections.OrderedDict()
+    for (param, values) in sweeps:
+        print('%s (others: %s)' % (param, ', '.join(
+            '%s=%s' % item for item in sorted(BASE.items())
+            if item[0] != param)))
+        for value in values:
+            params = dict(BASE)
+            params[param] = value
+            stats = measure(params, options.evaluations)
+            results['%s=%s' % (param, value)] = stats
+            print('  %-10s load %8.3f s  memory %8.1f MB  '
+                  'eval p50 %8.1f us  p99 %8.1f us' % (
+                      value, stats['load_seconds'],
+                      stats['memory_bytes'] / 1e6,
+                      stats['eval_p50'] * 1e6, stats['eval_p99'] * 1e6))
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as out:
+            json.dump(results, out, indent=2, separators=(',', ': '))
+            out.write('\n')
+    return 0
+
+
+def _parse_args(argv):
+    """Parses command line arguments."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.scale',
+                                     description='Reports how loading and '
+                                     'querying scale with the list directory.')
+    parser.add_argument('--sweep', dest='sweeps', action='append',
+                        type=_sweep, metavar='PARAM=V1,V2,...',
+                        help='sweep a parameter of dataset.generate over '
+                        'these values; may be given more than once')
+    parser.add_argument('--evaluations', type=int, default=500,
+                        help='random expressions to evaluate per dataset '
+                        '(default: %(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    return parser.parse_args(argv)
+
+
+def _sweep(text):
+    """Parses a --sweep argument into a pair (param,values)."""
+    try:
+        (param, values) = text.split('=', 1)
+        return (param, [json.loads(value) for value in values.split(',')])
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected PARAM=V1,V2,...: %s' % text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""The administrative web interface of the Mailing Set server.
+
+It is served by the same reactor as the SMTP service and should be reachable
+only from trusted hosts. The resources are:
+
+    /metrics    Server metrics in the Prometheus text format.
+    /memory     Approximate memory held by each component of the server, as
+                JSON. With ?snapshot=1, also the growth of the Python heap
+                since the previous snapshot, if tracemalloc is available.
+    /profile    Takes a profile of the reactor thread and responds with the
+                path of the file it was written to.
+    /query      Evaluates a set expression and responds with its recipients,
+                a page at a time, as JSON.
+
+"""
+from twisted.web import resource
+from twisted.web import server
+
+from memory import MemoryResource
+from metrics import MetricsResource
+from profiler import ProfileResource
+from query import QueryResource
+
+
+def build_site(factory, profiler=None):
+    """Builds the administrative web site for a Mailing Set SMTP server.
+
+    Args:
+        factory: The SetSMTPFactory of the server.
+        profiler: The Profiler with which to serve /profile, or None to leave
+            it out.
+
+    Returns:
+        A twisted.web.server.Site to listen on.
+    """
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource(factory.metrics.registry))
+    root.putChild('memory', MemoryResource(factory))
+    root.putChild('query', QueryResource(factory))
+    if profiler is not None:
+        root.putChild('profile', ProfileResource(profiler))
+    return server.Site(root)
@@ -0,0 +1,384 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A local archive of outgoing messages.
+
+Messages are appended to segmented mbox files in the archive directory, named
+archive-00000.mbox, archive-00001.mbox, and so on. A new segment is started once
+the current one exceeds the configured size. Alongside the segments is an index
+file with one tab-separated line per message:
+
+    segment  offset  length  message-id  expression
+
+where offset and length locate the message in its segment file, and expression
+is the set expression from the List-Id of the message. The index is loaded into
+memory at startup, so finding every message sent to a set expression or finding
+a message by Message-ID is a dict lookup.
+
+Writes are done by a background thread so that disk I/O never blocks the
+reactor. Messages written while the thread is busy are written together, with
+one fsync of the segment and of the index per batch.
+
+Several processes, such as worker processes, may share one archive. Each batch
+is written holding a lock on the index file, so batches from different
+processes are appended one after another, and every lookup first loads the
+index entries appended since the last one, by this process or another.
+"""
+import collections
+import os
+import Queue
+import re
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from suppression import FileLock
+
+
+# Entry in the index, locating one message in the archive
+ArchiveEntry = collections.namedtuple('ArchiveEntry',
+        ['segment', 'offset', 'length', 'message_id', 'expression'])
+
+
+class Archive(object):
+    """Segmented append-only mbox archive, indexed by Message-ID and expression.
+    """
+
+    # Default size in bytes after which a new segment is started
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, reactor=None):
+        """
+        Args:
+            path: Directory holding the archive. It is created if it does not
+                exist.
+            segment_size: Size in bytes after which a new segment is started.
+            reactor: The reactor on which to fire the Deferreds returned by
+                write. Defaults to the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._path = os.path.abspath(path)
+        self._segment_size = segment_size
+
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+        # Index of archived messages and the number of bytes of the index file
+        # loaded into it, only used on the reactor thread
+        self._by_id = {}
+        self._by_expression = collections.defaultdict(list)
+        self._index_offset = 0
+        self._load_index()
+
+        # Messages waiting for the writer thread, which is started on demand
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def write(self, message_id, expression, text, headers=()):
+        """Appends a message to the archive.
+
+        Args:
+            message_id: The Message-ID header of the message, or None.
+            expression: The set expression the message was sent to.
+            text: The serialized message.
+            headers: Sequence of (name,value) pairs of extra headers to put at
+                the top of the archived copy of the message.
+
+        Returns:
+            A Deferred firing with the ArchiveEntry of the message once it is
+            safely on disk.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                    name='mailingset-archive')
+            self._thread.daemon = True
+            self._thread.start()
+
+        done = defer.Deferred()
+        self._queue.put((message_id, expression, text, headers, done))
+        return done
+
+    def lookup(self, expression):
+        """Finds every archived message sent to a set expression.
+
+        Args:
+            expression: The set expression, in any case.
+
+        Returns:
+            A list of ArchiveEntry in the order the messages were archived.
+        """
+        self._catch_up()
+        return list(self._by_expression.get(expression.lower(), []))
+
+    def lookup_id(self, message_id):
+        """Finds an archived message by its Message-ID.
+
+        Args:
+            message_id: The Message-ID header of the message, which may be
+                folded.
+
+        Returns:
+            The ArchiveEntry of the message, or None if it is not archived.
+        """
+        self._catch_up()
+        return self._by_id.get(_clean(message_id))
+
+    def components(self):
+        """Gets the parts of the archive held in memory, for measuring their
+        size.
+
+        Returns:
+            A dict of component name to the object holding it: 'index', the
+            in-memory index; and 'pending', the list of messages waiting to be
+            written.
+        """
+        return {
+            'index': (self._by_id, self._by_expression),
+            'pending': list(self._queue.queue)}
+
+    def read(self, entry):
+        """Reads an archived message.
+
+        Args:
+            entry: The ArchiveEntry of the message.
+
+        Returns:
+            The message as it appears in the mbox segment, starting with its
+            "From " separator line.
+        """
+        with open(self._segment_path(entry.segment), 'rb') as segment:
+            segment.seek(entry.offset)
+            return segment.read(entry.length)
+
+    def close(self):
+        """Waits for pending writes to finish and stops the writer thread.
+
+        The archive may still be written to afterwards, which starts a new
+        writer thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _segment_path(self, segment):
+        """Path of the segment file with the given number."""
+        return os.path.join(self._path, 'archive-%05d.mbox' % (segment,))
+
+    def _index_path(self):
+        """Path of the index file."""
+        return os.path.join(self._path, 'index')
+
+    def _load_index(self):
+        """Loads the index file."""
+        if not os.path.exists(self._index_path()):
+            return
+
+        with FileLock(self._index_path()):
+            with open(self._index_path(), 'rb') as index:
+                self._index_offset = self._read_index(index)
+
+            # Drop a partially written entry left by a crash, so that new
+            # entries are not appended to it. Its message is left as an orphan.
+            if self._index_offset < os.path.getsize(self._index_path()):
+                with open(self._index_path(), 'r+b') as index:
+                    index.truncate(self._index_offset)
+
+    def _catch_up(self):
+        """Loads the entries appended to the index file since it was last read,
+        by this process or another sharing the archive.
+        """
+        try:
+            size = os.path.getsize(self._index_path())
+        except OSError:
+            return
+        if size > self._index_offset:
+            with open(self._index_path(), 'rb') as index:
+                index.seek(self._index_offset)
+                self._index_offset += self._read_index(index)
+
+    def _read_index(self, index):
+        """Adds the complete entries of the index file from its position to
+        the in-memory index.
+
+        Args:
+            index: The index file, open for reading.
+
+        Returns:
+            The number of bytes of the entries read.
+        """
+        valid = 0
+        for line in index:
+            fields = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(fields) != 5:
+                break
+            entry = ArchiveEntry(int(fields[0]), int(fields[1]),
+                    int(fields[2]), fields[3] or None, fields[4])
+            self._add_to_index(entry)
+            valid += len(line)
+        return valid
+
+    def _add_to_index(self, entry):
+        """Adds an entry to the in-memory index.
+
+        Args:
+            entry: The ArchiveEntry to add.
+        """
+        if entry.message_id:
+            self._by_id[entry.message_id] = entry
+        self._by_expression[entry.expression.lower()].append(entry)
+
+    def _run(self):
+        """Writes queued messages to disk until close is called.
+
+        A batch that cannot be written fails, so that no Deferred is left
+        unfired.
+        """
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+            try:
+                with FileLock(self._index_path()):
+                    entries = self._write_batch(batch)
+            except Exception:
+                self._fail_batch(batch, failure.Failure())
+            else:
+                self._reactor.callFromThread(self._written, batch, entries)
+
+    def _write_batch(self, batch):
+        """Writes a batch of messages to the end of the archive.
+
+        Must be called holding the lock on the index file, since other
+        processes may be writing to the archive too.
+
+        Args:
+            batch: List of (message_id,expression,text,headers,done) tuples.
+
+        Returns:
+            A list of the ArchiveEntry of each message.
+        """
+        # The last segment, which may have been started by another process
+        number = max(self._segments() or [0])
+        entries = []
+        opened = []
+        try:
+            segment = open(self._segment_path(number), 'ab')
+            opened.append(segment)
+            for (message_id, expression, text, headers, _) in batch:
+                segment.seek(0, os.SEEK_END)
+                if segment.tell() >= self._segment_size:
+                    number += 1
+                    segment = open(self._segment_path(number), 'ab')
+                    opened.append(segment)
+                offset = segment.tell()
+                segment.write(_mbox_entry(text, headers))
+                entries.append(ArchiveEntry(number, offset,
+                        segment.tell() - offset, _clean(message_id),
+                        _clean(expression)))
+            for written in opened:
+                _sync(written)
+        finally:
+            for written in opened:
+                written.close()
+
+        # The index is written only once the messages are on disk, so that
+        # every index entry refers to a complete message
+        with open(self._index_path(), 'ab') as index:
+            index.write(''.join('%d\t%d\t%d\t%s\t%s\n' % (entry.segment,
+                    entry.offset, entry.length, entry.message_id or '',
+                    entry.expression) for entry in entries))
+            _sync(index)
+        return entries
+
+    def _segments(self):
+        """Lists the numbers of the segment files in the archive directory."""
+        return [int(match.group(1)) for match in
+                (_SEGMENT_NAME.match(name) for name in os.listdir(self._path))
+                if match]
+
+    def _written(self, batch, entries):
+        """Loads the index entries of a batch that was written, along with any
+        written by other processes, and fires the Deferreds of the batch.
+
+        Args:
+            batch: List of (message_id,expression,text,headers,done) tuples.
+            entries: The ArchiveEntry of each message, as written.
+        """
+        self._catch_up()
+        for ((_, _, _, _, done), entry) in zip(batch, entries):
+            done.callback(entry)
+
+    def _fail_batch(self, batch, reason):
+        """Fires the Deferreds of a batch of messages that were not written.
+
+        Args:
+            batch: List of (message_id,expression,text,headers,done) tuples.
+            reason: The Failure with which to fire the Deferreds.
+        """
+        for (_, _, _, _, done) in batch:
+            self._reactor.callFromThread(done.errback, reason)
+
+
+# Name of a segment file, giving its number
+_SEGMENT_NAME = re.compile(r'^archive-(\d+)\.mbox$')
+
+
+def _mbox_entry(text, headers):
+    """Formats a serialized message as an mbox entry.
+
+    Args:
+        text: The serialized message.
+        headers: Sequence of (name,value) pairs of extra headers to put at the
+            top of the message.
+
+    Returns:
+        The message preceded by a "From " separator line and followed by a
+        blank line, with lines in the message that begin with "From " quoted.
+    """
+    separator = 'From mailingset %s\n' % (time.asctime(),)
+    extra = ''.join('%s: %s\n' % (name, value) for (name, value) in headers)
+    body = re.sub(r'(?m)^(>*From )', r'>\1', extra + text)
+    if not body.endswith('\n'):
+        body += '\n'
+    return separator + body + '\n'
+
+
+def _clean(field):
+    """Makes a string safe to store as a field in the index file."""
+    if field is None:
+        return None
+    return ' '.join(field.split())
+
+
+def _sync(open_file):
+    """Flushes a file all the way to disk."""
+    open_file.flush()
+    os.fsync(open_file.fileno())
@@ -0,0 +1,244 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Processing of bounces sent back to the envelope sender.
+
+Bounces are recognized as delivery status notifications (DSNs) in the format of
+RFC 3464. A DSN has a message/delivery-status part holding a block of fields for
+each recipient, for example:
+
+    Final-Recipient: rfc822; someone@example.com
+    Action: failed
+    Status: 5.1.1
+
+A recipient whose action is "failed" has hard-bounced. A block without an
+Action field is taken as a hard bounce if its status is a permanent failure
+(5.x.x); one with another action, such as "delayed", is not, whatever its
+status. Addresses that hard-bounce often enough are added to the suppression
+list so they stop receiving mail. Hard bounces are counted in the suppression
+list too, so that processes sharing its journal file count them together. The
+delivery status part may be sent as is, or encoded as base64 or
+quoted-printable.
+"""
+import binascii
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.mail import smtp
+from twisted.python import log
+
+
+class BounceProcessor(object):
+    """Counts hard bounces per address and suppresses addresses that bounce."""
+
+    def __init__(self, suppressed, threshold=1):
+        """
+        Args:
+            suppressed: The SuppressionList in which to count hard bounces, and
+                to which to add addresses that hard-bounce.
+            threshold: Number of hard bounces after which an address is
+                suppressed.
+        """
+        self.suppressed = suppressed
+        self.threshold = threshold
+
+    @property
+    def counts(self):
+        """A dict of address to the number of hard bounces seen for it."""
+        return self.suppressed.bounces()
+
+    def hard_bounce(self, addr):
+        """Records a hard bounce, suppressing the address past the threshold.
+
+        Args:
+            addr: The email address that bounced, in any case.
+        """
+        addr = addr.lower()
+        count = self.suppressed.bounce(addr)
+        log.msg('Hard bounce %s (%d)' % (addr, count))
+        if count >= self.threshold and addr not in self.suppressed:
+            log.msg('Suppressing %s' % (addr,))
+            self.suppressed.add(addr)
+
+
+@implementer(smtp.IMessage)
+class BounceMessage(object):
+    """Receives a bounce and reports the addresses that hard-bounced.
+
+    The message is scanned one line at a time as it arrives and is never
+    buffered, so a bounce carrying a large returned message costs no more
+    memory than a small one.
+    """
+
+    # Length beyond which a decoded line of the delivery status part without a
+    # line break is truncated
+    MAX_LINE = 998
+
+    def __init__(self, processor, verp_recipient=None):
+        """
+        Args:
+            processor: The BounceProcessor to which to report hard bounces.
+            verp_recipient: The recipient address decoded from the VERP
+                envelope sender to which the bounce was sent, or None if the
+                bounce was sent to the plain envelope sender. If given, it is
+                reported instead of the recipients named in the DSN, which may
+                have been rewritten by forwarding.
+        """
+        self.processor = processor
+        self.verp_recipient = verp_recipient
+
+        # Whether the lines being received are in a message/delivery-status
+        # part, whether they are its headers, and the fields of the block of
+        # lines being received
+        self._in_status = False
+        self._in_headers = False
+        self._fields = {}
+
+        # Content-Transfer-Encoding of the part whose headers were last seen,
+        # base64 characters left over from the previous line, and the decoded
+        # text following the last complete line
+        self._encoding = None
+        self._undecoded = ''
+        self._partial = ''
+
+        # Recipients the DSN reports as permanently failed
+        self._failed = set()
+
+    def lineReceived(self, line):
+        """Handles another line of data.
+
+        Specified by IMessage interface.
+
+        Args:
+            line: Line of message data without terminating newline.
+        """
+        lower = line.lower()
+        if not self._in_status:
+            if line.startswith('--') or not line.strip():
+                # MIME boundary or end of headers
+                self._encoding = None
+            elif lower.startswith('content-transfer-encoding:'):
+                self._encoding = lower.split(':', 1)[1].strip()
+            elif (lower.startswith('content-type:')
+                    and 'message/delivery-status' in lower):
+                self._in_status = True
+                self._in_headers = True
+        elif line.startswith('--'):
+            # MIME boundary ending the delivery status part
+            self._end_status()
+        elif self._in_headers:
+            if not line.strip():
+                self._in_headers = False
+            elif lower.startswith('content-transfer-encoding:'):
+                self._encoding = lower.split(':', 1)[1].strip()
+        else:
+            for decoded in self._decode(line):
+                self._field_line(decoded)
+
+    def eomReceived(self):
+        """Handles the end of the message by reporting hard bounces.
+
+        Specified by IMessage interface.
+
+        Returns:
+            A Deferred that has already fired.
+        """
+        self._end_status()
+        if self.verp_recipient:
+            failed = set([self.verp_recipient]) if self._failed else set()
+        else:
+            failed = self._failed
+        for addr in failed:
+            self.processor.hard_bounce(addr)
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        """Handles truncation of message by discarding anything received so far.
+
+        Specified by IMessage interface.
+        """
+        self._failed = set()
+
+    def _decode(self, line):
+        """Decodes a line of the body of the delivery status part.
+
+        Args:
+            line: Line of message data without terminating newline.
+
+        Returns:
+            The list of lines of the part completed by this one, decoded and
+            without terminating newlines.
+        """
+        if self._encoding == 'base64':
+            data = self._undecoded + ''.join(line.split())
+            usable = len(data) - len(data) % 4
+            self._undecoded = data[usable:]
+            try:
+                text = binascii.a2b_base64(data[:usable])
+            except binascii.Error:
+                text = ''
+        elif self._encoding == 'quoted-printable':
+            if line.endswith('='):
+                # Soft line break
+                text = binascii.a2b_qp(line[:-1])
+            else:
+                text = binascii.a2b_qp(line) + '\n'
+        else:
+            text = line + '\n'
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()[:self.MAX_LINE]
+        return [decoded.rstrip('\r') for decoded in lines]
+
+    def _field_line(self, line):
+        """Handles a decoded line of the body of the delivery status part.
+
+        Args:
+            line: The line without terminating newline.
+        """
+        if not line.strip():
+            self._end_block()
+        elif ':' in line and line[0] not in ' \t':
+            (name, value) = line.split(':', 1)
+            self._fields[name.strip().lower()] = value.strip()
+
+    def _end_status(self):
+        """Handles the end of the delivery status part."""
+        if self._partial:
+            self._field_line(self._partial)
+        self._end_block()
+        self._in_status = False
+        self._in_headers = False
+        self._encoding = None
+        self._undecoded = ''
+        self._partial = ''
+
+    def _end_block(self):
+        """Handles the end of a block of fields in the delivery status part."""
+        fields = self._fields
+        self._fields = {}
+        if 'final-recipient' not in fields:
+            return
+
+        # Field looks like "rfc822; someone@example.com"
+        addr = fields['final-recipient'].split(';', 1)[-1].strip().strip('<>')
+        if 'action' in fields:
+            failed = fields['action'].lower() == 'failed'
+        else:
+            failed = fields.get('status', '').startswith('5')
+        if addr and failed:
+            self._failed.add(addr.lower())
@@ -0,0 +1,220 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Structured logging written by a background thread.
+
+Log events are written as JSON lines, one object per event. Besides the time,
+system, and human-readable message, the object holds any extra fields passed to
+log.msg, so that
+
+    log.msg(format='Sent to %(count)d recipients', event='sent', count=3)
+
+is written as
+
+    {"count": 3, "event": "sent", "message": "Sent to 3 recipients", ...}
+
+Events are encoded and written by a background thread, so neither JSON encoding
+nor file I/O and rotation ever stall the reactor. A set is written as a sorted
+list, and since sorting a large set is part of encoding it, it is also done by
+the background thread.
+"""
+import datetime
+import json
+import os
+import Queue
+import threading
+
+from twisted.python import log
+
+
+# Keys of Twisted log events that are not extra fields
+_STANDARD_KEYS = frozenset(['format', 'isError', 'message', 'system', 'time',
+                            'failure', 'why'])
+
+# Types of values that are written as extra fields
+_FIELD_TYPES = (basestring, bool, int, long, float, list, tuple, dict, set,
+                frozenset, type(None))
+
+
+class ThreadedWriter(object):
+    """Writes to a file on a background thread.
+
+    The thread is started on demand by the first write, and started again by
+    the first write after a fork, since only the thread that forked survives in
+    the child process. Once stopped, writes are done immediately on the calling
+    thread, so that nothing logged late in shutdown is lost.
+    """
+
+    def __init__(self, out):
+        """
+        Args:
+            out: A file-like object with write and flush methods, such as a
+                twisted.python.logfile.LogFile. It is used only by the
+                background thread.
+        """
+        self._out = out
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def write(self, item, encode=str):
+        """Queues something to be written.
+
+        Args:
+            item: The thing to write.
+            encode: A function converting item into the string to write. It is
+                called on the background thread.
+        """
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._stopped:
+                    self._write_batch([(item, encode)])
+                    return
+                if self._thread is None or self._pid != os.getpid():
+                    # Items queued before a fork are written by the parent
+                    self._queue = Queue.Queue()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run,
+                            args=(self._queue,), name='mailingset-log')
+                    self._thread.daemon = True
+                    self._thread.start()
+        self._queue.put((item, encode))
+
+    def stop(self):
+        """Waits for everything queued to be written and stops the thread."""
+        with self._lock:
+            self._stopped = True
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self, queue):
+        """Writes queued items until stop is called.
+
+        Args:
+            queue: The Queue.Queue of items to write.
+        """
+        while True:
+            batch = [queue.get()]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                self._write_batch(batch[:batch.index(None)])
+                return
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """Writes and flushes a batch of queued items.
+
+        Args:
+            batch: List of (item,encode) pairs as passed to write.
+        """
+        for (item, encode) in batch:
+            try:
+                self._out.write(encode(item))
+            except Exception:
+                # Logging the failure would come right back here
+                pass
+        self._out.flush()
+
+
+class JSONLogObserver(object):
+    """A Twisted log observer writing events as JSON lines.
+
+    Add it with log.addObserver(observer.emit), and call stop at shutdown to
+    make sure everything is written.
+    """
+
+    def __init__(self, out, include=None, exclude=()):
+        """
+        Args:
+            out: A file-like object with write and flush methods, such as a
+                twisted.python.logfile.LogFile.
+            include: If not None, a collection of values of the 'event' field.
+                Only events with one of these values are written.
+            exclude: A collection of values of the 'event' field. Events with
+                one of these values are not written.
+        """
+        self._writer = ThreadedWriter(out)
+        self._include = include
+        self._exclude = frozenset(exclude)
+
+    def emit(self, event_dict):
+        """Queues a log event to be written.
+
+        Args:
+            event_dict: The Twisted log event.
+        """
+        event = event_dict.get('event')
+        if event in self._exclude:
+            return
+        if self._include is not None and event not in self._include:
+            return
+
+        # Format the message here because the event may hold objects, like a
+        # Failure, that are not safe to touch from another thread
+        record = {
+            'time': event_dict.get('time'),
+            'system': event_dict.get('system'),
+            'message': log.textFromEventDict(event_dict)}
+        if event_dict.get('isError'):
+            record['error'] = True
+        for (key, value) in event_dict.items():
+            if (key not in _STANDARD_KEYS and not key.startswith('log_')
+                    and isinstance(value, _FIELD_TYPES)):
+                if isinstance(value, set):
+                    # The caller may change the set once this returns
+                    value = frozenset(value)
+                record[key] = value
+        self._writer.write(record, _encode)
+
+    def stop(self):
+        """Waits for all emitted events to be written."""
+        self._writer.stop()
+
+
+def _encode(record):
+    """Encodes a log record as one line of JSON.
+
+    Args:
+        record: Dict of log fields, where 'time' is seconds since the epoch.
+
+    Returns:
+        The JSON line, including the terminating newline.
+    """
+    if record.get('time') is not None:
+        when = datetime.datetime.utcfromtimestamp(record['time'])
+        record['time'] = when.isoformat() + 'Z'
+    try:
+        return json.dumps(record, sort_keys=True, default=_sorted) + '\n'
+    except UnicodeDecodeError:
+        # Byte strings that are not UTF-8, such as from a raw header
+        return json.dumps(record, sort_keys=True, default=_sorted,
+                          encoding='latin-1') + '\n'
+
+
+def _sorted(value):
+    """Encodes a frozenset field as a sorted list, for json.dumps."""
+    if isinstance(value, frozenset):
+        return sorted(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
@@ -0,0 +1,260 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Hit counts of set expressions and the materialized results of the hottest.
+
+Every set expression evaluated from the local list definitions is counted. The
+results of the most frequently used ones are kept, so that the next message to
+one of them looks up its recipients instead of evaluating the expression again.
+
+The hit counts of the hottest expressions may be saved to a file, which is read
+back when the server starts, so that their results can be evaluated ahead of
+the first message after a restart. The file is JSON, like:
+
+    {"expressions": [
+      {"domain": "server.local", "expression": "cats_-_dogs", "hits": 1041}]}
+
+When list definitions are reloaded, only the results that depend on a list or
+person whose definition changed are dropped and evaluated again.
+"""
+import collections
+import json
+import os
+import tempfile
+
+from twisted.python import log
+
+
+class HotExpressions(object):
+    """Hit counts of set expressions, with the results of the hottest ones.
+
+    Expressions are identified by a pair (domain,address) of the lowercase
+    domain and the local part of the destination address. This is used only on
+    the reactor thread.
+    """
+
+    # Hit counts are kept for at most this many times as many expressions as
+    # are materialized, so that one-off expressions do not accumulate
+    TRACKED_FACTOR = 10
+
+    def __init__(self, size=100, path=None):
+        """
+        Args:
+            size: Number of expressions whose results are kept. If 0, nothing
+                is kept or counted.
+            path: Path of the file from which to read and to which to save the
+                hit counts of the hottest expressions, or None to keep them
+                only in memory. The file need not exist yet.
+        """
+        self.size = size
+        self._path = path
+        self._hits = collections.Counter()
+
+        # Materialized (tag,addrs) pairs of the hottest expressions
+        self._results = {}
+
+        if path is not None and os.path.exists(path):
+            self._read()
+
+    def __len__(self):
+        return len(self._results)
+
+    def components(self):
+        """Gets the parts held in memory, for measuring their size.
+
+        Returns:
+            A dict of component name to the object holding it: 'hits', the hit
+            counts of expressions; and 'results', the materialized results.
+        """
+        return {'hits': self._hits, 'results': self._results}
+
+    def lookup(self, domain, address, counted=True):
+        """Looks up the materialized result of an expression, counting a hit.
+
+        Args:
+            domain: The lowercase domain of the destination address.
+            address: The local part of the destination address.
+            counted: Whether to count a hit of the expression if it is
+                materialized.
+
+        Returns:
+            The pair (tag,addrs) of subject tag and set of recipient addresses
+            that the expression evaluated to, or None if it is not
+            materialized. The set must not be modified.
+        """
+        key = (domain, address)
+        result = self._results.get(key)
+        if result is not None and counted:
+            self._hits[key] += 1
+        return result
+
+    def record(self, domain, address, tag, addrs):
+        """Counts a hit of an expression that was evaluated.
+
+        The result is kept if the expression is among the hottest.
+
+        Args:
+            domain: The lowercase domain of the destination address.
+            address: The local part of the destination address.
+            tag: The subject tag the expression evaluated to.
+            addrs: The set of recipient addresses the expression evaluated to.
+                It must not be modified afterwards.
+        """
+        key = (domain, address)
+        self._hits[key] += 1
+        if self.size and self._is_hot(key):
+            self._results[key] = (tag, addrs)
+        if len(self._hits) > self.size * self.TRACKED_FACTOR:
+            self._prune()
+
+    def _is_hot(self, key):
+        """Checks whether an expression belongs among the materialized ones.
+
+        If it does and there is no room for it, the coldest materialized
+        expression is dropped to make room.
+        """
+        if key in self._results or len(self._results) < self.size:
+            return True
+        coldest = min(self._results, key=self._hits.__getitem__)
+        if self._hits[coldest] >= self._hits[key]:
+            return False
+        del self._results[coldest]
+        return True
+
+    def _prune(self):
+        """Forgets the hit counts of all but the hottest expressions."""
+        keep = self._hits.most_common(self.size * self.TRACKED_FACTOR // 2)
+        self._hits = collections.Counter(dict(keep))
+        self._hits.update(dict.fromkeys(self._results, 0))
+
+    def pending(self, states):
+        """Lists the hottest expressions that are not materialized.
+
+        Args:
+            states: A dict of lowercase domain to the MailingSetState of the
+                domains served. Expressions of other domains are left out.
+
+        Returns:
+            A list of (domain,address) pairs, hottest first.
+        """
+        return [key for (key, _) in self._hits.most_common(self.size)
+                if key not in self._results and key[0] in states]
+
+    def install(self, results):
+        """Materializes results evaluated ahead of time, as far as there is
+        room for them.
+
+        Args:
+            results: A dict of (domain,address) pair to (tag,addrs) pair, as
+                listed by pending.
+        """
+        for (key, result) in results.items():
+            if self.size and self._is_hot(key):
+                self._results[key] = result
+
+    def refresh(self, old_states, new_states, leaves):
+        """Drops the results that may differ under new list definitions.
+
+        A result is kept only if every list or person named in its expression
+        resolves the same way in the new state of its domain as in the old.
+
+        Args:
+            old_states: A dict of lowercase domain to MailingSetState with
+                which the results were evaluated.
+            new_states: A dict of lowercase domain to the MailingSetState
+                replacing it.
+            leaves: A function taking a set expression and returning the
+                names of the lists and people in it, like parser.leaves.
+
+        Returns:
+            The number of results dropped.
+        """
+        changed = {}
+        def has_changed(domain, leaf):
+            key = (domain, leaf.lower())
+            if key not in changed:
+                changed[key] = (_resolve(old_states.get(domain), leaf) !=
+                                _resolve(new_states.get(domain), leaf))
+            return changed[key]
+
+        stale = [(domain, address) for (domain, address) in self._results
+                 if domain not in new_states or
+                 any(has_changed(domain, leaf) for leaf in leaves(address))]
+        for key in stale:
+            del self._results[key]
+        return len(stale)
+
+    def save(self):
+        """Saves the hit counts of the hottest expressions to the file.
+
+        The file is replaced atomically, so a reader sees either the old or the
+        new counts. The counts are first written to a uniquely named file in the
+        same directory, so that processes saving at the same time do not write
+        over each other's partial files. Does nothing if there is no file.
+        """
+        if self._path is None:
+            return
+        expressions = [{'domain': domain, 'expression': address, 'hits': hits}
+                       for ((domain, address), hits)
+                       in self._hits.most_common(self.size)]
+        (fd, temp_path) = tempfile.mkstemp(prefix='.hot-',
+                dir=os.path.dirname(os.path.abspath(self._path)))
+        try:
+            with os.fdopen(fd, 'w') as hot_file:
+                json.dump({'expressions': expressions}, hot_file, indent=2,
+                          separators=(',', ': '), sort_keys=True)
+                hot_file.write('\n')
+            os.rename(temp_path, self._path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _read(self):
+        """Reads the hit counts saved to the file.
+
+        A file that cannot be read is logged and otherwise ignored, because
+        the counts only affect how quickly messages are accepted.
+        """
+        try:
+            with open(self._path) as hot_file:
+                saved = json.load(hot_file)
+            for expression in saved['expressions']:
+                key = (expression['domain'].encode('utf-8'),
+                       expression['expression'].encode('utf-8'))
+                self._hits[key] = int(expression['hits'])
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            log.err(None, 'Failed to read hot expressions %s' % (self._path,))
+            self._hits.clear()
+
+
+def _resolve(state, leaf):
+    """Resolves a list or person for comparison between states.
+
+    Args:
+        state: The MailingSetState with which to resolve the leaf, or None.
+        leaf: The name of the list or person.
+
+    Returns:
+        The pair (symbol,addrs) it resolves to, the message of the error
+        resolving it, or None if it is not defined.
+    """
+    if state is None or not state.knows(leaf):
+        return None
+    try:
+        return state(leaf)
+    except SyntaxError as e:
+        return str(e)
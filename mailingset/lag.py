@@ -0,0 +1,119 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measurement of how long the reactor is kept from running.
+
+Everything the server does for every connection runs on the reactor thread, so
+a slow call anywhere stalls every SMTP session. The LagMonitor schedules a
+heartbeat at a fixed interval and records how late each one runs in a
+histogram. A watchdog thread checks on the heartbeat. If it is overdue by more
+than a threshold, the watchdog captures the stack of the reactor thread, which
+shows the call that is blocking it. The stack is logged as a 'stall' event,
+along with how long the stall lasted, once the reactor is running again.
+"""
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.internet import task
+from twisted.python import log
+
+
+class LagMonitor(object):
+    """Measures reactor lag and captures the stack of calls that block it."""
+
+    def __init__(self, lag_seconds, stalls, interval=0.1, threshold=0.5,
+                 reactor=None):
+        """
+        Args:
+            lag_seconds: The Histogram in which to record how late each
+                heartbeat runs, in seconds.
+            stalls: The Counter in which to count stalls.
+            interval: Seconds between heartbeats.
+            threshold: Seconds by which a heartbeat must be overdue for the
+                reactor to be considered stalled.
+            reactor: The reactor to monitor. Defaults to the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.lag_seconds = lag_seconds
+        self.stalls = stalls
+        self.interval = interval
+        self.threshold = threshold
+
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._heartbeat.clock = reactor
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+        # Time of the last heartbeat, written by the reactor thread and read by
+        # the watchdog
+        self._last_beat = None
+        self._reactor_thread = None
+
+        # Stack of the reactor thread captured during the current stall, or
+        # None
+        self._stall_stack = None
+
+    def start(self):
+        """Starts the heartbeat and the watchdog. Call from the reactor thread.
+        """
+        self._reactor_thread = thread.get_ident()
+        self._last_beat = time.time()
+        self._stopping.clear()
+        self._heartbeat.start(self.interval, now=False)
+        self._watchdog = threading.Thread(target=self._watch,
+                name='mailingset-watchdog')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def stop(self):
+        """Stops the heartbeat and the watchdog."""
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        self._stopping.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _beat(self):
+        """Records how late this heartbeat ran, and reports any stall."""
+        now = time.time()
+        lag = max(0, now - self._last_beat - self.interval)
+        self._last_beat = now
+        self.lag_seconds.observe(lag)
+
+        stack = self._stall_stack
+        if stack is not None:
+            self._stall_stack = None
+            self.stalls.inc()
+            log.msg('Reactor stalled for %.3f seconds in:\n%s'
+                    % (lag + self.interval, stack),
+                    event='stall', duration=lag + self.interval, stack=stack)
+
+    def _watch(self):
+        """Captures the stack of the reactor thread whenever it stalls."""
+        while not self._stopping.wait(self.interval):
+            overdue = time.time() - self._last_beat - self.interval
+            if overdue > self.threshold and self._stall_stack is None:
+                frame = sys._current_frames().get(self._reactor_thread)
+                if frame is not None:
+                    self._stall_stack = ''.join(traceback.format_stack(frame))
+                del frame
@@ -0,0 +1,338 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Approximate accounting of the memory held by a running server.
+
+The report breaks down the bytes held by the list definitions in
+MailingSetState, the suppression list, the materialized hot expressions, the
+index of the local archive and the messages being received or sent. Sizes are
+measured by walking containers and object attributes with sys.getsizeof, so
+they count the objects themselves but not allocator overhead. A string shared
+by two components, such as an address that is both a list member and an alias,
+is counted in each.
+
+Walking the lists of a large deployment takes seconds, so MemoryResource
+measures in a thread rather than stalling the reactor. The objects are only
+copied one container at a time, so the sizes of things changing during the
+walk, such as messages in flight, are approximate.
+
+If the tracemalloc module is available, snapshots of the Python heap may also
+be taken and compared, showing which lines of code allocated the memory that
+grew between two points in time. tracemalloc is part of Python 3.4 and later;
+on Python 2.7 it is only available from the pytracemalloc backport, which
+requires an interpreter built with its patch, so snapshots are usually not
+available.
+"""
+import collections
+import json
+import sys
+import threading
+import types
+
+from twisted.internet import abstract
+from twisted.internet import interfaces
+from twisted.internet import protocol
+from twisted.internet import threads
+from twisted.python import log
+from twisted.web import resource, server
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Types whose instances are not followed when measuring objects
+_OPAQUE_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                 types.BuiltinFunctionType, types.MethodType,
+                 types.GeneratorType, types.FileType)
+
+# Types of instances which are neither counted nor followed, because they lead
+# from a component to the rest of the server: from a reactor to its listening
+# ports, from a port to its factory, and from the factory to every component
+_BOUNDARY_TYPES = (abstract.FileDescriptor, protocol.Factory,
+                   protocol.BaseProtocol, threading.Thread)
+
+
+def deep_size(obj, seen=None):
+    """Measures an object and everything reachable from it.
+
+    Containers, deques and the attributes of instances are followed. Classes,
+    modules, functions, methods, generators and files are not counted, and
+    neither are reactors, connections, ports, factories, protocols and threads,
+    which would lead to the whole server. Each
+    container is copied by a single call that does not release the global
+    interpreter lock, so this may run in another thread while the reactor
+    changes the objects.
+
+    Args:
+        obj: The object to measure.
+        seen: Set of ids of objects already counted, which are skipped. It is
+            updated with the objects counted by this call.
+
+    Returns:
+        The size in bytes.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _OPAQUE_TYPES):
+            continue
+        seen.add(id(obj))
+        if hasattr(obj, '__dict__') and _is_boundary(obj):
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+
+def _is_boundary(obj):
+    """Checks whether an instance is one at which measuring stops."""
+    return (isinstance(obj, _BOUNDARY_TYPES)
+            or interfaces.IReactorCore.providedBy(obj))
+
+
+def report(factory):
+    """Measures the memory held by each component of a server.
+
+    This walks every object held by the server, so it takes seconds for large
+    lists and must not be called on the reactor thread of a serving process;
+    MemoryResource calls collect on the reactor thread and measure in another.
+
+    Args:
+        factory: The SetSMTPFactory of the server.
+
+    Returns:
+        A dict of component to size in bytes, or to a dict of sizes for
+        components made of several parts. The 'lists' component maps each list
+        name to the size of its set of recipients, and the 'messages' component
+        gives the number of messages in flight and the total size of their
+        recipient sets and of their partially parsed data. If more than one
+        domain is served, the 'domains' component maps each domain to the
+        size of its state, counting only what is not shared with the domains
+        measured before it, starting with the domain in the incoming section.
+    """
+    return measure(collect(factory))
+
+
+def collect(factory):
+    """Gathers the objects held by each component of a server, to be measured.
+
+    This only takes references, so it is quick enough for the reactor thread,
+    and it iterates over the weak set of messages, which must not be done
+    while the reactor may change it.
+
+    Args:
+        factory: The SetSMTPFactory of the server.
+
+    Returns:
+        A dict to pass to measure.
+    """
+    components = factory.state.components()
+    domains = None
+    if len(factory.states) > 1:
+        domains = sorted(factory.states.items(), key=lambda (domain, state): (
+                state is not factory.state, domain))
+    archive = None
+    if factory.archive is not None:
+        archive = factory.archive.components()
+    return {
+        'lists': components.pop('lists'),
+        'state': components,
+        'domains': domains,
+        'suppressed': factory.suppressed.components(),
+        'hot': factory.hot.components(),
+        'archive': archive,
+        'messages': [(m.recipient_set, m.msg_parser)
+                     for m in factory.messages]}
+
+
+def measure(collected):
+    """Measures the objects gathered by collect.
+
+    Args:
+        collected: The dict returned by collect.
+
+    Returns:
+        The dict described by report.
+    """
+    result = _measure(collected['state'])
+    result['lists'] = _measure(collected['lists'])
+    if collected['domains'] is not None:
+        seen = set()
+        result['domains'] = dict(
+                (domain, deep_size(state, seen))
+                for (domain, state) in collected['domains'])
+    result['suppressed'] = _total(collected['suppressed'])
+    result['hot'] = _total(collected['hot'])
+    if collected['archive'] is not None:
+        result['archive'] = _measure(collected['archive'])
+
+    messages = collected['messages']
+    result['messages'] = {
+        'count': len(messages),
+        'recipients': sum(deep_size(recipients)
+                          for (recipients, _) in messages),
+        'buffers': sum(deep_size(parser) for (_, parser) in messages
+                       if parser is not None)}
+    return result
+
+
+def _total(components):
+    """Measures the values of a dict with deep_size, counting what they share
+    once.
+
+    Args:
+        components: A dict of name to object.
+
+    Returns:
+        The total size in bytes.
+    """
+    seen = set()
+    return sum(deep_size(value, seen) for value in components.values())
+
+
+def _measure(components):
+    """Measures each value of a dict with deep_size.
+
+    Args:
+        components: A dict of name to object.
+
+    Returns:
+        A dict of name to size in bytes.
+    """
+    return dict((name, deep_size(value))
+                for (name, value) in components.items())
+
+
+class HeapSnapshots(object):
+    """Snapshots of the Python heap taken with tracemalloc, for comparison."""
+
+    def __init__(self, frames=1):
+        """
+        Args:
+            frames: Number of frames of traceback to keep for each allocation.
+                Tracing starts when the first snapshot is taken.
+        """
+        self._frames = frames
+        self._previous = None
+
+    @staticmethod
+    def available():
+        """Checks whether the tracemalloc module can be used."""
+        return tracemalloc is not None
+
+    def take(self, limit=10):
+        """Takes a snapshot and compares it with the previous one.
+
+        The first snapshot starts tracing, so memory allocated before it is not
+        included in any comparison.
+
+        Args:
+            limit: Maximum number of lines of code to report.
+
+        Returns:
+            A list of up to limit dicts describing the lines of code whose
+            allocations grew the most since the previous snapshot, each with
+            keys 'where', 'size_diff' and 'count_diff'. The list is empty for
+            the first snapshot.
+
+        Raises:
+            RuntimeError: The tracemalloc module is not available.
+        """
+        if tracemalloc is None:
+            raise RuntimeError('tracemalloc is not available')
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__)])
+        (previous, self._previous) = (self._previous, snapshot)
+        if previous is None:
+            return []
+        stats = snapshot.compare_to(previous, 'lineno')
+        return [{'where': str(stat.traceback),
+                 'size_diff': stat.size_diff,
+                 'count_diff': stat.count_diff}
+                for stat in stats[:limit]]
+
+
+class MemoryResource(resource.Resource):
+    """A web resource serving the memory report of a server as JSON.
+
+    The report is measured in a thread, so the reactor keeps serving while it
+    is taken. With the query argument snapshot=1, a heap snapshot is also taken
+    and the lines of code whose allocations grew since the previous one are
+    included.
+    """
+
+    isLeaf = True
+
+    def __init__(self, factory):
+        """
+        Args:
+            factory: The SetSMTPFactory of the server.
+        """
+        resource.Resource.__init__(self)
+        self.factory = factory
+        self.snapshots = HeapSnapshots()
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        snapshot = request.args.get('snapshot', ['0'])[0] == '1'
+        try:
+            limit = int(request.args.get('limit', ['10'])[0])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            request.setResponseCode(400)
+            return '{"error": "limit must be a positive integer"}\n'
+        growth = None
+        if snapshot and self.snapshots.available():
+            growth = self.snapshots.take(limit)
+
+        # Nothing is written if the client goes away while measuring
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+        def respond(result):
+            """Finishes the request with the report."""
+            if disconnected:
+                return
+            if snapshot:
+                result['growth'] = growth
+            request.write(json.dumps(result, indent=2, separators=(',', ': '),
+                    sort_keys=True) + '\n')
+            request.finish()
+        def fail(reason):
+            """Finishes the request after measuring failed."""
+            log.err(reason, 'Failed to measure memory')
+            if disconnected:
+                return
+            request.setResponseCode(500)
+            request.write('{"error": "Failed to measure memory"}\n')
+            request.finish()
+        measured = threads.deferToThread(measure, collect(self.factory))
+        measured.addCallbacks(respond, fail)
+        return server.NOT_DONE_YET
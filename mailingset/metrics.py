@@ -0,0 +1,205 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Counters, gauges, and histograms exposed in the Prometheus text format.
+
+Recording a value is a dict update or a bisect into a short tuple, so metrics
+may be recorded freely on the hot path. Each metric may have a single label, for
+example the outcome of validating a recipient:
+
+    registry = Registry()
+    rcpt = registry.counter('mailingset_rcpt_total', 'RCPT outcomes', 'outcome')
+    rcpt.inc('accepted')
+
+The registry is rendered by MetricsResource, a Twisted web resource that can be
+served alongside the SMTP service.
+"""
+import bisect
+import collections
+import timeit
+
+from twisted.web import resource
+
+
+# Bucket upper bounds for latencies in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10,
+                   60)
+
+# Bucket upper bounds for sizes, like byte and recipient counts
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+class Registry(object):
+    """A collection of metrics to render together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, doc, label=None):
+        """Creates and registers a Counter. See Counter for the arguments."""
+        return self._register(Counter(name, doc, label))
+
+    def gauge(self, name, doc, label=None):
+        """Creates and registers a Gauge. See Gauge for the arguments."""
+        return self._register(Gauge(name, doc, label))
+
+    def histogram(self, name, doc, buckets=LATENCY_BUCKETS):
+        """Creates and registers a Histogram. See Histogram for the arguments.
+        """
+        return self._register(Histogram(name, doc, buckets))
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            The metrics as a string.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.doc))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return ''.join(line + '\n' for line in lines)
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+class Counter(object):
+    """A value that only goes up, like a count of messages."""
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, label=None):
+        """
+        Args:
+            name: Name of the metric, like 'mailingset_rcpt_total'.
+            doc: One-line description of the metric.
+            label: Name of the label distinguishing values of this metric, like
+                'outcome', or None if it has a single value.
+        """
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self._values = collections.defaultdict(int)
+
+    def inc(self, label_value=None, amount=1):
+        """Adds to the value with the given label value."""
+        self._values[label_value] += amount
+
+    def value(self, label_value=None):
+        """Gets the value with the given label value."""
+        return self._values.get(label_value, 0)
+
+    def samples(self):
+        """Lists the sample lines for rendering."""
+        if self.label is None:
+            return ['%s %s' % (self.name, self.value())]
+        return ['%s{%s="%s"} %s' % (self.name, self.label, key, value)
+                for (key, value) in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, like a number of messages in flight."""
+
+    kind = 'gauge'
+
+    def dec(self, label_value=None, amount=1):
+        """Subtracts from the value with the given label value."""
+        self._values[label_value] -= amount
+
+    def set(self, value, label_value=None):
+        """Sets the value with the given label value."""
+        self._values[label_value] = value
+
+
+class Histogram(object):
+    """A distribution of observed values, like latencies or sizes."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name: Name of the metric, like 'mailingset_parse_seconds'.
+            doc: One-line description of the metric.
+            buckets: Increasing sequence of bucket upper bounds.
+        """
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+
+        # Count of observations in each bucket, non-cumulative, with one extra
+        # for values above the last bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        """Records one observed value."""
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def time(self):
+        """Starts timing something to record in seconds.
+
+        Returns:
+            A function to call when the thing being timed is done. It records
+            the elapsed time and returns it.
+        """
+        start = timeit.default_timer()
+        def done():
+            elapsed = timeit.default_timer() - start
+            self.observe(elapsed)
+            return elapsed
+        return done
+
+    def count(self):
+        """Gets the number of observed values."""
+        return sum(self._counts)
+
+    def samples(self):
+        """Lists the sample lines for rendering."""
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, self._counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound,
+                    cumulative))
+        cumulative += self._counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, cumulative))
+        lines.append('%s_sum %s' % (self.name, self._sum))
+        lines.append('%s_count %d' % (self.name, cumulative))
+        return lines
+
+
+class MetricsResource(resource.Resource):
+    """A web resource serving a Registry to Prometheus."""
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        """
+        Args:
+            registry: The Registry to serve.
+        """
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -41,6 +41,12 @@ Examples:
 """
 import re
 
+from twisted.internet import defer
+
+
+# Leaf tokens are mailing list names and individual identifiers
+_LEAF_PAT = r'[A-Za-z0-9]+(?:[_.-][A-Za-z0-9]+)*'
+
 
 def parse(resolver, address):
     """Parses a Mailing Set operation.
@@ -78,6 +84,62 @@ def parse(resolver, address):
     return (tag, addrs)
 
 
+def parse_async(resolver, address):
+    """Parses a Mailing Set operation whose leaves are resolved asynchronously.
+
+    Every distinct leaf token is passed to the resolver up front, so that
+    lookups which go over the network, such as to a directory service, happen
+    concurrently. The expression is evaluated once all of them have finished.
+
+    Args:
+        resolver: A function taking a leaf token string and returning a pair
+            (symbol,addrs) as for parse, or a Deferred firing with one.
+        address: The local part of the email address to parse.
+
+    Returns:
+        A Deferred firing with a pair (tag,addrs) as returned by parse.
+
+    Failures:
+        SyntaxError: If the address could not be parsed, if the resolver
+            rejected one of the leaves, or if the address evaluated to the
+            empty set. If several leaves were rejected, the failure is for the
+            first of them in the address.
+    """
+    names = []
+    for leaf in leaves(address):
+        if leaf not in names:
+            names.append(leaf)
+    resolving = [defer.maybeDeferred(resolver, leaf) for leaf in names]
+
+    def evaluate(results):
+        for (success, result) in results:
+            if not success:
+                return result
+        resolved = dict(zip(names, [result for (_, result) in results]))
+        return parse(resolved.__getitem__, address)
+    done = defer.DeferredList(resolving, consumeErrors=True)
+    done.addCallback(evaluate)
+    return done
+
+
+def leaves(address):
+    """Lists the leaf tokens of an address without resolving or parsing it.
+
+    This is a single regex pass over the address, so it is much cheaper than
+    parse. It is useful for turning away addresses that name unknown lists or
+    people before doing the work of resolving and evaluating them.
+
+    Args:
+        address: The local part of the email address to scan.
+
+    Returns:
+        A list of leaf token strings in the order they appear in the address.
+        Nothing is checked besides the shape of each leaf, so the address may
+        still fail to parse.
+    """
+    return re.findall(_LEAF_PAT, address)
+
+
 def _expression(tokens, rbp=0):
     """Parses a stream of Mailing Set operation tokens.
 
@@ -174,12 +236,12 @@ def _yield_tokens(resolver, address):
     """
     token_pat = r"""
         (
-            [A-Za-z0-9]+(?:[_.-][A-Za-z0-9]+)*  # leaf token
+            %s                                  # leaf token
         ) | (
             _[|&-]_|\{|\}                       # operator or parenthesis
         ) |
             .                                   # anything else (error)
-        """
+        """ % (_LEAF_PAT,)
 
     # Keep track of position in input to give good error messages
     i = 1
@@ -0,0 +1,289 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""On-demand profiling of the reactor thread of a running server.
+
+A profile is started by sending the server SIGUSR1 or by requesting /profile
+from the administrative web interface. It runs for a fixed number of seconds and
+is then written to a file in the profile directory, named after the time the
+profile started. Two kinds of profile are supported:
+
+    cprofile    Deterministic profile of every function call made by the
+                reactor thread, written as profile-<time>.pstats for use with
+                the pstats module or a viewer like snakeviz.
+
+    stacks      Statistical profile taken by a background thread that samples
+                the stack of the reactor thread at a fixed interval, written as
+                profile-<time>.stacks in the collapsed format read by
+                flamegraph.pl: one line per distinct stack, with the frames
+                from outermost to innermost separated by semicolons and followed
+                by the number of samples.
+
+Nothing is hooked into the interpreter while no profile is running.
+"""
+import collections
+import cProfile
+import os
+import sys
+import thread
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.python import log
+from twisted.web import resource
+from twisted.web import server
+
+
+# Kinds of profile which may be taken
+MODES = ('cprofile', 'stacks')
+
+# Longest profile which may be taken, in seconds
+MAX_DURATION = 600
+
+
+class Profiler(object):
+    """Takes time-boxed profiles of the reactor thread, one at a time."""
+
+    def __init__(self, directory, mode='stacks', duration=30, interval=0.005,
+                 prefix='profile', reactor=None):
+        """
+        Args:
+            directory: Directory in which to write profiles. It is created if
+                it does not exist.
+            mode: Default kind of profile, one of MODES.
+            duration: Default length of a profile in seconds.
+            interval: Seconds between samples in a stacks profile.
+            prefix: Start of the name of each profile file, before the time.
+            reactor: The reactor whose thread is profiled. Defaults to the
+                global reactor.
+
+        Raises:
+            ValueError: The mode is not one of MODES.
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode: %s' % (mode,))
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._directory = directory
+        self.mode = mode
+        self.duration = duration
+        self.interval = interval
+        self.prefix = prefix
+
+        # Path of the profile being taken, or None
+        self.running = None
+
+    def start(self, mode=None, duration=None):
+        """Starts a profile. Must be called from the reactor thread.
+
+        Args:
+            mode: Kind of profile, one of MODES. Defaults to the configured
+                mode.
+            duration: Length of the profile in seconds. Defaults to the
+                configured duration.
+
+        Returns:
+            A Deferred firing with the path of the profile once it is written.
+
+        Raises:
+            ValueError: The mode is not one of MODES, or the duration is not
+                positive or is longer than MAX_DURATION.
+            RuntimeError: A profile is already running.
+        """
+        mode = mode or self.mode
+        duration = duration or self.duration
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode: %s' % (mode,))
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError('Profile duration must be between 0 and %d '
+                    'seconds: %s' % (MAX_DURATION, duration))
+        if self.running is not None:
+            raise RuntimeError('A profile is already running: %s'
+                    % (self.running,))
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        extension = 'pstats' if mode == 'cprofile' else 'stacks'
+        path = os.path.join(self._directory, '%s-%s.%s' % (self.prefix,
+                time.strftime('%Y%m%d-%H%M%S'), extension))
+        self.running = path
+        log.msg('Profiling for %s seconds: %s' % (duration, path),
+                event='profile', path=path, mode=mode, duration=duration)
+
+        if mode == 'cprofile':
+            done = self._profile(path, duration)
+        else:
+            done = self._sample(path, duration)
+        done.addBoth(self._finished)
+        return done
+
+    def _profile(self, path, duration):
+        """Runs cProfile on the reactor thread for the given duration."""
+        profile = cProfile.Profile()
+        profile.enable()
+        done = defer.Deferred()
+        def stop():
+            """Stops profiling and writes the stats."""
+            try:
+                profile.disable()
+                profile.dump_stats(path)
+            except Exception:
+                done.errback()
+            else:
+                done.callback(path)
+        self._reactor.callLater(duration, stop)
+        return done
+
+    def _sample(self, path, duration):
+        """Samples the stack of the reactor thread from a background thread."""
+        target = thread.get_ident()
+        done = defer.Deferred()
+        def run():
+            """Takes samples, then writes them and reports back."""
+            try:
+                counts = sample_stacks(target, duration, self.interval)
+                write_stacks(path, counts)
+            except Exception:
+                # The failure must be captured on this thread, where the
+                # exception is active
+                reason = failure.Failure()
+                self._reactor.callFromThread(done.errback, reason)
+            else:
+                self._reactor.callFromThread(done.callback, path)
+        sampler = threading.Thread(target=run, name='mailingset-profile')
+        sampler.daemon = True
+        sampler.start()
+        return done
+
+    def _finished(self, result):
+        """Clears the running profile and logs the outcome."""
+        self.running = None
+        if isinstance(result, str):
+            log.msg('Wrote profile: %s' % (result,))
+        return result
+
+
+class ProfileResource(resource.Resource):
+    """A web resource which takes a profile and responds with its path.
+
+    The optional query arguments mode and seconds override the configured kind
+    and length of the profile. The response is sent once the profile has been
+    written.
+    """
+
+    isLeaf = True
+
+    def __init__(self, profiler):
+        """
+        Args:
+            profiler: The Profiler with which to take profiles.
+        """
+        resource.Resource.__init__(self)
+        self.profiler = profiler
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain')
+        mode = request.args.get('mode', [None])[0]
+        try:
+            duration = float(request.args.get('seconds', [0])[0])
+            done = self.profiler.start(mode, duration)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return '%s\n' % (e,)
+        except RuntimeError as e:
+            request.setResponseCode(409)
+            return '%s\n' % (e,)
+
+        # The profile is still written if the client goes away, but nothing
+        # is sent to it
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+        def respond(path):
+            """Finishes the request with the path of the profile."""
+            if disconnected:
+                return
+            request.write('%s\n' % (path,))
+            request.finish()
+        def fail(reason):
+            """Finishes the request after the profile failed."""
+            log.err(reason, 'Failed to write profile')
+            if disconnected:
+                return
+            request.setResponseCode(500)
+            request.write('Failed to write profile\n')
+            request.finish()
+        done.addCallbacks(respond, fail)
+        return server.NOT_DONE_YET
+
+
+def sample_stacks(thread_id, duration, interval):
+    """Repeatedly samples the stack of another thread.
+
+    Args:
+        thread_id: Identifier of the thread to sample.
+        duration: Seconds for which to take samples.
+        interval: Seconds between samples.
+
+    Returns:
+        A Counter of collapsed stacks, as produced by collapse_stack, to the
+        number of times each was sampled.
+    """
+    counts = collections.Counter()
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        counts[collapse_stack(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return counts
+
+
+def collapse_stack(frame):
+    """Describes a stack in one line, outermost frame first.
+
+    Args:
+        frame: The innermost frame of the stack.
+
+    Returns:
+        A string like 'base.py:run;app.py:main' naming the source file and
+        function of each frame, separated by semicolons.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def write_stacks(path, counts):
+    """Writes sampled stacks in the collapsed format read by flamegraph.pl.
+
+    Args:
+        path: Path of the file to write.
+        counts: Mapping from collapsed stack to number of samples.
+    """
+    with open(path, 'w') as out:
+        for (stack, count) in sorted(counts.items()):
+            out.write('%s %d\n' % (stack, count))
@@ -0,0 +1,229 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Evaluation of set expressions on demand, for the administrative interface.
+
+Support staff can ask who would receive a message to a set expression without
+sending one. The expression is parsed with the same parser, list definitions
+and suppression list as an incoming message, but without counting it in the
+metrics or toward the hot expressions, and the response gives its tag,
+its number of recipients and one page of the recipients in sorted order:
+
+    GET /query?expr=cats_-_dogs&limit=2
+
+    {"count": 5, "domain": "server.local", "expression": "cats_-_dogs",
+     "members": ["a@example.com", "b@example.com"], "next": "b@example.com",
+     "tag": "C-D"}
+
+Passing next back as the cursor argument gives the following page, until next
+is null. The recipients of a page are written to the response a chunk at a
+time as the client reads it, so a large page is never held in memory as one
+string.
+"""
+import heapq
+import json
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet import interfaces
+from twisted.python import log
+from twisted.web import resource
+from twisted.web import server
+
+
+class QueryResource(resource.Resource):
+    """A web resource evaluating a set expression and serving its recipients.
+
+    The query arguments are:
+        expr    The set expression, as in the local part of an address.
+        domain  The domain of the address. Optional. Defaults to the domain in
+                the incoming section of the config.
+        limit   The most recipients to return, at most MAX_LIMIT. Optional.
+                Defaults to LIMIT.
+        cursor  The next value of the previous page. Optional. Only recipients
+                sorting after it are returned.
+    """
+
+    isLeaf = True
+
+    # Recipients returned by default, and the most that may be asked for
+    LIMIT = 1000
+    MAX_LIMIT = 10 * LIMIT
+
+    def __init__(self, factory):
+        """
+        Args:
+            factory: The SetSMTPFactory of the server, whose parser evaluates
+                the expressions.
+        """
+        resource.Resource.__init__(self)
+        self.factory = factory
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        expression = request.args.get('expr', [''])[0]
+        domain = request.args.get('domain', [None])[0]
+        cursor = request.args.get('cursor', [''])[0].lower()
+        try:
+            limit = int(request.args.get('limit', [self.LIMIT])[0])
+        except ValueError:
+            limit = 0
+        if not expression:
+            return _error(request, 400, 'Missing expr')
+        if not 1 <= limit <= self.MAX_LIMIT:
+            return _error(request, 400, 'limit must be an integer from 1 to %d'
+                    % (self.MAX_LIMIT,))
+        if domain is not None and not self.factory.serves(domain):
+            return _error(request, 404, 'Unknown domain: %s' % (domain,))
+
+        # Nothing is written if the client goes away before the expression has
+        # been evaluated
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+        def respond(parsed):
+            if not disconnected:
+                self._respond(parsed, request, expression,
+                        domain or self.factory.domain, cursor, limit)
+        def fail(reason):
+            if not disconnected:
+                self._fail(reason, request, expression)
+
+        parsed = defer.maybeDeferred(self.factory.evaluate, expression, domain)
+        parsed.addCallbacks(respond, fail)
+        parsed.addErrback(log.err, 'Failed to respond to query %s' % (
+                expression,))
+        return server.NOT_DONE_YET
+
+    def _respond(self, parsed, request, expression, domain, cursor, limit):
+        """Starts streaming one page of the recipients of an expression.
+
+        Args:
+            parsed: The pair (tag,addrs) the expression evaluated to.
+            request: The request to respond to.
+            expression: The set expression.
+            domain: The domain of the address.
+            cursor: Only recipients sorting after this are returned.
+            limit: The most recipients to return.
+        """
+        (tag, addrs) = parsed
+        members = page(addrs, cursor, limit + 1)
+        next_cursor = members[limit - 1] if len(members) > limit else None
+        del members[limit:]
+
+        head = '{"count": %d, "domain": %s, "expression": %s, "members": [' % (
+                len(addrs), json.dumps(domain), json.dumps(expression))
+        tail = '], "next": %s, "tag": %s}\n' % (json.dumps(next_cursor),
+                json.dumps(tag))
+        request.write(head)
+        request.registerProducer(_MembersProducer(request, members, tail),
+                False)
+
+    def _fail(self, reason, request, expression):
+        """Responds with the reason an expression failed to evaluate.
+
+        Args:
+            reason: The Failure from parsing the expression.
+            request: The request to respond to.
+            expression: The set expression.
+        """
+        if reason.check(SyntaxError):
+            status = 400
+        else:
+            log.err(reason, 'Failed to query %s' % (expression,))
+            status = 500
+        request.write(_error(request, status, str(reason.value)))
+        request.finish()
+
+
+@implementer(interfaces.IPullProducer)
+class _MembersProducer(object):
+    """Writes a list of recipients to a response a chunk at a time.
+
+    Each chunk is written when the transport asks for more, so only one chunk
+    of the response is buffered at once.
+    """
+
+    # Recipients written per chunk
+    CHUNK = 500
+
+    def __init__(self, request, members, tail):
+        """
+        Args:
+            request: The request to write to. The opening of the JSON response
+                has already been written.
+            members: The sorted list of recipients to write as a JSON array.
+            tail: The rest of the response, written after the recipients.
+        """
+        self.request = request
+        self.members = members
+        self.tail = tail
+        self.offset = 0
+
+    def resumeProducing(self):
+        if self.members is None:
+            return
+        chunk = self.members[self.offset:self.offset + self.CHUNK]
+        if chunk:
+            separator = ', ' if self.offset else ''
+            self.offset += len(chunk)
+            self.request.write(separator + ', '.join(json.dumps(member)
+                                                     for member in chunk))
+            return
+
+        self.members = None
+        self.request.write(self.tail)
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def stopProducing(self):
+        self.members = None
+
+
+def page(addrs, cursor, limit):
+    """Selects one page of a set of recipients in sorted order.
+
+    This takes time proportional to the number of recipients, times the
+    logarithm of limit, without sorting the whole set.
+
+    Args:
+        addrs: The set of recipient addresses.
+        cursor: Only addresses sorting after this are selected. The empty
+            string selects from the start.
+        limit: The most addresses to select.
+
+    Returns:
+        A sorted list of up to limit addresses.
+    """
+    if cursor:
+        return heapq.nsmallest(limit, (addr for addr in addrs if addr > cursor))
+    return heapq.nsmallest(limit, addrs)
+
+
+def _error(request, status, message):
+    """Sets the response code of a request and builds a JSON error body.
+
+    Args:
+        request: The request to respond to.
+        status: The HTTP status code.
+        message: The error message.
+
+    Returns:
+        The body of the response.
+    """
+    request.setResponseCode(status)
+    return json.dumps({'error': message}) + '\n'
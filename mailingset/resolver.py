@@ -0,0 +1,247 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Resolvers looking up leaf tokens in an external directory service.
+
+A resolver is a function taking a leaf token of a set expression, which is a
+mailing list name or individual identifier, and returning a pair (symbol,addrs)
+of symbol and set of recipient addresses. MailingSetState is the resolver for
+lists defined on this server. The resolvers here may instead return a Deferred,
+so expressions using them are evaluated with parser.parse_async.
+
+HTTPDirectoryResolver fetches leaves from an HTTP directory service, and
+CachingResolver keeps the results of another resolver for a while so that
+popular leaves are not fetched for every message. CachingResolver also limits
+how often the directory may be asked for names it does not know, so that spam
+to random addresses does not turn into a request to the directory for each one.
+"""
+import collections
+import json
+import urllib
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.python import log
+from twisted.web import client
+from twisted.web import http
+
+
+class CachingResolver(object):
+    """Caches the results of a resolver, which may return Deferreds.
+
+    Results, including SyntaxErrors for leaves that do not exist, are kept for
+    a fixed time, and are dropped once expired, on the next lookup of any leaf.
+    Concurrent lookups of the same leaf share one call to the underlying
+    resolver. Other failures are not cached.
+
+    Lookups of leaves that are not cached are refused with an IOError while
+    the underlying resolver has failed with max_misses SyntaxErrors in the
+    last MISS_WINDOW seconds, counting lookups still in progress. The SMTP
+    server turns that into a temporary failure, which a legitimate sender
+    retries.
+    """
+
+    # Seconds over which leaves that do not exist are counted for max_misses
+    MISS_WINDOW = 60
+
+    def __init__(self, resolver, ttl=60, max_misses=0, reactor=None):
+        """
+        Args:
+            resolver: The resolver whose results to cache.
+            ttl: Seconds for which to keep each result.
+            max_misses: Number of lookups of leaves that do not exist in
+                MISS_WINDOW seconds past which lookups are refused, or 0 for no
+                limit.
+            reactor: The reactor whose clock is used to expire results.
+                Defaults to the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._resolver = resolver
+        self.ttl = ttl
+        self.max_misses = max_misses
+
+        # Leaf token to pair (expiry,result) where result is a pair
+        # (symbol,addrs) or a Failure
+        self._cache = {}
+
+        # Pairs (expiry,val) of the results cached, oldest first, so that
+        # expired ones are dropped without scanning the whole cache
+        self._expiries = collections.deque()
+
+        # Leaf token to list of Deferreds waiting on a lookup in progress
+        self._waiting = {}
+
+        # Times at which lookups in the last MISS_WINDOW seconds found that
+        # their leaf does not exist, oldest first
+        self._misses = collections.deque()
+
+    def __call__(self, val):
+        """Resolves a leaf token.
+
+        Args:
+            val: A mailing list name or individual identifier, in any case.
+
+        Returns:
+            A Deferred firing with the pair (symbol,addrs) for the leaf.
+
+        Failures:
+            IOError: If the leaf is not cached and too many lookups recently
+                found leaves that do not exist.
+        """
+        val = val.lower()
+        self._expire()
+        cached = self._cache.get(val)
+        if cached is not None:
+            result = cached[1]
+            if _is_failure(result):
+                return defer.fail(result)
+            return defer.succeed(result)
+
+        if val not in self._waiting and self._throttled():
+            return defer.fail(IOError(
+                    'Too many lookups of unknown lists or people'))
+
+        waiting = defer.Deferred()
+        if val in self._waiting:
+            self._waiting[val].append(waiting)
+        else:
+            self._waiting[val] = [waiting]
+            lookup = defer.maybeDeferred(self._resolver, val)
+            lookup.addBoth(self._finished, val)
+        return waiting
+
+    def _finished(self, result, val):
+        """Caches the result of a lookup and passes it to everyone waiting."""
+        now = self._reactor.seconds()
+        if not _is_failure(result) or result.check(SyntaxError):
+            self._cache[val] = (now + self.ttl, result)
+            self._expiries.append((now + self.ttl, val))
+            if _is_failure(result):
+                self._misses.append(now)
+        for waiting in self._waiting.pop(val):
+            if _is_failure(result):
+                waiting.errback(result)
+            else:
+                waiting.callback(result)
+
+    def _expire(self):
+        """Drops the cached results that have expired."""
+        now = self._reactor.seconds()
+        while self._expiries and self._expiries[0][0] <= now:
+            (expiry, val) = self._expiries.popleft()
+            # The leaf may have been cached again since, with a later expiry
+            cached = self._cache.get(val)
+            if cached is not None and cached[0] == expiry:
+                del self._cache[val]
+
+    def _throttled(self):
+        """Checks whether lookups are refused because of too many misses.
+
+        Lookups in progress count as misses, so that a burst of them cannot
+        all be sent before the first one finishes.
+
+        Returns:
+            True if a new lookup must not be made.
+        """
+        if not self.max_misses:
+            return False
+        start = self._reactor.seconds() - self.MISS_WINDOW
+        while self._misses and self._misses[0] <= start:
+            self._misses.popleft()
+        return len(self._misses) + len(self._waiting) >= self.max_misses
+
+
+def _is_failure(result):
+    """Checks whether the result of a Deferred is a Failure."""
+    return isinstance(result, failure.Failure)
+
+
+class HTTPDirectoryResolver(object):
+    """Looks up leaf tokens in an HTTP directory service.
+
+    The URL of a leaf is the base URL followed by the leaf token. The service
+    responds with a JSON object like:
+
+        {"symbol": "Dog", "addrs": ["alice@example.com", "bob@example.com"]}
+
+    or with status 404 if there is no list or person by that name.
+    """
+
+    def __init__(self, base_url, agent=None):
+        """
+        Args:
+            base_url: URL to which to append leaf tokens, like
+                'http://directory.local/lists/'.
+            agent: The twisted.web.client.Agent with which to make requests.
+                Defaults to a new Agent on the global reactor.
+        """
+        if agent is None:
+            from twisted.internet import reactor
+            agent = client.Agent(reactor)
+        self._agent = agent
+        # Agent only takes URLs as byte strings
+        self.base_url = str(base_url)
+
+    def __call__(self, val):
+        """Fetches a leaf token from the directory.
+
+        Args:
+            val: A mailing list name or individual identifier.
+
+        Returns:
+            A Deferred firing with the pair (symbol,addrs) for the leaf.
+
+        Failures:
+            SyntaxError: If the directory has no list or person by that name.
+            IOError: If the directory responded with any other error.
+        """
+        url = self.base_url + urllib.quote(val.lower())
+        response = self._agent.request('GET', url)
+        response.addCallback(self._read, val, url)
+        return response
+
+    def _read(self, response, val, url):
+        """Reads the body of a response and interprets it."""
+        body = client.readBody(response)
+        if response.code == http.NOT_FOUND:
+            body.addCallback(lambda _: _not_found(val))
+        elif response.code != http.OK:
+            body.addCallback(lambda _: _failed(url, response.code))
+        else:
+            body.addCallback(_decode)
+        return body
+
+
+def _not_found(val):
+    """Rejects a leaf token which the directory does not know."""
+    raise SyntaxError('No such list or person: %s' % (val,))
+
+
+def _failed(url, code):
+    """Fails a lookup to which the directory responded with an error."""
+    log.msg('Directory lookup failed with status %d: %s' % (code, url))
+    raise IOError('Directory lookup failed with status %d' % (code,))
+
+
+def _decode(body):
+    """Decodes the JSON entry of a leaf into a pair (symbol,addrs)."""
+    entry = json.loads(body)
+    symbol = entry['symbol'].encode('utf-8')
+    addrs = set(addr.encode('utf-8').lower() for addr in entry['addrs'])
+    return (symbol, addrs)
@@ -27,22 +27,47 @@ Mailing Set can be added to a Twisted application using the following code:
 import email
 from email import Header
 from email import parser
+import functools
 import netaddr
+import random
+import timeit
+import weakref
 
 from zope.interface import implementer
 
+from twisted.internet import defer
+from twisted.internet import threads
 from twisted.mail import smtp
+from twisted.python import failure
 from twisted.python import log
 
-from mailman import subject_prefix
-
+from archive import Archive
+from bounce import BounceMessage, BounceProcessor
+from hot import HotExpressions
+from metrics import Registry, SIZE_BUCKETS
+from resolver import CachingResolver, HTTPDirectoryResolver
 from state import MailingSetState
+from subject import SubjectTagger
+from suppression import SuppressionList
 import parser
+import tracing
+import verp
 
 
 __all__ = ['SetSMTPFactory']
 
 
+# Shared by every message, so that the pattern for each tag is compiled once
+_tagger = SubjectTagger()
+
+# Prefix of the names of config sections defining additional domains
+DOMAIN_SECTION = 'domain '
+
+# Section of config holding the size limits of lists, which may be followed by
+# a domain to hold those of the lists of that domain only
+LIST_MAX_SIZE_SECTION = 'list_max_size'
+
+
 class SetSMTPFactory(smtp.SMTPFactory):
 
     def __init__(self, config, sendmail, *a, **kw):
@@ -60,9 +85,427 @@ class SetSMTPFactory(smtp.SMTPFactory):
         self.config = config
         self.sendmail = sendmail
 
-        # Cache list definitions and use them to parse destination addresses
-        resolver = MailingSetState(self.config)
-        self.parse = lambda address: parser.parse(resolver, address)
+        # Counters and timings of everything the server does
+        self.metrics = SetMetrics()
+
+        # Cache list definitions of every domain served and use them to parse
+        # destination addresses
+        self.domain = self.config.get('incoming', 'domain').lower()
+        self.states = self._load_states()
+
+        # Addresses removed from the recipients of every message
+        self.suppressed = SuppressionList(
+                self.config.get('data', 'suppression_file', fallback=None))
+
+        # Bounces to the envelope sender feed the suppression list
+        self.bounces = BounceProcessor(self.suppressed, self.config.getint(
+                'outgoing', 'bounce_threshold', fallback=1))
+
+        # Directory service consulted for leaves not defined on this server
+        self.directory = None
+        if self.config.has_option('data', 'directory_url'):
+            self.directory = CachingResolver(
+                    HTTPDirectoryResolver(
+                        self.config.get('data', 'directory_url')),
+                    ttl=self.config.getfloat('data', 'directory_ttl',
+                        fallback=60),
+                    max_misses=self.config.getint('data',
+                        'directory_max_misses', fallback=100))
+
+        # Hit counts of expressions, and the results of the hottest ones
+        self.hot = HotExpressions(
+                self.config.getint('data', 'hot_expressions', fallback=100),
+                self.config.get('data', 'hot_file', fallback=None))
+
+        # Messages being received or sent, for measuring memory use
+        self.messages = weakref.WeakSet()
+
+        # Size limits on incoming messages, where 0 means no limit
+        self.max_size = self.config.getint('incoming', 'max_size', fallback=0)
+        self.max_fanout_bytes = self.config.getint('incoming',
+                'max_fanout_bytes', fallback=0)
+        self.list_max_size = self._load_list_max_size()
+
+        # Local archive of outgoing messages, if configured
+        self.archive = None
+        if self.config.has_option('outgoing', 'archive_dir'):
+            self.archive = Archive(self.config.get('outgoing', 'archive_dir'),
+                    self.config.getint('outgoing', 'archive_segment_size',
+                        fallback=Archive.SEGMENT_SIZE))
+
+    @property
+    def state(self):
+        """The MailingSetState of the domain in the incoming section."""
+        return self.states[self.domain]
+
+    def _load_states(self):
+        """Loads the list definitions of every domain served.
+
+        The domain in the incoming section uses the lists and symbols in the
+        data section. Each additional domain has a section of its own, named
+        after the domain like [domain other.org], holding the same entries. The
+        states of all domains intern their strings in one dict, so an address
+        that is a member in several domains is stored once.
+
+        Returns:
+            A dict of lowercase domain to MailingSetState.
+
+        Raises:
+            RuntimeError: If the list definitions of any domain fail to load.
+        """
+        interned = {}
+        states = {self.domain: MailingSetState(self.config,
+                interned=interned)}
+        for section in self.config.sections():
+            if section.startswith(DOMAIN_SECTION):
+                domain = section[len(DOMAIN_SECTION):].strip().lower()
+                states[domain] = MailingSetState(self.config, section, domain,
+                        interned)
+        return states
+
+    def _load_list_max_size(self):
+        """Reads the size limits of lists and people of every domain served.
+
+        The [list_max_size] section applies to every domain. A section named
+        after a domain, like [list_max_size other.org], adds limits for the
+        lists of that domain, replacing those of the same names.
+
+        Returns:
+            A dict of lowercase domain to dict of lowercase leaf to size limit
+            in bytes.
+
+        Raises:
+            RuntimeError: If a section names a domain that is not served.
+        """
+        common = {}
+        if self.config.has_section(LIST_MAX_SIZE_SECTION):
+            for (leaf, size) in self.config.items(LIST_MAX_SIZE_SECTION):
+                common[leaf.lower()] = int(size)
+        limits = dict((domain, dict(common)) for domain in self.states)
+        prefix = LIST_MAX_SIZE_SECTION + ' '
+        for section in self.config.sections():
+            if section.startswith(prefix):
+                domain = section[len(prefix):].strip().lower()
+                if domain not in limits:
+                    raise RuntimeError('[%s] names a domain not served' % (
+                            section,))
+                for (leaf, size) in self.config.items(section):
+                    limits[domain][leaf.lower()] = int(size)
+        return limits
+
+    def serves(self, domain):
+        """Checks whether mailing lists are hosted for a domain.
+
+        Args:
+            domain: The domain of a destination address.
+
+        Returns:
+            True if the domain is one of the domains served.
+        """
+        return domain.lower() in self.states
+
+    def startFactory(self):
+        """Warms the hot expressions when the server starts listening."""
+        self.warm()
+
+    def stopFactory(self):
+        """Saves the hot expressions and waits for pending archive writes when
+        the server stops listening."""
+        self._save_hot()
+        if self.archive is not None:
+            self.archive.close()
+
+    def warm(self):
+        """Evaluates the hottest expressions that are not materialized.
+
+        They are evaluated by the worker pool, and materialized unless the list
+        definitions have been reloaded in the meantime.
+
+        Returns:
+            A Deferred firing when they have been evaluated.
+        """
+        states = self.states
+        pending = self.hot.pending(states)
+        if not pending:
+            return defer.succeed(None)
+        def install(results):
+            if self.states is states:
+                self.hot.install(results)
+                log.msg('Warmed %d hot expressions' % (len(results),))
+        warmed = threads.deferToThread(_evaluate_all, states, pending)
+        warmed.addCallback(install)
+        warmed.addErrback(log.err, 'Failed to warm hot expressions')
+        return warmed
+
+    def _save_hot(self):
+        """Saves the hit counts of the hot expressions, logging any failure."""
+        try:
+            self.hot.save()
+        except EnvironmentError:
+            log.err(None, 'Failed to save hot expressions')
+
+    def parse(self, address, domain=None):
+        """Parses a destination address as a set expression.
+
+        Addresses naming a list or person that does not exist are rejected
+        after a single tokenization pass, without resolving any leaves or
+        evaluating the expression. These are counted in the fast_rejected
+        metric.
+
+        Expressions which could evaluate to at least [pool] parse_threshold
+        recipients are evaluated by the worker pool rather than on the reactor
+        thread.
+
+        If a directory service is configured, leaves not defined on this server
+        are looked up there, and the expression is evaluated once every lookup
+        has finished.
+
+        The results of the most frequently used expressions are materialized,
+        so that they are looked up instead of evaluated. These are counted in
+        the hot_hits metric.
+
+        Suppressed addresses are removed from the result.
+
+        Args:
+            address: The local part of the destination address.
+            domain: The domain of the destination address, which must be one
+                of the domains served, or None for the domain in the incoming
+                section.
+
+        Returns:
+            A pair (tag,addrs) of subject tag and set of recipient addresses, or
+            a Deferred firing with one if the expression is evaluated by the
+            worker pool or uses the directory service.
+
+        Raises:
+            SyntaxError: If the address does not parse, names an unknown list or
+                person, or evaluates to the empty set, or if every recipient is
+                suppressed. If a Deferred is returned, it fails with this
+                instead.
+        """
+        return self._parse(address, domain, True)
+
+    def evaluate(self, address, domain=None):
+        """Evaluates a set expression without counting it as a message.
+
+        This is parse for callers that do not deliver mail, like the query
+        interface. Nothing is recorded in the metrics, and the expression does
+        not count toward the hot expressions that are materialized.
+
+        Args:
+            address: The set expression.
+            domain: One of the domains served, or None for the domain in the
+                incoming section.
+
+        Returns:
+            A pair (tag,addrs) of subject tag and set of recipient addresses, or
+            a Deferred firing with one.
+
+        Raises:
+            SyntaxError: As for parse.
+        """
+        return self._parse(address, domain, False)
+
+    def _parse(self, address, domain, counted):
+        """Parses a destination address as a set expression.
+
+        Args:
+            address: The local part of the destination address.
+            domain: The domain of the destination address, or None.
+            counted: Whether to record the expression in the metrics and
+                count it toward the hot expressions.
+
+        Returns:
+            As for parse.
+
+        Raises:
+            SyntaxError: As for parse.
+        """
+        domain = domain.lower() if domain else self.domain
+        start = timeit.default_timer()
+        hot = self.hot.lookup(domain, address, counted)
+        if hot is not None:
+            if counted:
+                self.metrics.hot_hits.inc()
+            (tag, addrs) = hot
+            return self._finish_parse(
+                    (tag, addrs, timeit.default_timer() - start), counted)
+
+        state = self.states[domain]
+        leaves = parser.leaves(address)
+        if self.directory is not None and not all(
+                state.knows(leaf) for leaf in leaves):
+            start = timeit.default_timer()
+            def finish(parsed):
+                """Records the time taken and drops suppressed addresses."""
+                (tag, addrs) = parsed
+                return self._finish_parse(
+                        (tag, addrs, timeit.default_timer() - start), counted)
+            resolved = parser.parse_async(
+                    functools.partial(self._resolve, state), address)
+            return resolved.addCallback(finish)
+
+        try:
+            state.prefilter(leaves)
+        except SyntaxError:
+            if counted:
+                self.metrics.fast_rejected.inc()
+            raise
+
+        threshold = self.config.getint('pool', 'parse_threshold',
+                fallback=10000)
+        if state.upper_bound(leaves) >= threshold:
+            evaluated = threads.deferToThread(_evaluate, state, address)
+            if counted:
+                evaluated.addCallback(self._record, state, domain, address)
+            return evaluated.addCallback(self._finish_parse, counted)
+        evaluated = _evaluate(state, address)
+        if counted:
+            self._record(evaluated, state, domain, address)
+        return self._finish_parse(evaluated, counted)
+
+    def _record(self, evaluated, state, domain, address):
+        """Counts a hit of an evaluated expression, for materializing the
+        hottest.
+
+        Args:
+            evaluated: The triple (tag,addrs,seconds) returned by _evaluate,
+                which is passed through.
+            state: The MailingSetState with which it was evaluated.
+            domain: The lowercase domain of the destination address.
+            address: The local part of the destination address.
+
+        Returns:
+            The triple evaluated.
+        """
+        # A result evaluated before a reload is not kept
+        if self.states.get(domain) is state:
+            (tag, addrs, _) = evaluated
+            self.hot.record(domain, address, tag, addrs)
+        return evaluated
+
+    def _finish_parse(self, evaluated, counted):
+        """Records the time taken to evaluate an expression and drops
+        suppressed addresses from the result.
+
+        Args:
+            evaluated: The triple (tag,addrs,seconds) returned by _evaluate.
+            counted: Whether to record the time taken in the metrics.
+
+        Returns:
+            A pair (tag,addrs) of subject tag and set of recipient addresses.
+
+        Raises:
+            SyntaxError: If every recipient is suppressed.
+        """
+        (tag, addrs, seconds) = evaluated
+        if counted:
+            self.metrics.parse_seconds.observe(seconds)
+
+        # Drop suppressed addresses, but leave alone lists that were empty to
+        # begin with to match parser.parse. Either way the set is not modified,
+        # because it may be materialized
+        if addrs:
+            addrs = self.suppressed.subtract(addrs)
+            if not addrs:
+                raise SyntaxError('All recipients are suppressed')
+        return (tag, addrs)
+
+    def _resolve(self, state, val):
+        """Resolves a leaf token defined on this server or in the directory.
+
+        Args:
+            state: The MailingSetState of the domain of the destination.
+            val: A mailing list name or individual identifier.
+
+        Returns:
+            A pair (symbol,addrs) of symbol and set of recipient addresses, or a
+            Deferred firing with one if the leaf is looked up in the directory.
+        """
+        if state.knows(val):
+            return state(val)
+        return self.directory(val)
+
+    def may_post(self, sender, address, domain=None):
+        """Checks whether a sender is allowed to post to a set expression.
+
+        This is the members-only posting policy. The sender must be a member of
+        at least one of the mailing lists named in the set expression. If the
+        expression names only individuals, the sender must be a member of some
+        mailing list on the server.
+
+        Membership is checked among the lists of the domain of the destination
+        only.
+
+        Args:
+            sender: The email address of the sender.
+            address: The local part of the destination address.
+            domain: The domain of the destination address, or None for the
+                domain in the incoming section.
+
+        Returns:
+            True if the sender is allowed to post.
+        """
+        state = self.states[domain.lower() if domain else self.domain]
+        _, flattened = state.memberships(sender)
+        named = set(leaf.lower() for leaf in parser.leaves(address))
+        if any(state.is_list(leaf) for leaf in named):
+            return bool(flattened & named)
+        return bool(flattened)
+
+    def size_limit(self, address, recipients, domain=None):
+        """Computes the largest message that may be sent to a set expression.
+
+        This is the smallest of the global max_size, the limit in the
+        list_max_size sections of any list or person named in the expression,
+        and max_fanout_bytes divided by the number of recipients.
+
+        Args:
+            address: The local part of the destination address.
+            recipients: The number of recipients the expression evaluated to.
+            domain: The domain of the destination address, or None for the
+                domain in the incoming section.
+
+        Returns:
+            The limit in bytes, or 0 if there is none.
+        """
+        limits = [self.max_size] if self.max_size else []
+        list_max_size = self.list_max_size[
+                domain.lower() if domain else self.domain]
+        for leaf in parser.leaves(address):
+            limit = list_max_size.get(leaf.lower())
+            if limit:
+                limits.append(limit)
+        if self.max_fanout_bytes and recipients:
+            limits.append(max(1, self.max_fanout_bytes // recipients))
+        return min(limits) if limits else 0
+
+    def reload(self):
+        """Reloads list definitions and symbols from the places in config.
+
+        The new states of every domain replace the old ones only if they all
+        load successfully. Messages already accepted keep the recipients they
+        were accepted with.
+
+        Materialized expressions naming a list or person whose definition
+        changed are dropped, and the hottest expressions are warmed again.
+
+        Returns:
+            A Deferred firing when the hot expressions have been warmed, or
+            None if the list definitions failed to load.
+        """
+        try:
+            states = self._load_states()
+        except Exception:
+            log.err(None, 'Failed to reload list definitions')
+            return None
+        (old_states, self.states) = (self.states, states)
+        log.msg('Reloaded list definitions')
+        dropped = self.hot.refresh(old_states, states, parser.leaves)
+        if dropped:
+            log.msg('Dropped %d stale hot expressions' % (dropped,))
+        self._save_hot()
+        return self.warm()
 
     def buildProtocol(self, addr):
         """Builds the protocol governing the connection to the given address.
@@ -77,32 +520,231 @@ class SetSMTPFactory(smtp.SMTPFactory):
         Returns:
             The protocol, an implementation of IProtocol.
         """
-        protocol = smtp.ESMTP()
+        protocol = SetESMTP(self.max_size, self.metrics)
+        protocol.factory = self
         protocol.delivery = SetMessageDelivery(protocol, self.config,
-                self.parse, self.sendmail)
+                self.serves, self.parse, self.may_post, self.size_limit,
+                self.bounces, self.archive, self.metrics, self.messages,
+                self.sendmail)
         return protocol
 
 
+class SetMetrics(object):
+    """The metrics recorded by the Mailing Set SMTP server.
+
+    Each metric is an attribute, so recording one on the hot path costs only an
+    attribute lookup and an update.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.from_total = self.registry.counter('mailingset_from_total',
+                'Outcomes of validating the sender of a message', 'outcome')
+        self.rcpt_total = self.registry.counter('mailingset_rcpt_total',
+                'Outcomes of validating the recipient of a message', 'outcome')
+        self.fast_rejected = self.registry.counter(
+                'mailingset_fast_rejected_total',
+                'Recipients naming an unknown list or person, rejected before '
+                'parsing')
+        self.parse_seconds = self.registry.histogram(
+                'mailingset_parse_seconds',
+                'Time to parse and evaluate set expressions')
+        self.recipients = self.registry.histogram('mailingset_recipients',
+                'Number of recipients of accepted set expressions',
+                SIZE_BUCKETS)
+        self.message_bytes = self.registry.histogram('mailingset_message_bytes',
+                'Size of received message data', SIZE_BUCKETS)
+        self.munge_seconds = self.registry.histogram('mailingset_munge_seconds',
+                'Time to rewrite the headers of a message')
+        self.send_seconds = self.registry.histogram('mailingset_send_seconds',
+                'Time to send a message through the outgoing server')
+        self.send_failures = self.registry.counter(
+                'mailingset_send_failures_total',
+                'Transactions with the outgoing server that failed')
+        self.in_flight = self.registry.gauge('mailingset_messages_in_flight',
+                'Messages being received or sent')
+        self.reactor_lag = self.registry.histogram(
+                'mailingset_reactor_lag_seconds',
+                'Time by which the reactor heartbeat was late')
+        self.reactor_stalls = self.registry.counter(
+                'mailingset_reactor_stalls_total',
+                'Times the reactor was blocked for longer than the threshold')
+        self.too_large = self.registry.counter('mailingset_too_large_total',
+                'Messages rejected for exceeding the size limit, by the '
+                'command at which they were rejected', 'stage')
+        self.hot_hits = self.registry.counter('mailingset_hot_hits_total',
+                'Set expressions looked up from the materialized results of '
+                'hot expressions instead of evaluated')
+
+
+def _evaluate(state, address):
+    """Parses and evaluates a set expression, timing how long it takes.
+
+    This may run on a thread of the worker pool, so it touches nothing but the
+    immutable state.
+
+    Args:
+        state: The MailingSetState with which to resolve the leaves.
+        address: The local part of the destination address.
+
+    Returns:
+        A triple (tag,addrs,seconds) of subject tag, set of recipient addresses,
+        and seconds taken to evaluate the expression.
+
+    Raises:
+        SyntaxError: If the address does not parse or evaluates to the empty
+            set.
+    """
+    start = timeit.default_timer()
+    (tag, addrs) = parser.parse(state, address)
+    return (tag, addrs, timeit.default_timer() - start)
+
+
+def _evaluate_all(states, expressions):
+    """Evaluates set expressions ahead of time, skipping invalid ones.
+
+    This runs on a thread of the worker pool, like _evaluate.
+
+    Args:
+        states: A dict of lowercase domain to MailingSetState.
+        expressions: A list of (domain,address) pairs of the domain and local
+            part of destination addresses.
+
+    Returns:
+        A dict of (domain,address) pair to (tag,addrs) pair of subject tag and
+        set of recipient addresses.
+    """
+    results = {}
+    for (domain, address) in expressions:
+        try:
+            results[(domain, address)] = parser.parse(states[domain], address)
+        except SyntaxError:
+            continue
+    return results
+
+
+class SetESMTP(smtp.ESMTP):
+    """ESMTP server protocol supporting the SIZE extension of RFC 1870.
+
+    The size limit is advertised in the reply to EHLO, and a MAIL command
+    declaring a larger size is rejected. The declared size is kept so that
+    recipients with a lower limit can be rejected as well. A client whose data
+    exceeds the limit anyway is told so and disconnected straight away, rather
+    than reading the rest of the message only to throw it away.
+    """
+
+    def __init__(self, max_size, metrics, *a, **kw):
+        """
+        Args:
+            max_size: The largest message accepted in bytes, or 0 if there is
+                no limit.
+            metrics: The SetMetrics in which to record rejections.
+        """
+        smtp.ESMTP.__init__(self, *a, **kw)
+        self.max_size = max_size
+        self.metrics = metrics
+
+        # Size declared by the client for the current transaction, or None
+        self.declared_size = None
+
+    def extensions(self):
+        """Lists the supported service extensions, adding SIZE.
+
+        Returns:
+            A dict of extension name to list of parameters or None.
+        """
+        ext = smtp.ESMTP.extensions(self)
+        ext['SIZE'] = [str(self.max_size)] if self.max_size else None
+        return ext
+
+    def do_MAIL(self, rest):
+        """Handles the MAIL command, checking any declared SIZE.
+
+        Args:
+            rest: The arguments of the command.
+        """
+        match = self.mail_re.match(rest)
+        if not self._from and match and match.group('opts'):
+            self.declared_size = None
+            for opt in match.group('opts').split():
+                (key, _, value) = opt.partition('=')
+                if key.upper() != 'SIZE':
+                    continue
+                if not value.isdigit():
+                    self.sendCode(501, 'Syntax error in SIZE parameter')
+                    return
+                self.declared_size = int(value)
+            if (self.max_size and self.declared_size is not None
+                    and self.declared_size > self.max_size):
+                log.msg('Rejecting declared size %d' % (self.declared_size,))
+                self.metrics.too_large.inc('mail')
+                self.sendCode(552, 'Message size exceeds fixed maximum '
+                        'message size')
+                return
+        elif not self._from:
+            self.declared_size = None
+        smtp.ESMTP.do_MAIL(self, rest)
+
+    def dataLineReceived(self, line):
+        """Handles a line of message data, disconnecting once it is too large.
+
+        Args:
+            line: The line, without its line ending.
+        """
+        smtp.ESMTP.dataLineReceived(self, line)
+        if self.datafailed is not None and not self.transport.disconnecting:
+            self.sendCode(self.datafailed.code, self.datafailed.resp)
+            self.transport.loseConnection()
+
+    state_DATA = dataLineReceived
+
+
 @implementer(smtp.IMessageDelivery)
 class SetMessageDelivery(object):
 
-    def __init__(self, protocol, config, parse, sendmail):
+    def __init__(self, protocol, config, serves, parse, may_post, size_limit,
+            bounces, archive, metrics, messages, sendmail):
         """
         Args:
             protocol: The protocol governing interaction with client
                 connections.
             config: ConfigParser object holding configuration for the Mailing
                 Set SMTP server.
-            parse: A function taking an email address and returning a pair of
-                subject tag and recipient address set.
+            serves: A function taking the domain of a destination address and
+                returning whether mailing lists are hosted for it.
+            parse: A function taking the local part and domain of an email
+                address and returning a pair of subject tag and recipient
+                address set.
+            may_post: A function taking a sender address and the local part
+                and domain of a destination address, and returning whether the
+                members-only posting policy allows the sender to post there.
+            size_limit: A function taking the local part of a destination
+                address, its number of recipients and its domain, and returning
+                the largest message in bytes that may be sent there, or 0 if
+                unlimited.
+            bounces: The BounceProcessor to handle bounces sent to the envelope
+                sender.
+            archive: The Archive to which to write outgoing messages, or None.
+            metrics: The SetMetrics in which to record what happens.
+            messages: A WeakSet to which to add each SetMessage created.
             sendmail: A function with the same signature as smtp.sendmail which
                 will be called to send outgoing messages.
         """
         self.protocol = protocol
         self.config = config
+        self.serves = serves
         self.parse = parse
+        self.may_post = may_post
+        self.size_limit = size_limit
+        self.bounces = bounces
+        self.archive = archive
+        self.metrics = metrics
+        self.messages = messages
         self.sendmail = sendmail
 
+        # Trace id of the current SMTP transaction
+        self.trace_id = tracing.new_id()
+
     def receivedHeader(self, helo, origin, recipients):
         """Generates the Received header for a message.
 
@@ -138,15 +780,20 @@ class SetMessageDelivery(object):
             SMTPBadSender: If origin is not one of the accept_from addresses set
                 in the server config.
         """
+        # A new sender starts a new transaction
+        self.trace_id = tracing.new_id()
+
         good = self.config.get('incoming', 'accept_from', fallback='0.0.0.0/0')
         for cidr in good.split(','):
             if helo[1] in netaddr.IPNetwork(cidr):
                 # Accept messages from this address
                 log.msg('Receiving from %s %s' % (helo, origin))
+                self.metrics.from_total.inc('accepted')
                 return origin
 
         # Do not accept messages from this address
         log.msg('Rejecting from %s %s' % (helo, origin))
+        self.metrics.from_total.inc('rejected')
         raise smtp.SMTPBadSender(helo[1])
 
     def validateTo(self, user):
@@ -157,70 +804,198 @@ class SetMessageDelivery(object):
         Args:
             user: The address to validate.
 
+        Bounces sent to the envelope sender, or to a VERP envelope sender built
+        from it, are accepted and handed to the bounce processor instead of
+        being parsed as a set expression.
+
         Returns:
             A callable which takes no arguments and returns an object
             implementing IMessage, which will be used to deliver the message
-            when it arrives.
+            when it arrives, or a Deferred firing with one.
 
         Raises:
-            SMTPBadRcpt: If the domain of the recipient address does not match
-                the server's domain, or if the recipient address fails to parse
-                as a set expression. This results in a bounce back to the
-                sender.
+            SMTPBadRcpt: If the domain of the recipient address is not one of
+                the domains served, if the recipient address fails to parse
+                as a set expression, if the members_only policy is enabled
+                and the sender is not a member, or if the size declared by the
+                sender exceeds the size limit of the set expression. This
+                results in a bounce back to the sender. A failure to parse or
+                a size limit fails the returned Deferred instead of being
+                raised.
         """
-        # Check for domain matching server's domain
+        # Check for bounces, which may be to a different domain
+        envelope_sender = self.config.get('outgoing', 'envelope_sender')
+        dest = str(user.dest)
+        if dest.lower() == envelope_sender.lower():
+            log.msg('Receiving bounce from %s' % (user.orig,))
+            self.metrics.rcpt_total.inc('bounce')
+            return lambda: BounceMessage(self.bounces)
+        verp_recipient = verp.decode(envelope_sender, dest)
+        if verp_recipient:
+            log.msg('Receiving bounce for %s' % (verp_recipient,))
+            self.metrics.rcpt_total.inc('bounce')
+            return lambda: BounceMessage(self.bounces, verp_recipient)
+
+        # Check for domain matching one of the server's domains
+        msg_trace = tracing.Trace(self.trace_id, user.dest.local)
+        msg_trace.mark('rcpt')
         domain = user.dest.domain
-        if domain != self.config.get('incoming', 'domain'):
+        if not self.serves(domain):
             log.msg('Rejecting domain %s' % (domain,))
+            self.metrics.rcpt_total.inc('wrong_domain')
             reason = 'Incorrect domain: %s' % (domain,)
             raise smtp.SMTPBadRcpt(user, resp=reason)
 
-        # Try to parse address as set expression
+        # Check members-only posting policy
         local = user.dest.local
-        try:
-            subject_tag, recipient_set = self.parse(local)
-        except SyntaxError as error:
-            log.msg('Rejecting address %s: %s' % (local, error))
-            reason = str(error)
+        members_only = self.config.getboolean('incoming', 'members_only',
+                fallback=False)
+        if members_only and not self.may_post(str(user.orig), local, domain):
+            log.msg('Rejecting non-member %s to %s' % (user.orig, local))
+            self.metrics.rcpt_total.inc('not_member')
+            reason = 'Sender is not a member: %s' % (user.orig,)
             raise smtp.SMTPBadRcpt(user, resp=reason)
 
-        # Good to go, receive rest of message
-        return lambda: SetMessage(
-                self.config, local, subject_tag, recipient_set, self.sendmail)
+        # Try to parse address as set expression, which is done by the worker
+        # pool for large expressions
+        parsed = defer.maybeDeferred(self.parse, local, domain)
+        parsed.addCallbacks(self._accept, self._reject_invalid,
+                callbackArgs=(user, local, domain, msg_trace),
+                errbackArgs=(user, local))
+        return parsed
+
+    def _reject_invalid(self, reason, user, local):
+        """Rejects a recipient address that failed to parse.
+
+        Args:
+            reason: The Failure from parsing the address.
+            user: The address being validated.
+            local: The local part of the address.
+
+        Raises:
+            SMTPBadRcpt: If parsing failed with a SyntaxError, or with a
+                temporary 451 code if the directory service failed or refused
+                the lookup. Other failures are passed through.
+        """
+        if reason.check(IOError):
+            log.msg('Deferring address %s: %s' % (local, reason.value))
+            self.metrics.rcpt_total.inc('directory_failed')
+            raise smtp.SMTPBadRcpt(user, code=451, resp=str(reason.value))
+        reason.trap(SyntaxError)
+        log.msg('Rejecting address %s: %s' % (local, reason.value))
+        self.metrics.rcpt_total.inc('invalid')
+        raise smtp.SMTPBadRcpt(user, resp=str(reason.value))
+
+    def _accept(self, parsed, user, local, domain, msg_trace):
+        """Accepts a recipient address that parsed successfully.
+
+        Args:
+            parsed: The pair (tag,addrs) of subject tag and set of recipient
+                addresses.
+            user: The address being validated.
+            local: The local part of the address.
+            domain: The domain of the address.
+            msg_trace: The Trace of the message.
+
+        Returns:
+            A callable which takes no arguments and returns the SetMessage
+            which will receive the message.
+
+        Raises:
+            SMTPBadRcpt: If the sender declared a size larger than the size
+                limit of the set expression.
+        """
+        (subject_tag, recipient_set) = parsed
+        msg_trace.mark('parsed')
+
+        max_size = self.size_limit(local, len(recipient_set), domain)
+        declared_size = getattr(self.protocol, 'declared_size', None)
+        if (max_size and declared_size is not None
+                and declared_size > max_size):
+            log.msg('Rejecting declared size %d for %s' % (declared_size,
+                    local))
+            self.metrics.rcpt_total.inc('too_large')
+            self.metrics.too_large.inc('rcpt')
+            reason = 'Message size exceeds limit of %d bytes for %s' % (
+                    max_size, local)
+            raise smtp.SMTPBadRcpt(user, code=552, resp=reason)
+
+        self.metrics.rcpt_total.inc('accepted')
+        self.metrics.recipients.observe(len(recipient_set))
+        def build_message():
+            """Creates the SetMessage to receive the rest of the message."""
+            message = SetMessage(self.config, local, domain, subject_tag,
+                    recipient_set, max_size, self.archive, self.metrics,
+                    msg_trace, self.sendmail)
+            self.messages.add(message)
+            return message
+        return build_message
 
 
 @implementer(smtp.IMessage)
 class SetMessage(object):
 
-    def __init__(self, config, address, subject_tag, recipient_set, sendmail):
+    def __init__(self, config, address, domain, subject_tag, recipient_set,
+            max_size, archive, metrics, trace, sendmail):
         """
         Args:
             config: ConfigParser object holding configuration for the Mailing
                 Set SMTP server.
             address: The original recipient address of the message.
+            domain: The domain of the recipient address, used in the List-*
+                headers.
             subject_tag: Tag that will be prepended in square brackets to the
                 message subject to indicate the target set expression.
             recipient_set: The actual recipient addresses as a set of strings.
+            max_size: The largest message accepted in bytes, or 0 if there is
+                no limit.
+            archive: The Archive to which to write the message, or None.
+            metrics: The SetMetrics in which to record what happens.
+            trace: The Trace of the message, started when its recipient was
+                validated.
             sendmail: A function with the same signature as smtp.sendmail which
                 will be called to send outgoing messages.
         """
         self.config = config
         self.address = address
+        self.domain = domain
         self.subject_tag = subject_tag
         self.recipient_set = recipient_set
+        self.max_size = max_size
+        self.archive = archive
+        self.metrics = metrics
+        self.trace = trace
         self.sendmail = sendmail
 
         # Buffer to receive rest of message
         self.msg_parser = email.parser.FeedParser()
+        self.size = 0
+        self.data_started = self.trace.mark('data')
+        self.metrics.in_flight.inc()
+        self._released = False
 
     def lineReceived(self, line):
         """Handles another line of data.
 
         Specified by IMessage interface.
 
+        Once the message exceeds its size limit, whatever was received is
+        discarded.
+
         Args:
             line: Line of message data without terminating newline.
+
+        Raises:
+            SMTPServerError: If the message exceeds its size limit. SetESMTP
+                then tells the client and disconnects it.
         """
+        self.size += len(line) + 1
+        if self.max_size and self.size > self.max_size:
+            log.msg('Discarding %s after %d bytes' % (self.address, self.size))
+            self.metrics.too_large.inc('data')
+            self.msg_parser = None
+            raise smtp.SMTPServerError(552, 'Message size exceeds limit of '
+                    '%d bytes' % (self.max_size,))
         self.msg_parser.feed(line)
         self.msg_parser.feed('\n')
 
@@ -229,28 +1004,86 @@ class SetMessage(object):
 
         Fixes up the message headers and sends it through the outgoing server to
         the appropriate recipients, including the archival address if one is
-        present in the server config.
+        present in the server config. If an archive directory is configured,
+        the message is also written to the local archive.
 
         Specified by IMessage interface.
 
         Returns:
             A Deferred responsible for sending the message through the outgoing
-            server.
+            server and writing it to the local archive.
+        """
+        done = defer.maybeDeferred(self._deliver)
+        done.addBoth(self._release)
+        return done
+
+    def _deliver(self):
+        """Fixes up the message headers and sends the message.
+
+        Returns:
+            A Deferred responsible for sending the message through the outgoing
+            server and writing it to the local archive.
         """
         msg = self.msg_parser.close()
         self.msg_parser = None
+        self.metrics.message_bytes.observe(self.size)
+        receive_seconds = self.trace.mark('received') - self.data_started
 
         # Prepend subject tag and set mailing list headers
+        done = self.metrics.munge_seconds.time()
         self._munge_header(msg)
+        munge_seconds = done()
+        self.trace.mark('munged')
 
         # Add archival address to recipient set if there is one
         recp = self.recipient_set
         if self.config.has_option('outgoing', 'archive_addr'):
-            recp |= set([self.config.get('outgoing', 'archive_addr')])
+            recp = recp | set([self.config.get('outgoing', 'archive_addr')])
+
+        # Log the recipient count; the recipients themselves may be a huge
+        # list, so they are logged separately and only if sampled, and are
+        # sorted by the thread writing the log rather than here
+        message_id = msg['Message-ID']
+        log.msg(format='Sending %(message_id)s to %(expression)s '
+                '(%(count)d recipients)', event='send', message_id=message_id,
+                trace_id=self.trace.trace_id, expression=self.address,
+                count=len(recp), subject=str(msg['Subject']))
+        has_file = self.config.has_option('log', 'recipients_file')
+        sample = self.config.getfloat('log', 'recipients_sample',
+                fallback=1.0 if has_file else 0.0)
+        if random.random() < sample:
+            log.msg(format='Recipients of %(message_id)s', event='recipients',
+                    message_id=message_id, expression=self.address,
+                    recipients=recp)
+
+        # Serialize the message, on the worker pool if it is large, then send
+        # it
+        timings = {'receive_seconds': receive_seconds,
+                   'munge_seconds': munge_seconds}
+        threshold = self.config.getint('pool', 'serialize_threshold',
+                fallback=1000000)
+        if self.size >= threshold:
+            serialized = threads.deferToThread(msg.as_string)
+        else:
+            serialized = defer.maybeDeferred(msg.as_string)
+        serialized.addCallback(self._send, msg, recp, message_id, timings)
+        return serialized
+
+    def _send(self, body, msg, recp, message_id, timings):
+        """Sends a serialized message and writes it to the local archive.
+
+        Args:
+            body: The serialized message.
+            msg: The email.message.Message that was serialized.
+            recp: The set of recipient addresses.
+            message_id: The Message-ID header of the message.
+            timings: Dict of timings to log once the message has been sent.
 
-        # Log
-        log.msg('Subject: %s' % (str(msg['Subject']),))
-        log.msg('Sending to: %s' % (', '.join(recp),))
+        Returns:
+            A Deferred responsible for sending the message through the outgoing
+            server and writing it to the local archive.
+        """
+        self.trace.mark('serialized')
 
         # Get outgoing config
         outgoing_server = self.config.get('outgoing', 'server')
@@ -258,19 +1091,134 @@ class SetMessage(object):
         envelope_sender = self.config.get('outgoing', 'envelope_sender')
 
         # Begin sending the message!
-        send = self.sendmail(outgoing_server, envelope_sender, recp,
-                msg.as_string(), port=outgoing_port)
-        send.addCallback(log.msg, 'Success %s' % (self.address,))
+        done = self.metrics.send_seconds.time()
+        if self.config.getboolean('outgoing', 'verp', fallback=False):
+            send = self._send_verp(outgoing_server, outgoing_port,
+                    envelope_sender, recp, body)
+        else:
+            send = self.sendmail(outgoing_server, envelope_sender, recp, body,
+                    port=outgoing_port)
+            send.addErrback(self._count_failure)
+        send.addBoth(self._sent, done, message_id, len(recp), timings)
         send.addErrback(log.err, 'Failure %s' % (self.address,))
+
+        # Archive the message locally alongside sending it
+        if self.archive is not None:
+            headers = []
+            if self.config.getboolean('outgoing', 'archive_trace_header',
+                    fallback=False):
+                headers.append(('X-Mailingset-Trace', self.trace.header()))
+            archived = self.archive.write(msg['Message-ID'], self.address, body,
+                    headers)
+            archived.addCallback(lambda _: self.trace.mark('archived'))
+            archived.addErrback(log.err,
+                    'Failure archiving %s' % (self.address,))
+            send = defer.gatherResults([send, archived])
+
+        # Log the trace once everything is done
+        def emit_trace(result):
+            self.trace.emit(message_id=message_id)
+            return result
+        send.addBoth(emit_trace)
         return send
 
+    def _send_verp(self, server, port, envelope_sender, recp, body):
+        """Sends a message to each recipient with its own envelope sender.
+
+        The same serialized message body is shared by every transaction. The
+        transactions run one after another over at most verp_concurrency
+        connections, so the number of open connections to the outgoing server
+        is bounded no matter how many recipients there are.
+
+        Args:
+            server: The outgoing SMTP server.
+            port: Port of the outgoing SMTP server.
+            envelope_sender: The envelope sender from which to build the VERP
+                envelope sender of each recipient.
+            recp: The set of recipient addresses.
+            body: The serialized message.
+
+        Returns:
+            A Deferred that fires when every transaction has finished. Failures
+            for individual recipients are logged rather than failing the
+            Deferred.
+        """
+        concurrency = self.config.getint('outgoing', 'verp_concurrency',
+                fallback=20)
+
+        def failed(addr, reason):
+            """Counts and logs a recipient the message was not sent to."""
+            self._count_failure(reason)
+            log.err(reason, 'Failure %s to %s' % (self.address, addr))
+
+        return verp.send(server, port, envelope_sender, recp, body, failed,
+                connections=concurrency)
+
     def connectionLost(self):
         """Handles truncation of message by discarding anything received so far.
 
         Specified by IMessage interface.
         """
-        log.err('Connection lost %s' % (self.address,))
-        self.msg_parser = None
+        # A message over its size limit was already discarded
+        if self.msg_parser is not None:
+            log.err('Connection lost %s' % (self.address,))
+            self.msg_parser = None
+        self._release()
+
+    def _release(self, result=None):
+        """Stops counting the message as in flight.
+
+        Only the first call has any effect, since a message may end in more
+        than one way: Twisted calls connectionLost both when the message is too
+        large and when the client then disconnects.
+
+        Args:
+            result: A result, which is passed through.
+
+        Returns:
+            The result.
+        """
+        if not self._released:
+            self._released = True
+            self.metrics.in_flight.dec()
+        return result
+
+    def _count_failure(self, reason):
+        """Counts a failed transaction with the outgoing server.
+
+        Args:
+            reason: The Failure, which is passed through.
+
+        Returns:
+            The Failure.
+        """
+        self.metrics.send_failures.inc()
+        return reason
+
+    def _sent(self, result, done, message_id, count, timings):
+        """Records and logs that sending a message has finished.
+
+        Args:
+            result: The result of sending, which is passed through.
+            done: The function to call to record the time sending took.
+            message_id: The Message-ID header of the message.
+            count: The number of recipients.
+            timings: Dict of the number of seconds taken by earlier stages of
+                handling the message, to include in the log.
+
+        Returns:
+            The result.
+        """
+        send_seconds = done()
+        succeeded = not isinstance(result, failure.Failure)
+        self.trace.mark('sent' if succeeded else 'failed')
+        log.msg(format='%(outcome)s %(message_id)s to %(expression)s in '
+                '%(send_seconds).3fs', event='sent',
+                outcome='Success' if succeeded else 'Failure',
+                message_id=message_id, trace_id=self.trace.trace_id,
+                expression=self.address, count=count,
+                send_seconds=send_seconds, **timings)
+        return result
 
     def _munge_header(self, msg):
         """Prepends subject tag and sets mailing list headers.
@@ -281,7 +1229,7 @@ class SetMessage(object):
         # Prepend subject tag if not already present
         tag = '[%s] ' % (self.subject_tag,)
         try:
-            subject_prefix.SubjectPrefix().process(tag, msg)
+            _tagger.process(tag, msg)
         except (UnicodeError, ValueError):
             pass
 
@@ -290,8 +1238,7 @@ class SetMessage(object):
             msg['Precedence'] = 'list'
 
         # List-* headers
-        domain = self.config.get('incoming', 'domain')
         del msg['list-id']
-        msg['List-Id'] = '<%s.mailingset.%s>' % (self.address, domain)
+        msg['List-Id'] = '<%s.mailingset.%s>' % (self.address, self.domain)
         del msg['list-post']
-        msg['List-Post'] = '<mailto:%s@%s>' % (self.address, domain)
+        msg['List-Post'] = '<mailto:%s@%s>' % (self.address, self.domain)
@@ -15,16 +15,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import csv
+import gzip
+import io
+import itertools
+import json
+import operator
 import os
 import re
 
+from multiprocessing.pool import ThreadPool
+
 
 class MailingSetState(object):
     """An immutable cache of the membership of mailing lists on this server.
 
-    This is initialized once at server startup and is used for all messages that
-    hit the server. There is no support for reloading this cache without
-    restarting the server.
+    This is initialized at server startup and is used for all messages that hit
+    the server. It is never modified; reloading list definitions means building
+    a new instance and swapping it in place of the old one.
 
     The function call operator may be used to query the name and recipient
     addresses of a list or individual. See __call__.
@@ -33,31 +42,64 @@ class MailingSetState(object):
     # Mailing lists may not be nested more deeply than this limit
     NEST_LIMIT = 10
 
-    def __init__(self, config):
+    def __init__(self, config, section='data', domain=None, interned=None):
         """
         Args:
             config: ConfigParser object holding configuration for the
                 Mailing Set SMTP server. The entries required here are the path
-                to the directory containing list definitions, the path to the
-                file containing mailing list symbols, and the domain used by
-                mailing list addresses.
+                to the directory containing list definitions or the path to the
+                consolidated membership file (or both), the path to the file
+                containing mailing list symbols, and the domain used by mailing
+                list addresses.
+            section: The section of config holding the paths of the list
+                definitions and symbols, and optionally load_threads, which
+                defaults to the one in the data section.
+            domain: The domain used by mailing list addresses, or None to use
+                the domain in the incoming section of config.
+            interned: A dict in which to intern the addresses, names and other
+                strings held by this state, or None not to intern them. The
+                states of several domains may share one, so that a string
+                appearing in more than one of them is stored only once.
 
         Raises:
-            RuntimeError: If nesting exceeds NEST_LIMIT, or if a list is missing
-            a symbol.
+            RuntimeError: If nesting exceeds NEST_LIMIT, if a list is missing a
+            symbol, if the membership file is malformed, or if load_threads is
+            not positive.
         """
         # Store config entries first because the loader functions rely on these
-        self._lists_dir = os.path.abspath(config.get('data', 'lists_dir'))
-        self._symbols_file = os.path.abspath(config.get('data', 'symbols_file'))
-        self._server_domain = config.get('incoming', 'domain')
-
-        # Load state from the places specified in config
-        self._lists = self._load_lists()
-        self._aliases = self._load_aliases()
-        self._symbols = self._load_symbols()
+        self._lists_dir = config.get(section, 'lists_dir', fallback=None)
+        if self._lists_dir is not None:
+            self._lists_dir = os.path.abspath(self._lists_dir)
+        self._symbols_file = os.path.abspath(config.get(section,
+                'symbols_file'))
+        self._server_domain = domain or config.get('incoming', 'domain')
+        self._load_threads = config.getint(section, 'load_threads',
+                fallback=config.getint('data', 'load_threads', fallback=1))
+        if self._load_threads < 1:
+            raise RuntimeError('load_threads must be at least 1')
+
+        # Members of the lists in the consolidated membership file, which is
+        # read in a single pass before anything else
+        self._file_members = {}
+        if config.has_option(section, 'members_file'):
+            self._file_members = _read_members_file(
+                    os.path.abspath(config.get(section, 'members_file')))
+
+        # Load state from the places specified in config. Every list file is
+        # read once, up front, and everything else is built from its members
+        members = self._read_lists(interned)
+        direct = self._load_direct(members)
+        self._lists = self._load_lists(direct)
+        self._memberships = self._load_memberships(direct)
+        self._aliases = self._load_aliases(members, interned)
+        self._symbols = self._load_symbols(members, interned)
 
         self._check_symbols()
 
+        # Every string that __call__ can resolve, for cheap up-front rejection
+        # of addresses naming lists or people that do not exist
+        self._names = frozenset(self._lists) | frozenset(self._aliases)
+
     def __call__(self, val):
         """Queries the name and recipient addresses of a list or individual.
 
@@ -100,20 +142,125 @@ class MailingSetState(object):
             raise SyntaxError('No such list or person: %s' % (val,))
         return (symbol, addrs)
 
+    def prefilter(self, leaves):
+        """Checks that every leaf token names a list or individual.
+
+        This costs one set lookup per leaf, so it is a cheap way to turn away
+        addresses naming lists or people that do not exist before resolving the
+        leaves and evaluating the set expression. Passing the prefilter does not
+        mean the leaves resolve; an identifier may still be ambiguous.
+
+        Args:
+            leaves: Iterable of mailing list names and individual identifiers,
+                typically from parser.leaves.
+
+        Raises:
+            SyntaxError: If any leaf is not a mailing list name or individual
+                identifier. The error is the same one __call__ would raise for
+                that leaf.
+        """
+        for val in leaves:
+            if not self.knows(val):
+                raise SyntaxError('No such list or person: %s' % (val.lower(),))
+
+    def knows(self, val):
+        """Checks whether a string names a list or individual on this server.
+
+        Args:
+            val: A mailing list name or individual identifier, in any case.
+
+        Returns:
+            True if val is a mailing list name or individual identifier. The
+            identifier may still be ambiguous.
+        """
+        return val.lower() in self._names
+
+    def upper_bound(self, leaves):
+        """Bounds the number of recipients of an expression from above.
+
+        The bound is the number of recipients the expression would have if every
+        operator were a union, so it costs one dict lookup per leaf.
+
+        Args:
+            leaves: Iterable of mailing list names and individual identifiers,
+                typically from parser.leaves.
+
+        Returns:
+            The sum of the sizes of the lists named by the leaves, counting one
+            for each individual and none for anything unknown.
+        """
+        bound = 0
+        for val in leaves:
+            val = val.lower()
+            if val in self._lists:
+                bound += len(self._lists[val])
+            elif val in self._aliases:
+                bound += 1
+        return bound
+
+    def is_list(self, val):
+        """Checks whether a string is the name of a mailing list.
+
+        Args:
+            val: The string to check, in any case.
+
+        Returns:
+            True if val names a mailing list on this server.
+        """
+        return val.lower() in self._lists
+
+    def memberships(self, addr):
+        """Queries which mailing lists an address belongs to.
+
+        This is a dict lookup, not a scan over the lists.
+
+        Args:
+            addr: An email address, in any case.
+
+        Returns:
+            A pair (direct,flattened) of frozensets of mailing list names. The
+            first holds the lists naming the address in their list definition,
+            and the second the lists containing the address once nested lists
+            are flattened. Both are empty if the address is on no list.
+        """
+        empty = frozenset()
+        return self._memberships.get(addr.lower(), (empty, empty))
+
+    def components(self):
+        """Gets the tables making up this cache, for measuring their size.
+
+        Returns:
+            A dict of component name to the object holding it: 'lists', the
+            dict of list name to set of recipient addresses; 'memberships', the
+            reverse index used by memberships; 'aliases', the dict of
+            individual identifier to address; 'symbols', the dict of list name
+            or address to symbol; and 'names', the set used by prefilter.
+        """
+        return {
+            'lists': self._lists,
+            'memberships': self._memberships,
+            'aliases': self._aliases,
+            'symbols': self._symbols,
+            'names': self._names}
+
     def _list_lists(self):
         """List of mailing list names on this server.
 
         A mailing list is a file in the directory lists_dir specified in the
-        config used to construct this class. The name of the mailing list is the
-        name of the file.
+        config used to construct this class, or a list named in the
+        consolidated membership file members_file. The name of the mailing list
+        is the name of the file.
 
         Returns:
             A set of mailing list names.
         """
-        names = os.listdir(self._lists_dir)
-        def is_list(name):
-            return os.path.isfile(os.path.join(self._lists_dir, name))
-        return set([name for name in names if is_list(name)])
+        lists = set(self._file_members)
+        if self._lists_dir is not None:
+            names = os.listdir(self._lists_dir)
+            def is_list(name):
+                return os.path.isfile(os.path.join(self._lists_dir, name))
+            lists.update(name for name in names if is_list(name))
+        return lists
 
     def _read_members(self, listname):
         """Lists the members of a mailing list.
@@ -122,6 +269,8 @@ class MailingSetState(object):
         the mailing list, in the directory lists_dir specified in the config
         used to construct this class. Each line of the file is one member. Refer
         to the documentation of _split_line for the permitted formats of a line.
+        Members may also be given in the consolidated membership file, as
+        described in _read_members_file.
 
         Args:
             listname: Name of the mailing list.
@@ -130,9 +279,53 @@ class MailingSetState(object):
             A set of (name,addr) pairs. The name is None if no name is given for
             the member.
         """
+        if self._lists_dir is None:
+            return self._file_members[listname]
         path = os.path.join(self._lists_dir, listname)
+        if listname in self._file_members and not os.path.isfile(path):
+            return self._file_members[listname]
+        members = set(self._file_members.get(listname, ()))
         with open(path) as list_file:
-            return set(_split_line(line) for line in list_file if line.strip())
+            members.update(_split_line(line) for line in list_file
+                           if line.strip())
+        return members
+
+    def _read_lists(self, interned=None):
+        """Reads the members of every mailing list.
+
+        The list files are read by a pool of load_threads threads, so that on a
+        slow filesystem the latency of opening and reading one file overlaps
+        with that of the others. With a single thread they are read one after
+        another. Either way the result is the same.
+
+        Args:
+            interned: A dict in which to intern the names and addresses read,
+                or None not to intern them.
+
+        Returns:
+            A dict of list name to set of (name,addr) pairs, as returned by
+            _read_members.
+        """
+        names = list(self._list_lists())
+        threads = min(self._load_threads, len(names))
+        if threads <= 1:
+            members = [self._read_members(name) for name in names]
+        else:
+            pool = ThreadPool(threads)
+            try:
+                members = pool.map(self._read_members, names)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        # Interning happens here rather than in the threads, so that the dict
+        # is only ever touched by one thread
+        if interned is not None:
+            intern = interned.setdefault
+            members = [set((name and intern(name, name), intern(addr, addr))
+                           for (name, addr) in listed)
+                       for listed in members]
+        return dict(zip(names, members))
 
     def _compute(self, listname, members, depth=0):
         """Recursively flattens a mailing list containing other mailing lists.
@@ -166,8 +359,28 @@ class MailingSetState(object):
                 result.add(addr)
         return result
 
-    def _load_lists(self):
-        """Loads a dict of list name to set of members by looking in lists_dir.
+    def _load_direct(self, members):
+        """Loads a dict of list name to set of member addresses.
+
+        Args:
+            members: A dict of list name to set of (name,addr) pairs, as
+                returned by _read_lists.
+
+        Returns:
+            A dict of list name to set of addresses, exactly as given in the
+            list definitions. Addresses may be other mailing lists.
+        """
+        addrs = {}
+        for (lname, listed) in members.items():
+            addrs[lname] = set(line[1] for line in listed)
+        return addrs
+
+    def _load_lists(self, direct):
+        """Flattens nested mailing lists.
+
+        Args:
+            direct: A dict of list name to set of addresses, where the addresses
+                may be other mailing lists, as returned by _load_direct.
 
         Returns:
             A dict of list name to set of recipient addresses. Nested mailing
@@ -176,56 +389,84 @@ class MailingSetState(object):
         Raises:
             RuntimeError: If nesting exceeds NEST_LIMIT.
         """
-        listnames = self._list_lists()
+        return dict((lname, self._compute(lname, direct)) for lname in direct)
 
-        # Read members without flattening.
-        addrs = {}
-        for lname in listnames:
-            addrs[lname] = set(line[1] for line in self._read_members(lname))
+    def _load_memberships(self, direct):
+        """Builds the reverse index from address to the lists containing it.
+
+        Must be called after self._lists has been loaded.
+
+        Args:
+            direct: A dict of list name to set of addresses as given in the list
+                definitions, as returned by _load_direct.
+
+        Returns:
+            A dict of address to pair (direct,flattened) of frozensets of list
+            names. See memberships.
+        """
+        direct_index = collections.defaultdict(set)
+        for (lname, addrs) in direct.items():
+            for addr in addrs:
+                direct_index[addr].add(lname)
 
-        # Flatten nested lists
-        return dict((lname, self._compute(lname, addrs)) for lname in listnames)
+        flat_index = collections.defaultdict(set)
+        for (lname, addrs) in self._lists.items():
+            for addr in addrs:
+                flat_index[addr].add(lname)
 
-    def _read_all_members(self):
+        return dict((addr, (frozenset(direct_index[addr]),
+                            frozenset(flat_index[addr])))
+                    for addr in set(direct_index) | set(flat_index))
+
+    def _read_all_members(self, members):
         """Lists the members across all mailing lists.
 
-        Mailing list membership is defined in the directory lists_dir specified
-        in the config used to construct this class.
+        Args:
+            members: A dict of list name to set of (name,addr) pairs, as
+                returned by _read_lists.
 
         Returns:
             A set of (name,addr) pairs containing every member on the server.
             The name is None if no name is given for the member.
         """
-        members = set()
-        for listname in self._list_lists():
-            members |= self._read_members(listname)
-        return members
+        everyone = set()
+        for listed in members.values():
+            everyone |= listed
+        return everyone
 
-    def _load_aliases(self):
+    def _load_aliases(self, members, interned=None):
         """Loads a dict mapping individual identifiers to email address.
 
         An individual identifier is the first name, middle name, last name,
         username, or period-concatenated (first.last) full name of an
         individual, as long as it uniquely identifies one individual.
 
+        Args:
+            members: A dict of list name to set of (name,addr) pairs, as
+                returned by _read_lists.
+            interned: A dict in which to intern the identifiers, or None not to
+                intern them.
+
         Returns:
             A dict of individual identifier to email address. If any identifier
             applies to more than one individual, such as a common first name, it
             is present as a key in the dict but the value is None.
         """
-        members = self._read_all_members()
+        everyone = self._read_all_members(members)
         aliases = {}
 
         invalid = re.compile('[^a-z0-9.]')
         def set_if_absent(key, value, clean):
             if clean:
                 key = invalid.sub('', key)
+            if interned is not None:
+                key = interned.setdefault(key, key)
             if key in aliases and aliases[key] != value:
                 aliases[key] = None
             else:
                 aliases[key] = value
 
-        for (name, addr) in members:
+        for (name, addr) in everyone:
             if name:
                 # Username
                 local = addr.split('@', 1)[0]
@@ -242,7 +483,7 @@ class MailingSetState(object):
 
         return aliases
 
-    def _load_symbols(self):
+    def _load_symbols(self, members, interned=None):
         """Loads a dict containing symbols suitable for using in a subject tag.
 
         Symbols for mailing lists are defined in the file symbols_file specified
@@ -252,6 +493,12 @@ class MailingSetState(object):
 
         Symbols for individuals are their initials in lowercase.
 
+        Args:
+            members: A dict of list name to set of (name,addr) pairs, as
+                returned by _read_lists.
+            interned: A dict in which to intern the symbols of individuals, or
+                None not to intern them.
+
         Returns:
             A dict in which the keys are list names and individual email
             addresses, and the values are the corresponding symbols.
@@ -263,11 +510,14 @@ class MailingSetState(object):
                 (listname, symbol) = line.strip().split(':')
                 symbols[listname.lower()] = symbol
 
-        for listname in self._list_lists():
-            for (name, addr) in self._read_members(listname):
+        for listed in members.values():
+            for (name, addr) in listed:
                 if name:
                     abbrev = ''.join(word[:1] for word in name.split()).lower()
-                    symbols[addr.lower()] = abbrev
+                    if interned is not None:
+                        abbrev = interned.setdefault(abbrev, abbrev)
+                    # Addresses are already lowercase, as read by _split_line
+                    symbols[addr] = abbrev
 
         return symbols
 
@@ -310,3 +560,186 @@ def _split_line(line):
     else:
         addr = line.strip().lower()
         return (None, addr)
+
+
+def _read_members_file(path):
+    """Reads the consolidated membership file in a single pass.
+
+    Each row of the file is a triple of list name, member name and member
+    address, in one of two formats chosen by the extension of the file:
+        .csv        list,name,address
+        .jsonl      {"list": ..., "name": ..., "address": ...}
+    The name may be empty, and the address may itself be a line in one of the
+    formats accepted by _split_line. A row with an empty address defines a
+    list without adding a member to it. The file may be compressed with gzip,
+    in which case its name ends in .gz, like members.csv.gz. A CSV file may
+    start with a header row naming the columns.
+
+    Args:
+        path: Path of the file.
+
+    Returns:
+        A dict of list name to set of (name,addr) pairs, as returned by
+        _split_line.
+
+    Raises:
+        RuntimeError: If the extension of the file is not recognized, or if a
+            line is malformed.
+    """
+    base = path[:-len('.gz')] if path.endswith('.gz') else path
+    extension = os.path.splitext(base)[1].lower()
+    if extension == '.csv':
+        read_rows = _csv_rows
+    elif extension in ('.jsonl', '.json'):
+        read_rows = _jsonl_rows
+    else:
+        raise RuntimeError('Unknown format of members file: %s' % (path,))
+
+    if path.endswith('.gz'):
+        members_file = io.BufferedReader(gzip.open(path, 'rb'))
+    else:
+        members_file = open(path, 'rb')
+
+    # The same people belong to many lists, so each distinct row is split
+    # once and its pair shared between the lists
+    members = collections.defaultdict(set)
+    pairs = {}
+    with members_file:
+        for (listname, name, addr) in read_rows(members_file, path):
+            listname = listname.strip()
+            if not listname:
+                continue
+            listed = members[listname]
+            if not addr or addr.isspace():
+                continue
+            key = (name, addr)
+            pair = pairs.get(key)
+            if pair is None:
+                pair = pairs[key] = _split_row(name, addr)
+            listed.add(pair)
+    return dict(members)
+
+
+def _csv_rows(members_file, path):
+    """Yields the rows of a CSV membership file, skipping any header row.
+
+    Raises:
+        RuntimeError: If a row does not have three columns.
+    """
+    rows = csv.reader(members_file)
+    for row in rows:
+        if len(row) != 3:
+            if not any(column.strip() for column in row):
+                continue
+            msg = 'Malformed line %d in members file: %s' % (rows.line_num,
+                    path)
+            raise RuntimeError(msg)
+        if rows.line_num == 1 and [column.strip().lower()
+                for column in row] == ['list', 'name', 'address']:
+            continue
+        yield row
+
+
+def _jsonl_rows(members_file, path):
+    """Returns the rows of a JSON Lines membership file as triples.
+
+    The whole file is decoded in one call, as a JSON array of its lines, which
+    takes a fraction of the time of decoding each line on its own. Only if that
+    fails is it decoded again line by line, to skip blank lines and to find the
+    line that is malformed.
+
+    Raises:
+        RuntimeError: If a line is not an object with list and address keys,
+            or if a value is not a string. The name and address may be null.
+    """
+    text = members_file.read()
+    rows = _parse_jsonl(text)
+    if rows is None:
+        rows = _scan_jsonl(io.BytesIO(text), path)
+    return rows
+
+
+# Types of the values in a JSON Lines membership file, which the json module
+# decodes as unicode
+_JSON_STRINGS = frozenset([str, unicode])
+_JSON_OPTIONAL = _JSON_STRINGS | frozenset([type(None)])
+
+
+def _parse_jsonl(text):
+    """Decodes a JSON Lines membership file at once.
+
+    Args:
+        text: The contents of the file.
+
+    Returns:
+        A list of (list,name,address) triples of byte strings, with a missing
+        or null name or address given as an empty string, or None if a line is
+        blank or is not an object with string values for list and address.
+    """
+    try:
+        objects = json.loads('[%s]' % (','.join(text.splitlines()),))
+        lists = map(operator.itemgetter('list'), objects)
+        names = map(dict.get, objects,
+                    itertools.repeat('name', len(objects)))
+        addrs = map(operator.itemgetter('address'), objects)
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not (set(itertools.imap(type, lists)) <= _JSON_STRINGS
+            and set(itertools.imap(type, names)) <= _JSON_OPTIONAL
+            and set(itertools.imap(type, addrs)) <= _JSON_OPTIONAL):
+        return None
+
+    # The same lists and people appear on many rows, so each distinct value is
+    # encoded once
+    encoded = {None: ''}
+    for value in set(lists) | set(names) | set(addrs):
+        if value is not None:
+            encoded[value] = (value.encode('utf-8')
+                              if isinstance(value, unicode) else value)
+    encode = encoded.__getitem__
+    return zip(map(encode, lists), map(encode, names), map(encode, addrs))
+
+
+def _scan_jsonl(members_file, path):
+    """Yields the rows of a JSON Lines membership file line by line as
+    triples, skipping blank lines.
+
+    Raises:
+        RuntimeError: If a line is not an object with list and address keys,
+            or if a value is not a string. The name and address may be null.
+    """
+    for (number, line) in enumerate(members_file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            (name, addr) = (row.get('name'), row['address'])
+            row = (row['list'], '' if name is None else name,
+                   '' if addr is None else addr)
+            if not all(isinstance(column, basestring) for column in row):
+                raise TypeError('Columns must be strings')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            msg = 'Malformed line %d in members file: %s' % (number, path)
+            raise RuntimeError(msg)
+        yield tuple(column.encode('utf-8') if isinstance(column, unicode)
+                    else column for column in row)
+
+
+def _split_row(name, addr):
+    """Separates the name and address of a row of the membership file.
+
+    The result is the same as that of _split_line on the equivalent line of a
+    list file.
+
+    Args:
+        name: The name of the member, or an empty string.
+        addr: The address of the member.
+
+    Returns:
+        A pair (name,addr) as returned by _split_line. The name column, if not
+        empty, replaces any name given in the address column.
+    """
+    split = _split_line(addr)
+    if name.strip():
+        return _split_line('%s <%s>' % (name, split[1]))
+    return split
@@ -0,0 +1,336 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A set of addresses that must not receive mail, such as hard bounces.
+
+Suppressed addresses are subtracted from the recipients of every message after
+the set expression is evaluated, so an address can be taken off all lists at
+once without editing any list definitions or reloading.
+
+The set may be backed by a journal file, which is append-only. Each line is an
+address prefixed by + to suppress it or by - to stop suppressing it. A line with
+neither prefix suppresses the address, so a plain list of addresses is also a
+valid journal. A line prefixed by ! records a hard bounce of the address, so
+that every process using the journal counts the bounces received by all of
+them; suppressing an address or no longer suppressing it resets its count.
+Lines appended by other programs are picked up when the set is next used, at
+most once per refresh interval, so for example:
+
+    echo +someone@example.com >> suppressed
+
+suppresses someone@example.com for every message from then on.
+
+Once the journal holds many more lines than there are suppressed addresses and
+counted bounces, it is compacted: rewritten with one line per suppressed address
+and per bounce still counted, and renamed over the old journal. A journal
+replaced by another file, by compaction in another process or otherwise, is
+read again from the beginning. Every process using the
+journal takes a lock on the file named after it with .lock added while
+appending or compacting. Lines appended by other programs while a compaction
+runs are copied to the new journal, as long as each is appended with a single
+write, as echo does.
+"""
+import collections
+import fcntl
+import os
+import stat
+import tempfile
+
+
+class SuppressionList(object):
+    """A set of suppressed addresses, optionally backed by a journal file."""
+
+    # The journal is compacted once it has this many times more lines than
+    # there are suppressed addresses, and at least COMPACT_MIN lines
+    COMPACT_FACTOR = 4
+    COMPACT_MIN = 1000
+
+    def __init__(self, path=None, interval=1.0, reactor=None):
+        """
+        Args:
+            path: Path to the journal file. It need not exist yet, and is
+                created by the first change. If None, the set is kept only in
+                memory.
+            interval: Seconds for which the set is used without checking the
+                journal file for changes made by other programs.
+            reactor: The reactor whose clock times the refresh interval.
+                Defaults to the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._path = path
+        self.interval = interval
+        self._addrs = set()
+
+        # Number of hard bounces recorded for each address that is not
+        # suppressed
+        self._bounces = collections.Counter()
+
+        # Identity of the journal file, number of its bytes applied to
+        # self._addrs so far, and number of its lines
+        self._file_id = None
+        self._offset = 0
+        self._lines = 0
+
+        # Time at which the journal file was last checked for changes
+        self._checked = None
+
+        self.refresh()
+
+    def __contains__(self, addr):
+        self._refresh_due()
+        return addr.lower() in self._addrs
+
+    def __len__(self):
+        self._refresh_due()
+        return len(self._addrs)
+
+    def components(self):
+        """Gets the parts of the suppression list held in memory, for
+        measuring their size.
+
+        Returns:
+            A dict of component name to the object holding it: 'addresses',
+            the set of suppressed addresses; and 'bounces', the hard bounce
+            counts.
+        """
+        return {'addresses': self._addrs, 'bounces': self._bounces}
+
+    def add(self, addr):
+        """Suppresses an address.
+
+        Args:
+            addr: The email address to suppress, in any case.
+        """
+        addr = addr.lower()
+        self.refresh()
+        if addr not in self._addrs:
+            self._record('+', addr)
+
+    def discard(self, addr):
+        """Stops suppressing an address, if it is suppressed.
+
+        Args:
+            addr: The email address to stop suppressing, in any case.
+        """
+        addr = addr.lower()
+        self.refresh()
+        if addr in self._addrs:
+            self._record('-', addr)
+
+    def bounce(self, addr):
+        """Records a hard bounce of an address.
+
+        Args:
+            addr: The email address that bounced, in any case.
+
+        Returns:
+            The number of hard bounces of the address recorded since it was
+            last suppressed or stopped being suppressed, by this or any other
+            process using the journal.
+        """
+        addr = addr.lower()
+        self._record('!', addr)
+        return self._bounces[addr]
+
+    def bounces(self):
+        """Gets the hard bounce counts of addresses.
+
+        Returns:
+            A dict of lowercase address to the number of hard bounces recorded
+            for it, as returned by bounce.
+        """
+        self._refresh_due()
+        return dict(self._bounces)
+
+    def subtract(self, addrs):
+        """Removes suppressed addresses from a set of recipients.
+
+        The set difference iterates over addrs, so this takes time
+        proportional to the number of recipients, however many addresses are
+        suppressed.
+
+        Args:
+            addrs: A set of lowercase recipient addresses.
+
+        Returns:
+            A new set holding the recipient addresses that are not suppressed.
+        """
+        self._refresh_due()
+        return addrs - self._addrs
+
+    def refresh(self):
+        """Applies lines appended to the journal file since the last refresh.
+
+        Every other method refreshes once the refresh interval has passed, so
+        it is only necessary to call this directly in order to pick up changes
+        eagerly. If the journal file has been replaced or has shrunk, it is
+        assumed to have been rewritten and is read again from the beginning.
+        """
+        if self._path is None:
+            return
+        self._checked = self._reactor.seconds()
+        try:
+            info = os.stat(self._path)
+        except OSError:
+            (file_id, size) = (None, 0)
+        else:
+            (file_id, size) = ((info.st_dev, info.st_ino), info.st_size)
+        if file_id == self._file_id and size == self._offset:
+            return
+        if file_id != self._file_id or size < self._offset:
+            self._addrs = set()
+            self._bounces = collections.Counter()
+            self._offset = 0
+            self._lines = 0
+            self._file_id = file_id
+        if file_id is None:
+            return
+
+        with open(self._path) as journal:
+            journal.seek(self._offset)
+            self._read(journal)
+
+    def compact(self):
+        """Rewrites the journal file with one line per suppressed address and
+        per bounce counted.
+
+        The new journal is written to a temporary file and renamed over the old
+        one, so readers see one or the other. Does nothing if there is no
+        journal file.
+        """
+        if self._path is None:
+            return
+        with self._locked():
+            self.refresh()
+            if self._file_id is None:
+                return
+            (fd, temp_path) = tempfile.mkstemp(prefix='.suppressed-',
+                    dir=os.path.dirname(os.path.abspath(self._path)))
+            try:
+                with os.fdopen(fd, 'w') as compacted:
+                    for addr in sorted(self._addrs):
+                        compacted.write('+%s\n' % (addr,))
+                    for (addr, count) in sorted(self._bounces.items()):
+                        compacted.write('!%s\n' % (addr,) * count)
+                os.chmod(temp_path, stat.S_IMODE(os.stat(self._path).st_mode))
+                with open(self._path) as old:
+                    os.rename(temp_path, self._path)
+
+                    # Copy lines that other programs appended to the old
+                    # journal before it was replaced
+                    old.seek(self._offset)
+                    appended = old.read()
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            if appended:
+                with open(self._path, 'a') as journal:
+                    journal.write(appended)
+        self.refresh()
+
+    def _refresh_due(self):
+        """Refreshes if the refresh interval has passed since the last one."""
+        if (self._path is not None and
+                self._reactor.seconds() - self._checked >= self.interval):
+            self.refresh()
+
+    def _read(self, journal):
+        """Applies the complete lines of the journal from its position.
+
+        Args:
+            journal: The journal file, open for reading.
+        """
+        for line in journal:
+            if not line.endswith('\n'):
+                # Partially written line; apply it once it is complete
+                break
+            self._offset += len(line)
+            self._lines += 1
+            self._apply(line.strip())
+
+    def _apply(self, line):
+        """Applies one line of the journal to the set of suppressed addresses
+        and the bounce counts.
+
+        Args:
+            line: The journal line without surrounding whitespace.
+        """
+        if line.startswith('!'):
+            self._bounces[line[1:].strip().lower()] += 1
+            return
+        if line.startswith(('-', '+')):
+            (op, addr) = (line[0], line[1:].strip().lower())
+        elif line:
+            (op, addr) = ('+', line.lower())
+        else:
+            return
+        if op == '+':
+            self._addrs.add(addr)
+        else:
+            self._addrs.discard(addr)
+        self._bounces.pop(addr, None)
+
+    def _record(self, op, addr):
+        """Records a change in the journal file and the in-memory set.
+
+        Args:
+            op: '+' to suppress the address, '-' to stop suppressing it, or '!'
+                to count a hard bounce of it.
+            addr: The lowercase email address.
+        """
+        line = '%s%s\n' % (op, addr)
+        if self._path is None:
+            self._apply(line.strip())
+            return
+        with self._locked():
+            with open(self._path, 'a') as journal:
+                journal.write(line)
+        self.refresh()
+        kept = len(self._addrs) + sum(self._bounces.itervalues())
+        if self._lines >= max(self.COMPACT_MIN, self.COMPACT_FACTOR * kept):
+            self.compact()
+
+    def _locked(self):
+        """Takes the lock shared by every process using the journal file.
+
+        Returns:
+            A context manager holding the lock until it exits.
+        """
+        return FileLock(self._path + '.lock')
+
+
+class FileLock(object):
+    """An exclusive lock on a file, held as a context manager.
+
+    The lock is taken with flock, so it excludes other processes as well as
+    other open files in the same process.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def __exit__(self, type, value, traceback):
+        self._file.close()
+        self._file = None
@@ -0,0 +1,105 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tracing of the stages of handling a message.
+
+Each SMTP transaction gets a trace id when the sender is validated. Each message
+in the transaction gets a Trace under that id, which is carried from validating
+the recipient through to sending, and records when each stage was reached. Once
+the message is sent, the trace is logged as one structured 'trace' event like:
+
+    Trace 3f9c2a1b7d4e5f60 named: rcpt=0.000 parsed=0.001 data=0.002 ...
+
+where each number is the time in seconds since the recipient was validated.
+"""
+import time
+import timeit
+import uuid
+
+from twisted.python import log
+
+
+def new_id():
+    """Generates a new trace id.
+
+    Returns:
+        A random string of 16 hex digits.
+    """
+    return uuid.uuid4().hex[:16]
+
+
+class Trace(object):
+    """Timestamps of the stages of handling one message."""
+
+    def __init__(self, trace_id, expression, clock=timeit.default_timer):
+        """Starts the trace.
+
+        Args:
+            trace_id: The trace id of the SMTP transaction.
+            expression: The set expression the message is sent to.
+            clock: Function returning the current time in seconds, for testing.
+        """
+        self.trace_id = trace_id
+        self.expression = expression
+        self.started = time.time()
+        self._clock = clock
+        self._start = clock()
+
+        # List of (stage,seconds) pairs in the order the stages were reached
+        self.stages = []
+
+    def mark(self, stage):
+        """Records that a stage has been reached.
+
+        Args:
+            stage: Name of the stage, like 'parsed'.
+
+        Returns:
+            The number of seconds since the trace started.
+        """
+        elapsed = self._clock() - self._start
+        self.stages.append((stage, elapsed))
+        return elapsed
+
+    def summary(self):
+        """Formats the stages reached so far.
+
+        Returns:
+            A string like 'rcpt=0.000 parsed=0.001' giving the seconds since the
+            trace started at which each stage was reached.
+        """
+        return ' '.join('%s=%.3f' % (stage, elapsed)
+                        for (stage, elapsed) in self.stages)
+
+    def header(self):
+        """Formats the trace as the value of an X-Mailingset-Trace header.
+
+        Returns:
+            A string like '3f9c2a1b7d4e5f60 rcpt=0.000 parsed=0.001'.
+        """
+        return '%s %s' % (self.trace_id, self.summary())
+
+    def emit(self, **fields):
+        """Logs the trace as one structured 'trace' event.
+
+        Args:
+            **fields: Extra fields to include in the event.
+        """
+        log.msg(format='Trace %(trace_id)s %(expression)s: %(summary)s',
+                event='trace', trace_id=self.trace_id,
+                expression=self.expression, started=self.started,
+                summary=self.summary(), stages=dict(self.stages), **fields)
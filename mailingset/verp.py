@@ -0,0 +1,249 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Variable envelope return paths (VERP) for tying bounces to recipients.
+
+With VERP, each recipient of a message gets its own envelope sender that encodes
+the recipient address, so a bounce identifies the address that bounced without
+having to parse the bounce message. For envelope sender mailingset@server.local
+and recipient user@domain.com, the VERP envelope sender is:
+
+    mailingset+user=domain.com@server.local
+
+Since each recipient needs a transaction of its own, send delivers a message
+over a small pool of connections to the outgoing server, each of which runs one
+transaction after another.
+"""
+import StringIO
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.mail import smtp
+from twisted.python import failure
+
+
+def encode(sender, recipient):
+    """Builds the VERP envelope sender for one recipient.
+
+    Args:
+        sender: The envelope sender shared by all recipients, like
+            mailingset@server.local.
+        recipient: The recipient address, like user@domain.com.
+
+    Returns:
+        The envelope sender for this recipient, like
+        mailingset+user=domain.com@server.local.
+    """
+    (local, domain) = sender.split('@', 1)
+    return '%s+%s@%s' % (local, recipient.replace('@', '='), domain)
+
+
+def decode(sender, address):
+    """Recovers the recipient address from a VERP envelope sender.
+
+    Args:
+        sender: The envelope sender shared by all recipients, like
+            mailingset@server.local.
+        address: An address that may have been built by encode with the same
+            sender, like mailingset+user=domain.com@server.local.
+
+    Returns:
+        The recipient address in lowercase, like user@domain.com, or None if the
+        address is not a VERP envelope sender built from this sender.
+    """
+    (local, domain) = sender.lower().split('@', 1)
+    if '@' not in address:
+        return None
+    (addr_local, addr_domain) = address.lower().rsplit('@', 1)
+    prefix = local + '+'
+    if addr_domain != domain or not addr_local.startswith(prefix):
+        return None
+
+    # Domains never contain '=' but the user part of the recipient might
+    (user, sep, recipient_domain) = addr_local[len(prefix):].rpartition('=')
+    if not sep or not user or not recipient_domain:
+        return None
+    return '%s@%s' % (user, recipient_domain)
+
+
+def send(server, port, sender, recipients, body, failed, connections=20,
+         timeout=30, reactor=None):
+    """Sends a message to each recipient with its own VERP envelope sender.
+
+    Every recipient gets a transaction of its own, but the transactions are
+    spread over at most the given number of connections. Each connection takes
+    the next recipient once its previous transaction finishes, so the number
+    of connections and of pending Deferreds does not grow with the number of
+    recipients.
+
+    Args:
+        server: The outgoing SMTP server.
+        port: Port of the outgoing SMTP server.
+        sender: The envelope sender from which to build the VERP envelope sender
+            of each recipient.
+        recipients: The collection of recipient addresses.
+        body: The serialized message.
+        failed: A function called with a recipient address and a Failure for
+            each recipient the message could not be sent to.
+        connections: The largest number of connections to open at once.
+        timeout: Seconds to wait for a response from the server.
+        reactor: The reactor with which to connect. Defaults to the global
+            reactor.
+
+    Returns:
+        A Deferred firing with the number of recipients the message was sent
+        to, once every connection has closed.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    pool = _Pool(server, port, sender, recipients, body, failed, timeout,
+            reactor)
+    for _ in range(min(connections, len(recipients))):
+        pool.connect()
+    if not pool.open:
+        pool.done.callback(0)
+    return pool.done
+
+
+class _Pool(protocol.ClientFactory):
+    """Hands out the recipients of a message to connections as they free up."""
+
+    def __init__(self, server, port, sender, recipients, body, failed, timeout,
+                 reactor):
+        self.server = server
+        self.port = port
+        self.sender = sender
+        self.body = body
+        self.failed = failed
+        self.timeout = timeout
+        self._reactor = reactor
+        self._recipients = iter(recipients)
+        self._exhausted = False
+
+        # Number of connections not yet closed, and of recipients sent to
+        self.open = 0
+        self.sent = 0
+        self.done = defer.Deferred()
+
+    def connect(self):
+        """Opens another connection to the outgoing server."""
+        self.open += 1
+        self._reactor.connectTCP(self.server, self.port, self)
+
+    def next_recipient(self):
+        """Takes the next recipient to send to.
+
+        Returns:
+            The address, or None once every recipient has been taken.
+        """
+        if not self._exhausted:
+            try:
+                return next(self._recipients)
+            except StopIteration:
+                self._exhausted = True
+        return None
+
+    def buildProtocol(self, addr):
+        return _VERPClient(self, smtp.DNSNAME)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.closed(False, reason)
+
+    def closed(self, delivered, reason):
+        """Handles a connection closing.
+
+        A connection that delivered anything and closed while recipients remain
+        is replaced. A connection that failed without delivering anything is
+        not, so that an unreachable server is not retried forever. Once the
+        last connection closes, any recipients left over fail.
+
+        Args:
+            delivered: Whether any transaction on the connection succeeded.
+            reason: The Failure with which the connection closed.
+        """
+        self.open -= 1
+        if delivered and not self._exhausted:
+            self.connect()
+        elif not self.open:
+            recipient = self.next_recipient()
+            while recipient is not None:
+                self.failed(recipient, reason)
+                recipient = self.next_recipient()
+            self.done.callback(self.sent)
+
+
+class _VERPClient(smtp.ESMTPSender):
+    """Sends the message of a _Pool to one recipient after another.
+
+    This is ESMTPSender, as used by smtp.sendmail, taking its recipients from
+    the pool instead of sending one message.
+    """
+
+    requireAuthentication = False
+    requireTransportSecurity = False
+
+    def __init__(self, pool, identity):
+        smtp.ESMTPSender.__init__(self, None, None, None, identity)
+        self.heloFallback = True
+        self.timeout = pool.timeout
+        self.pool = pool
+
+        # Recipient of the transaction in progress, or None
+        self.recipient = None
+        self.delivered = False
+
+    def getMailFrom(self):
+        self.recipient = self.pool.next_recipient()
+        if self.recipient is None:
+            return None
+        return encode(self.pool.sender, self.recipient)
+
+    def getMailTo(self):
+        return [self.recipient]
+
+    def getMailData(self):
+        return StringIO.StringIO(self.pool.body)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        if numOk and code in smtp.SUCCESS:
+            self.pool.sent += 1
+            self.delivered = True
+            self.recipient = None
+        else:
+            self._fail(smtp.SMTPDeliveryError(code, resp, log.str(),
+                    addresses))
+
+    def sendError(self, exc):
+        self._fail(exc)
+        smtp.ESMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._fail(reason)
+        smtp.ESMTPClient.connectionLost(self, reason)
+        self.pool.closed(self.delivered, reason)
+
+    def _fail(self, reason):
+        """Reports that the transaction in progress, if any, failed.
+
+        Args:
+            reason: The exception or Failure it failed with.
+        """
+        if self.recipient is not None:
+            if not isinstance(reason, failure.Failure):
+                reason = failure.Failure(reason)
+            self.pool.failed(self.recipient, reason)
+            self.recipient = None
@@ -0,0 +1,272 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Running the server as several worker processes sharing one listening port.
+
+One process handles SMTP on only one core. In supervisor mode, the process
+started by twistd opens the listening socket and spawns worker processes, each
+running the full server on the inherited socket, so the kernel spreads incoming
+connections across them. The supervisor restarts workers that die, and forwards
+SIGHUP and SIGUSR1 to every worker so that they all reload their list
+definitions or take a profile. Workers exit when the supervisor goes away.
+
+The membership data is not shared between workers: each one loads its own copy
+of the list definitions, so memory use grows with the number of workers. The
+state is made of Python sets and dicts, which cannot be placed in shared memory,
+and forking after loading would not keep the pages shared for long because
+reference counting writes to every object. Data that must be seen by every
+worker is shared through files instead: the archive and the suppression file,
+in which hard bounces are counted, are written holding a lock and read back by
+the other workers. Files that are only ever read by the worker that wrote them,
+like logs and profiles, are kept apart for each worker with worker_path.
+"""
+import os
+import signal
+import socket
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import stdio
+from twisted.python import log
+
+
+# Environment variables telling a worker its index and the descriptor of the
+# listening socket
+WORKER_ENV = 'MAILINGSET_WORKER'
+WORKER_FD_ENV = 'MAILINGSET_WORKER_FD'
+
+# Descriptor at which workers inherit the listening socket
+_WORKER_FD = 3
+
+
+def worker_index():
+    """Gets the index of this worker process.
+
+    Returns:
+        The index, from 0, if this process was spawned by a Supervisor, or None
+        otherwise.
+    """
+    index = os.environ.get(WORKER_ENV)
+    return None if index is None else int(index)
+
+
+def worker_path(path, index):
+    """Gets the path of a file of which each worker keeps its own.
+
+    Args:
+        path: The path of the file or directory, like 'mailingset.log'.
+        index: The index of the worker, or None if not running as a worker.
+
+    Returns:
+        The path with the index of the worker inserted before the extension,
+        like 'mailingset-0.log', or just the path if index is None. The index
+        of a directory is added to its name, so 'archive/' becomes 'archive-0'.
+    """
+    if index is None:
+        return path
+    (root, ext) = os.path.splitext(os.path.normpath(path))
+    return '%s-%d%s' % (root, index, ext)
+
+
+class Supervisor(service.Service):
+    """A service spawning and supervising worker processes."""
+
+    def __init__(self, port, count, argv, interface='', backlog=50,
+                 restart_delay=1.0, reactor=None):
+        """
+        Args:
+            port: Port on which to listen.
+            count: Number of worker processes.
+            argv: Function taking the index of a worker and returning the
+                command line with which to start it. The first element is the
+                path of the executable.
+            interface: Address on which to listen. Defaults to all addresses.
+            backlog: Size of the listen queue.
+            restart_delay: Seconds to wait before restarting a dead worker.
+            reactor: The reactor with which to spawn processes. Defaults to the
+                global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._port = port
+        self._interface = interface
+        self._backlog = backlog
+        self.count = count
+        self.argv = argv
+        self.restart_delay = restart_delay
+
+        self._socket = None
+        self._workers = {}
+        self._ended = {}
+        self._restarting = {}
+        self.restarts = 0
+
+    @property
+    def address(self):
+        """The (host,port) pair on which the workers listen."""
+        return self._socket.getsockname()
+
+    def startService(self):
+        """Opens the listening socket and spawns the workers."""
+        service.Service.startService(self)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self._interface, self._port))
+        self._socket.listen(self._backlog)
+        self._socket.setblocking(False)
+        for index in range(self.count):
+            self._spawn(index)
+
+    def stopService(self):
+        """Stops the workers and closes the listening socket.
+
+        Returns:
+            A Deferred firing once every worker has exited.
+        """
+        service.Service.stopService(self)
+        for delayed in self._restarting.values():
+            delayed.cancel()
+        self._restarting.clear()
+        ended = list(self._ended.values())
+        for process in self._workers.values():
+            _signal(process, 'TERM')
+        self._socket.close()
+        return defer.DeferredList(ended)
+
+    def reload(self):
+        """Tells every worker to reload its list definitions."""
+        log.msg('Reloading %d workers' % (len(self._workers),))
+        for process in self._workers.values():
+            _signal(process, 'HUP')
+
+    def profile(self):
+        """Tells every worker to take a profile."""
+        log.msg('Profiling %d workers' % (len(self._workers),))
+        for process in self._workers.values():
+            # signalProcess accepts the names of only a few signals
+            _signal(process, signal.SIGUSR1)
+
+    def _spawn(self, index):
+        """Starts the worker with the given index."""
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(index)
+        env[WORKER_FD_ENV] = str(_WORKER_FD)
+        argv = self.argv(index)
+        worker = _WorkerProtocol(self, index)
+        self._ended[index] = defer.Deferred()
+        self._workers[index] = self._reactor.spawnProcess(worker, argv[0],
+                argv, env, childFDs={0: 'w', 1: 'r', 2: 'r',
+                                     _WORKER_FD: self._socket.fileno()})
+        log.msg('Started worker %d, pid %d' % (index,
+                self._workers[index].pid))
+
+    def _worker_ended(self, index, reason):
+        """Restarts a worker that exited, unless the service is stopping."""
+        log.msg('Worker %d exited: %s' % (index, reason.getErrorMessage()))
+        del self._workers[index]
+        self._ended.pop(index).callback(None)
+        if self.running:
+            self.restarts += 1
+            self._restarting[index] = self._reactor.callLater(
+                    self.restart_delay, self._restart, index)
+
+    def _restart(self, index):
+        """Restarts a worker after the restart delay."""
+        del self._restarting[index]
+        if self.running and index not in self._workers:
+            self._spawn(index)
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """Relays the output of a worker to the log and reports when it exits."""
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg('Worker %d: %s' % (self.index, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.supervisor._worker_ended(self.index, reason)
+
+
+def _signal(process, name):
+    """Sends a signal to a process, ignoring it if the process has exited."""
+    try:
+        process.signalProcess(name)
+    except error.ProcessExitedAlready:
+        pass
+
+
+class AdoptedPortService(service.Service):
+    """A service listening on a socket inherited from the supervisor."""
+
+    def __init__(self, factory, fd=None, reactor=None):
+        """
+        Args:
+            factory: The server factory to listen with.
+            fd: The descriptor of the listening socket. Defaults to the one
+                given in the environment by the supervisor.
+            reactor: The reactor with which to listen. Defaults to the global
+                reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.factory = factory
+        self.fd = int(os.environ[WORKER_FD_ENV]) if fd is None else fd
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = self._reactor.adoptStreamPort(self.fd, socket.AF_INET,
+                self.factory)
+        os.close(self.fd)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self.port.stopListening()
+
+
+class _ParentWatcher(protocol.Protocol):
+    """Stops the reactor when the supervisor closes the worker's stdin."""
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+
+    def connectionLost(self, reason):
+        log.msg('Supervisor went away')
+        if self._reactor.running:
+            self._reactor.stop()
+
+
+def watch_supervisor(reactor=None):
+    """Makes this worker exit when its supervisor goes away.
+
+    Args:
+        reactor: The reactor to stop. Defaults to the global reactor.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    stdio.StandardIO(_ParentWatcher(reactor), reactor=reactor)
@@ -0,0 +1,146 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from mailingset import archive as archive_module
+from mailingset.archive import Archive
+
+import helper
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates an empty archive with small segments."""
+        self.path = helper.temp_path(self)
+        self.archive = self._open()
+
+    def _open(self):
+        """Opens the archive in self.path, closing it after the test."""
+        archive = Archive(self.path, segment_size=100)
+        self.addCleanup(archive.close)
+        return archive
+
+    def _write_all(self):
+        """Archives three messages to two set expressions."""
+        return defer.gatherResults([
+            self.archive.write('<1@test>', 'a_&_b', 'Subject: one\n\nbody\n'),
+            self.archive.write('<2@test>', 'a', 'Subject: two\n\nFrom me\n'),
+            self.archive.write(None, 'A_&_B', 'Subject: three\n\nbody')])
+
+    @defer.inlineCallbacks
+    def test_lookup(self):
+        yield self._write_all()
+        entries = self.archive.lookup('a_&_b')
+        self.assertEqual(['<1@test>', None],
+                [entry.message_id for entry in entries])
+        text = self.archive.read(entries[1])
+        self.assertTrue(text.startswith('From mailingset '))
+        self.assertTrue(text.endswith('\nSubject: three\n\nbody\n\n'))
+
+    @defer.inlineCallbacks
+    def test_lookup_id(self):
+        yield self._write_all()
+        text = self.archive.read(self.archive.lookup_id('<2@test>'))
+        self.assertTrue(text.endswith('\nSubject: two\n\n>From me\n\n'))
+        self.assertEqual(None, self.archive.lookup_id('<missing@test>'))
+
+    @defer.inlineCallbacks
+    def test_lookup_id_folded(self):
+        yield self.archive.write('<4@test>\n ', 'c', 'Subject: four\n\nbody')
+        entry = self.archive.lookup_id('\n <4@test>')
+        self.assertNotEqual(None, entry)
+        self.assertEqual(entry, self.archive.lookup_id('<4@test>'))
+
+    @defer.inlineCallbacks
+    def test_segments(self):
+        yield self._write_all()
+        yield self.archive.write('<4@test>', 'c', 'x' * 200)
+        yield self.archive.write('<5@test>', 'c', 'y')
+        segments = [entry.segment for entry in self.archive.lookup('c')]
+        self.assertEqual(2, len(set(segments)))
+        self.assertTrue(os.path.exists(
+                os.path.join(self.path, 'archive-00001.mbox')))
+
+    @defer.inlineCallbacks
+    def test_failed_segment_closed(self):
+        yield self.archive.write('<4@test>', 'c', 'x' * 200)
+        synced = []
+        def sync(open_file):
+            """Fails to sync the first file, after recording it."""
+            synced.append(open_file)
+            raise IOError('Disk is full')
+        self.patch(archive_module, '_sync', sync)
+        yield self.assertFailure(self.archive.write('<5@test>', 'c', 'y'),
+                                 IOError)
+        # Wait for the writer thread to be done with the batch
+        self.archive.close()
+        self.assertEqual(1, len(synced))
+        self.assertTrue(synced[0].closed)
+
+    @defer.inlineCallbacks
+    def test_reopen(self):
+        yield self._write_all()
+        self.archive.close()
+
+        # Simulate a crash partway through writing an index entry
+        with open(os.path.join(self.path, 'index'), 'a') as index:
+            index.write('0\t12')
+
+        reopened = self._open()
+        self.assertEqual(2, len(reopened.lookup('A_&_b')))
+        yield reopened.write('<4@test>', 'a', 'Subject: four\n\nbody\n')
+        reopened.close()
+
+        entries = self._open().lookup('a')
+        self.assertEqual(['<2@test>', '<4@test>'],
+                [entry.message_id for entry in entries])
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        # Archives in one directory, like those of worker processes, append
+        # to the same files and each finds the messages written by the other
+        other = self._open()
+        yield self.archive.write('<1@test>', 'a', 'Subject: one\n\nbody\n')
+        yield other.write('<2@test>', 'a', 'x' * 200)
+        yield self.archive.write('<3@test>', 'a', 'Subject: three\n\nbody\n')
+        for archive in (self.archive, other):
+            entries = archive.lookup('a')
+            self.assertEqual(['<1@test>', '<2@test>', '<3@test>'],
+                    [entry.message_id for entry in entries])
+            self.assertEqual([0, 0, 1], [entry.segment for entry in entries])
+            self.assertTrue(archive.read(entries[2]).endswith(
+                    '\nSubject: three\n\nbody\n\n'))
+        self.assertEqual(entries[1], self.archive.lookup_id('<2@test>'))
+
+    @defer.inlineCallbacks
+    def test_fail_open(self):
+        os.rmdir(self.path)
+        yield self.assertFailure(self.archive.write('<1@test>', 'a', 'one'),
+                IOError)
+        os.mkdir(self.path)
+        entry = yield self.archive.write('<2@test>', 'a', 'two')
+        self.assertEqual([entry], self.archive.lookup('a'))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,140 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from benchmarks import harness
+
+
+class HarnessTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a baseline to compare results against."""
+        self.baseline = {
+            'fast': {'best': 1.0, 'median': 1.1, 'loops': 10},
+            'slow': {'best': 2.0, 'median': 2.1, 'loops': 1}}
+
+    def test_compare_within_threshold(self):
+        results = {
+            'fast': {'best': 1.2, 'median': 1.3, 'loops': 10},
+            'slow': {'best': 1.5, 'median': 1.6, 'loops': 1}}
+        self.assertEqual([], harness.compare(results, self.baseline, 0.25))
+
+    def test_compare_regression(self):
+        results = {
+            'fast': {'best': 1.3, 'median': 1.3, 'loops': 10},
+            'slow': {'best': 2.0, 'median': 2.1, 'loops': 1}}
+        self.assertEqual([('fast', 1.0, 1.3)],
+                         harness.compare(results, self.baseline, 0.25))
+
+    def test_compare_per_case_threshold(self):
+        results = {
+            'fast': {'best': 1.3, 'median': 1.3, 'loops': 10},
+            'slow': {'best': 2.2, 'median': 2.2, 'loops': 1}}
+        regressions = harness.compare(results, self.baseline, 0.25,
+                                      thresholds={'fast': 0.5, 'slow': 0.05})
+        self.assertEqual([('slow', 2.0, 2.2)], regressions)
+
+    def test_compare_min_delta(self):
+        # A microsecond case slower by a large fraction but a few microseconds
+        baseline = {'short': {'best': 1e-5, 'median': 1e-5, 'loops': 10000}}
+        results = {'short': {'best': 1.5e-5, 'median': 1.5e-5, 'loops': 10000}}
+        self.assertEqual([], harness.compare(results, baseline, 0.25,
+                                             min_delta=1e-5))
+        self.assertEqual([('short', 1e-5, 1.5e-5)],
+                         harness.compare(results, baseline, 0.25,
+                                         min_delta=1e-5,
+                                         min_deltas={'short': 1e-6}))
+
+    def test_compare_reference(self):
+        # With the median reference time twice as slow, the baseline is
+        # doubled, and no case is compared with its own reference time alone
+        baseline = {
+            'fast': {'best': 1.0, 'median': 1.0, 'loops': 10,
+                     'reference': 0.1},
+            'slow': {'best': 2.0, 'median': 2.0, 'loops': 1,
+                     'reference': 0.1},
+            'noisy': {'best': 2.0, 'median': 2.0, 'loops': 1,
+                      'reference': 0.1}}
+        results = {
+            'fast': {'best': 2.4, 'median': 2.4, 'loops': 10,
+                     'reference': 0.2},
+            'slow': {'best': 5.5, 'median': 5.5, 'loops': 1,
+                     'reference': 0.2},
+            'noisy': {'best': 5.5, 'median': 5.5, 'loops': 1,
+                      'reference': 0.4}}
+        self.assertEqual([('slow', 4.0, 5.5), ('noisy', 4.0, 5.5)],
+                         sorted(harness.compare(results, baseline),
+                                reverse=True))
+        # Without reference times in the baseline, it is compared as is
+        for stats in baseline.values():
+            del stats['reference']
+        self.assertEqual(3, len(harness.compare(results, baseline)))
+
+    def test_case_threshold(self):
+        harness.case('test.noisy', threshold=0.5)(lambda: lambda: None)
+        harness.case('test.steady')(lambda: lambda: None)
+        for name in ('test.noisy', 'test.steady'):
+            self.addCleanup(harness._CASES.pop, name)
+        self.addCleanup(harness._THRESHOLDS.pop, 'test.noisy')
+        self.assertEqual(0.5, harness.thresholds()['test.noisy'])
+        self.assertNotIn('test.steady', harness.thresholds())
+
+    def test_case_min_delta(self):
+        harness.case('test.short', min_delta=1e-5)(lambda: lambda: None)
+        self.addCleanup(harness._CASES.pop, 'test.short')
+        self.addCleanup(harness._MIN_DELTAS.pop, 'test.short')
+        self.assertEqual({'test.short': 1e-5}, harness.min_deltas())
+
+    def test_compare_new_case(self):
+        results = {'new': {'best': 9.0, 'median': 9.0, 'loops': 1}}
+        self.assertEqual([], harness.compare(results, self.baseline))
+
+    def test_save_load(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        results_path = os.path.join(path, 'results.json')
+        harness.save(results_path, self.baseline)
+        self.assertEqual(self.baseline, harness.load(results_path))
+
+    def test_reference_time(self):
+        self.assertTrue(0 < harness.reference_time(repeat=1))
+
+    def test_run(self):
+        calls = []
+        harness.case('test.harness')(lambda: lambda: calls.append(None))
+        self.addCleanup(harness._CASES.pop, 'test.harness')
+        self.assertIn('test.harness', harness.names(['test.*']))
+        self.assertNotIn('test.harness', harness.names(['parser.*']))
+
+        results = harness.run(['test.harness'], repeat=3, min_time=0)
+        stats = results['test.harness']
+        self.assertEqual(1, stats['loops'])
+        self.assertTrue(0 <= stats['best'] <= stats['median'])
+        self.assertTrue(0 < stats['reference'])
+        # One calibration call, then one call per repeat, with more repeats
+        # since the case is short
+        self.assertEqual(1 + 3 * harness.SHORT_REPEAT, len(calls))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
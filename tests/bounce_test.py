@@ -0,0 +1,164 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import base64
+import nose
+import quopri
+
+from twisted.trial import unittest
+
+from mailingset.bounce import BounceMessage, BounceProcessor
+from mailingset.suppression import SuppressionList
+
+import helper
+
+
+DSN = """From: MAILER-DAEMON@remote.test
+To: mailingset@test.local
+Subject: Undelivered Mail Returned to Sender
+Content-Type: multipart/report; report-type=delivery-status;
+\tboundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+Action: failed
+Final-Recipient: rfc822; in-text@remote.test
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; remote.test
+
+Final-Recipient: rfc822; Failed@remote.test
+Action: failed
+Status: 5.1.1
+
+Final-Recipient: rfc822; <permanent@remote.test>
+Status: 5.0.0
+
+Final-Recipient: rfc822; retrying@remote.test
+Action: delayed
+Status: 5.0.0
+
+Final-Recipient: rfc822; delayed@remote.test
+Action: delayed
+Status: 4.4.1
+
+Final-Recipient: rfc822; delivered@remote.test
+Action: delivered
+Status: 2.0.0
+--BOUNDARY
+Content-Type: message/rfc822
+
+Final-Recipient: rfc822; returned@remote.test
+Action: failed
+
+--BOUNDARY--
+"""
+
+ENCODED = """Content-Type: multipart/report; report-type=delivery-status;
+\tboundary="BOUNDARY"
+
+--BOUNDARY
+Content-Transfer-Encoding: %s
+Content-Type: message/delivery-status
+
+%s
+--BOUNDARY--
+"""
+
+# Long enough for quoted-printable to wrap its line
+ADDRESS = 'encoded-with-a-long-local-part-to-be-wrapped@remote.test'
+
+STATUS = """Reporting-MTA: dns; remote.test
+
+Final-Recipient: rfc822; %s
+Action: failed
+Status: 5.1.1
+""" % (ADDRESS,)
+
+
+class BounceTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a bounce processor with an in-memory suppression list."""
+        self.suppressed = SuppressionList()
+        self.processor = BounceProcessor(self.suppressed, threshold=2)
+
+    def _receive(self, text, verp_recipient=None):
+        """Feeds a bounce message to a BounceMessage line by line."""
+        msg = BounceMessage(self.processor, verp_recipient)
+        for line in text.splitlines():
+            msg.lineReceived(line)
+        return msg.eomReceived()
+
+    def test_dsn(self):
+        self._receive(DSN)
+        expected = {'failed@remote.test': 1, 'permanent@remote.test': 1}
+        self.assertEqual(expected, self.processor.counts)
+
+    def test_verp(self):
+        self._receive(DSN, 'original@remote.test')
+        self.assertEqual({'original@remote.test': 1}, self.processor.counts)
+
+    def test_verp_not_failed(self):
+        self._receive('Content-Type: message/delivery-status\n\n'
+                'Final-Recipient: rfc822; delayed@remote.test\n'
+                'Action: delayed\nStatus: 4.4.1\n', 'original@remote.test')
+        self.assertEqual({}, self.processor.counts)
+
+    def test_threshold(self):
+        self._receive(DSN)
+        self.assertFalse('failed@remote.test' in self.suppressed)
+        self._receive(DSN)
+        self.assertTrue('failed@remote.test' in self.suppressed)
+        self.assertEqual(2, len(self.suppressed))
+
+    def test_threshold_shared(self):
+        # Processes sharing a journal count each other's bounces
+        path = helper.temp_path(self)
+        processors = [BounceProcessor(SuppressionList(path), threshold=2)
+                      for _ in range(2)]
+        processors[0].hard_bounce('failed@remote.test')
+        self.assertFalse('failed@remote.test' in processors[1].suppressed)
+        processors[1].hard_bounce('failed@remote.test')
+        self.assertTrue('failed@remote.test' in processors[1].suppressed)
+
+    def test_base64(self):
+        # Lines of base64 need not be a multiple of 4 characters long
+        encoded = base64.b64encode(STATUS)
+        lines = [encoded[i:i + 17] for i in range(0, len(encoded), 17)]
+        self._receive(ENCODED % ('base64', '\n'.join(lines)))
+        self.assertEqual({ADDRESS: 1}, self.processor.counts)
+
+    def test_quoted_printable(self):
+        encoded = quopri.encodestring(STATUS)
+        self.assertTrue('=\n' in encoded)
+        self._receive(ENCODED % ('quoted-printable', encoded))
+        self.assertEqual({ADDRESS: 1}, self.processor.counts)
+
+    def test_truncated(self):
+        msg = BounceMessage(self.processor)
+        for line in DSN.splitlines():
+            msg.lineReceived(line)
+        msg.connectionLost()
+        self.assertEqual({}, self.processor.counts)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
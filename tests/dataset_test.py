@@ -0,0 +1,114 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from mailingset.state import MailingSetState
+
+from benchmarks import dataset
+
+
+class DatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a directory to generate datasets into."""
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def generate(self, **params):
+        """Generates a dataset and loads it."""
+        return MailingSetState(dataset.generate(self.path, **params))
+
+    def read(self, listname):
+        """Reads the lines of a generated list."""
+        with open(os.path.join(self.path, 'lists', listname)) as list_file:
+            return list_file.read().splitlines()
+
+    def test_lists(self):
+        state = self.generate(lists=30, members=20, depth=0)
+        self.assertEqual(set('list%d' % i for i in range(30)),
+                         set(state.components()['lists']))
+        self.assertEqual('L29', state('list29')[0])
+
+    def test_same_seed(self):
+        dataset.generate(self.path, lists=5, members=10, seed=3)
+        first = [self.read('list%d' % i) for i in range(5)]
+        shutil.rmtree(self.path)
+        os.mkdir(self.path)
+        dataset.generate(self.path, lists=5, members=10, seed=3)
+        self.assertEqual(first, [self.read('list%d' % i) for i in range(5)])
+
+    def test_constant_size(self):
+        self.generate(lists=10, members=7, tail=None, depth=0)
+        for index in range(10):
+            self.assertEqual(7, len(self.read('list%d' % index)))
+
+    def test_heavy_tail(self):
+        self.generate(lists=200, members=10, tail=1.2, people=10000, depth=0)
+        sizes = [len(self.read('list%d' % i)) for i in range(200)]
+        self.assertTrue(max(sizes) > 5 * sorted(sizes)[100])
+
+    def test_nesting(self):
+        state = self.generate(lists=40, members=10, depth=3, nested=0.25)
+        # Ten composite lists over three levels above the lists of people
+        nested = ['list%d' % i for i in range(30, 40)]
+        for listname in nested:
+            self.assertTrue(any(line.endswith('@' + dataset.DOMAIN)
+                                for line in self.read(listname)))
+        # The top level contains everything nested beneath it
+        top = state.components()['lists']['list39']
+        self.assertTrue(len(top) > len(self.read('list39')))
+
+    def test_named(self):
+        self.generate(lists=10, members=50, named=0.0, depth=0)
+        self.assertFalse(any('<' in line for line in self.read('list0')))
+        shutil.rmtree(self.path)
+        os.mkdir(self.path)
+        self.generate(lists=10, members=50, named=1.0, depth=0)
+        self.assertTrue(all('<' in line for line in self.read('list0')))
+
+    def test_collisions(self):
+        state = self.generate(lists=10, members=50, collisions=0.0,
+                              named=1.0, depth=0)
+        aliases = state.components()['aliases']
+        self.assertFalse(any(aliases[k] is None for k in aliases if '.' in k))
+
+        shutil.rmtree(self.path)
+        os.mkdir(self.path)
+        state = self.generate(lists=10, members=50, collisions=0.5,
+                              named=1.0, depth=0)
+        aliases = state.components()['aliases']
+        self.assertTrue(any(aliases[k] is None for k in aliases if '.' in k))
+
+    def test_members_file(self):
+        expected = self.generate(lists=20, members=20, seed=5).components()
+        for filename in ('members.csv', 'members.jsonl.gz'):
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+            state = self.generate(lists=20, members=20, seed=5,
+                                  members_file=filename)
+            self.assertFalse(os.path.exists(os.path.join(self.path, 'lists')))
+            self.assertEqual(expected, state.components())
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,112 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import nose
+import StringIO
+
+from twisted.python import failure
+from twisted.trial import unittest
+
+from mailingset import eventlog
+
+
+class EventLogTest(unittest.TestCase):
+
+    def _emit_all(self, events, **kw):
+        """Writes log events through a JSONLogObserver.
+
+        Args:
+            events: List of Twisted log event dicts.
+            **kw: Extra arguments for the JSONLogObserver.
+
+        Returns:
+            List of the JSON objects written.
+        """
+        out = StringIO.StringIO()
+        observer = eventlog.JSONLogObserver(out, **kw)
+        for event in events:
+            observer.emit(event)
+        observer.stop()
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_fields(self):
+        event = {'format': 'Sent to %(count)d', 'count': 2, 'event': 'sent',
+                 'message': (), 'time': 0, 'system': '-', 'isError': 0,
+                 'log_namespace': 'log_legacy', 'unencodable': object()}
+        expected = [{'time': '1970-01-01T00:00:00Z', 'system': '-',
+                     'message': 'Sent to 2', 'count': 2, 'event': 'sent'}]
+        self.assertEqual(expected, self._emit_all([event]))
+
+    def test_set(self):
+        recipients = set(['c@test.local', 'a@test.local', 'b@test.local'])
+        event = {'message': ('Recipients',), 'time': None, 'system': '-',
+                 'isError': 0, 'recipients': recipients}
+        out = StringIO.StringIO()
+        observer = eventlog.JSONLogObserver(out)
+        observer.emit(event)
+        # A change after logging is not written
+        recipients.add('d@test.local')
+        observer.stop()
+        self.assertEqual(['a@test.local', 'b@test.local', 'c@test.local'],
+                json.loads(out.getvalue())['recipients'])
+
+    def test_error(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            event = {'failure': failure.Failure(), 'why': 'Oops',
+                     'isError': 1, 'time': 0, 'system': '-', 'message': ()}
+        (record,) = self._emit_all([event])
+        self.assertTrue(record['error'])
+        self.assertTrue(record['message'].startswith('Oops\n'))
+        self.assertTrue('ZeroDivisionError' in record['message'])
+
+    def test_include_exclude(self):
+        events = [{'message': ('one',), 'event': 'a'},
+                  {'message': ('two',), 'event': 'b'},
+                  {'message': ('three',)}]
+        included = self._emit_all(events, include=['a'])
+        self.assertEqual(['one'], [record['message'] for record in included])
+        excluded = self._emit_all(events, exclude=['a'])
+        self.assertEqual(['two', 'three'],
+                [record['message'] for record in excluded])
+
+    def test_after_fork(self):
+        out = StringIO.StringIO()
+        writer = eventlog.ThreadedWriter(out)
+        writer.write('a\n')
+        (parent_thread, parent_queue) = (writer._thread, writer._queue)
+        # Pretend the process forked, leaving the writer thread behind
+        writer._pid = None
+        writer.write('b\n')
+        self.assertNotIdentical(parent_thread, writer._thread)
+        writer.stop()
+        parent_queue.put(None)
+        parent_thread.join()
+        self.assertEqual(['a', 'b'], sorted(out.getvalue().split()))
+
+    def test_after_stop(self):
+        out = StringIO.StringIO()
+        observer = eventlog.JSONLogObserver(out)
+        observer.emit({'message': ('one',)})
+        observer.stop()
+        observer.emit({'message': ('two',)})
+        self.assertEqual(2, len(out.getvalue().splitlines()))
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
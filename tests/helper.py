@@ -15,6 +15,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import shutil
+import tempfile
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.mail import smtp
+
+
 class AssertFail:
     """A replacement for TestCase.assertRaisesRegexp which is not in Python 2.6.
 
@@ -44,3 +54,88 @@ class AssertFail:
         self.test_obj.assertEqual(self.expected_type, type)
         self.test_obj.assertEqual(self.expected_msg, str(value))
         return True # do not propagate the error
+
+
+def temp_path(test_obj):
+    """Makes a path at which a test may create a file or directory.
+
+    Unlike TestCase.mktemp, the path is in a new directory under the system
+    temporary directory, which is removed when the test finishes, so running
+    the tests leaves nothing behind in the working directory.
+
+    Args:
+        test_obj: The TestCase instance, in order to remove the directory.
+
+    Returns:
+        A path that does not exist yet.
+    """
+    directory = tempfile.mkdtemp()
+    test_obj.addCleanup(shutil.rmtree, directory, True)
+    return os.path.join(directory, 'temp')
+
+
+class RecordingRelay(smtp.SMTPFactory):
+    """An SMTP server recording every transaction it receives.
+
+    Attributes:
+        transactions: List of (connection,sender,recipient) tuples, one for each
+            message received, where connection counts the connections from 1.
+        rejected: Set of recipient addresses to refuse.
+        connections: Number of connections accepted so far.
+    """
+
+    def __init__(self):
+        smtp.SMTPFactory.__init__(self)
+        self.transactions = []
+        self.rejected = set()
+        self.connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        protocol = smtp.ESMTP()
+        protocol.factory = self
+        protocol.delivery = _RecordingDelivery(self, self.connections)
+        return protocol
+
+
+@implementer(smtp.IMessageDelivery)
+class _RecordingDelivery(object):
+    """Accepts senders and recipients of a connection to RecordingRelay."""
+
+    def __init__(self, relay, connection):
+        self.relay = relay
+        self.connection = connection
+        self.sender = None
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        self.sender = str(origin)
+        return origin
+
+    def validateTo(self, user):
+        recipient = str(user.dest)
+        if recipient in self.relay.rejected:
+            raise smtp.SMTPBadRcpt(user)
+        transaction = (self.connection, self.sender, recipient)
+        return lambda: _RecordingMessage(self.relay, transaction)
+
+
+@implementer(smtp.IMessage)
+class _RecordingMessage(object):
+    """Records one transaction received by RecordingRelay."""
+
+    def __init__(self, relay, transaction):
+        self.relay = relay
+        self.transaction = transaction
+
+    def lineReceived(self, line):
+        pass
+
+    def eomReceived(self):
+        self.relay.transactions.append(self.transaction)
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
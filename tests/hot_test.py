@@ -0,0 +1,144 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import nose
+import os
+import shutil
+
+from twisted.trial import unittest
+
+from mailingset import parser
+from mailingset.hot import HotExpressions
+from mailingset.state import MailingSetState
+
+import helper
+
+
+class HotExpressionsTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates hot expressions saved to a fresh file."""
+        self.path = helper.temp_path(self)
+        self.hot = HotExpressions(size=2, path=self.path)
+
+    def _state(self, lists_path=None):
+        """Loads the state of the test lists, or of a copy of them."""
+        test_dir = os.path.dirname(__file__)
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'lists_dir',
+                   lists_path or os.path.join(test_dir, 'lists'))
+        config.set('data', 'symbols_file',
+                   os.path.join(test_dir, 'symbols.txt'))
+        return MailingSetState(config)
+
+    def test_record(self):
+        self.assertEqual(None, self.hot.lookup('test.local', 'named'))
+        self.hot.record('test.local', 'named', 'Named', set(['b@test.local']))
+        self.assertEqual(('Named', set(['b@test.local'])),
+                         self.hot.lookup('test.local', 'named'))
+        self.assertEqual(None, self.hot.lookup('other.local', 'named'))
+        self.assertEqual(2, self.hot._hits[('test.local', 'named')])
+        self.hot.lookup('test.local', 'named', counted=False)
+        self.assertEqual(2, self.hot._hits[('test.local', 'named')])
+
+    def test_hottest_kept(self):
+        for (address, hits) in [('a', 3), ('b', 1), ('c', 2)]:
+            for _ in range(hits):
+                self.hot.record('test.local', address, address.upper(), set())
+        self.assertEqual(2, len(self.hot))
+        self.assertEqual(None, self.hot.lookup('test.local', 'b'))
+
+        # An expression becoming hotter than a kept one replaces it
+        for _ in range(3):
+            self.hot.record('test.local', 'b', 'B', set())
+        self.assertNotEqual(None, self.hot.lookup('test.local', 'b'))
+        self.assertEqual(None, self.hot.lookup('test.local', 'c'))
+
+    def test_disabled(self):
+        hot = HotExpressions(size=0)
+        hot.record('test.local', 'named', 'Named', set())
+        self.assertEqual(None, hot.lookup('test.local', 'named'))
+        self.assertEqual([], hot.pending({'test.local': None}))
+
+    def test_pruned(self):
+        for index in range(100):
+            self.hot.record('test.local', 'x%d' % index, 'X', set())
+        self.assertTrue(
+                len(self.hot._hits) <= 2 * HotExpressions.TRACKED_FACTOR)
+
+    def test_saved(self):
+        for (address, hits) in [('a', 3), ('b', 1), ('c', 2)]:
+            for _ in range(hits):
+                self.hot.record('test.local', address, address.upper(), set())
+        self.hot.save()
+        self.hot.save()
+        self.assertEqual([os.path.basename(self.path)],
+                os.listdir(os.path.dirname(os.path.abspath(self.path))))
+
+        # Only the counts are saved, so nothing is materialized until warmed
+        reopened = HotExpressions(size=2, path=self.path)
+        self.assertEqual(0, len(reopened))
+        states = {'test.local': None}
+        self.assertEqual([('test.local', 'a'), ('test.local', 'c')],
+                         reopened.pending(states))
+        self.assertEqual([], reopened.pending({}))
+
+        reopened.install({('test.local', 'a'): ('A', set())})
+        self.assertEqual([('test.local', 'c')], reopened.pending(states))
+
+    def test_unreadable(self):
+        with open(self.path, 'w') as hot_file:
+            hot_file.write('{"expressions": [{"domain": "test.local"}]}')
+        hot = HotExpressions(path=self.path)
+        self.assertEqual(1, len(self.flushLoggedErrors(KeyError)))
+        self.assertEqual([], hot.pending({'test.local': None}))
+
+    def test_refresh(self):
+        old = self._state()
+        self.hot.size = 3
+        for address in ['named', 'unnamed_-_zz', 'nested']:
+            (tag, addrs) = parser.parse(old, address)
+            self.hot.record('test.local', address, tag, addrs)
+
+        # Only the expressions depending on a changed list are dropped
+        lists_path = helper.temp_path(self)
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'lists'),
+                        lists_path)
+        with open(os.path.join(lists_path, 'named'), 'a') as list_file:
+            list_file.write('d@test.local\n')
+        new = self._state(lists_path)
+        dropped = self.hot.refresh({'test.local': old}, {'test.local': new},
+                                   parser.leaves)
+        self.assertEqual(2, dropped)
+        self.assertEqual(None, self.hot.lookup('test.local', 'named'))
+        self.assertNotEqual(None, self.hot.lookup('test.local', 'unnamed_-_zz'))
+        # Nested lists are compared by their flattened members
+        self.assertEqual(None, self.hot.lookup('test.local', 'nested'))
+
+    def test_refresh_domain_removed(self):
+        state = self._state()
+        self.hot.record('test.local', 'named', 'Named', set())
+        self.assertEqual(1, self.hot.refresh({'test.local': state}, {},
+                                             parser.leaves))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,69 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+from twisted.trial import unittest
+
+from mailingset import lag
+from mailingset import metrics
+
+
+class LagTest(unittest.TestCase):
+
+    def setUp(self):
+        """Starts a lag monitor with a short interval and threshold."""
+        registry = metrics.Registry()
+        self.lag_seconds = registry.histogram('lag_seconds', 'Lag')
+        self.stalls = registry.counter('stalls_total', 'Stalls')
+        self.monitor = lag.LagMonitor(self.lag_seconds, self.stalls,
+                interval=0.02, threshold=0.1)
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+
+    def test_no_stall(self):
+        def check(_):
+            """Checks that heartbeats were recorded without a stall."""
+            self.assertTrue(self.lag_seconds.count() > 0)
+            self.assertEqual(0, self.stalls.value())
+        return task.deferLater(reactor, 0.2, lambda: None).addCallback(check)
+
+    def test_stall(self):
+        def block_reactor():
+            """Keeps the reactor from running for longer than the threshold."""
+            time.sleep(0.3)
+        reactor.callLater(0.05, block_reactor)
+
+        def check(_):
+            """Checks that the stall was logged with the blocking stack."""
+            self.assertEqual(1, self.stalls.value())
+            (event,) = [e for e in self.events if e.get('event') == 'stall']
+            self.assertTrue(event['duration'] >= 0.3)
+            self.assertTrue('block_reactor' in event['stack'])
+        return task.deferLater(reactor, 0.5, lambda: None).addCallback(check)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,119 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import nose
+import os
+import random
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.mail import smtp
+from twisted.protocols import policies
+from twisted.trial import unittest
+
+from mailingset.service import SetSMTPFactory
+
+from benchmarks import loadgen
+
+
+class LoadgenTest(unittest.TestCase):
+
+    def setUp(self):
+        """Starts the service on the sample lists, sending to a fake relay."""
+        test_dir = os.path.dirname(__file__)
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'lists_dir', os.path.join(test_dir, 'lists'))
+        config.set('data', 'symbols_file', os.path.join(test_dir,
+                                                        'symbols.txt'))
+
+        # Track connections to both servers so that the test can wait for
+        # them to close
+        self.relay = loadgen.FakeRelay()
+        relay_factory = policies.WrappingFactory(self.relay)
+        relay_port = reactor.listenTCP(0, relay_factory,
+                                       interface='127.0.0.1')
+        self.addCleanup(relay_port.stopListening)
+
+        loadgen.server_config(config, relay_port.getHost().port)
+        server_factory = policies.WrappingFactory(
+                SetSMTPFactory(config, smtp.sendmail))
+        server_port = reactor.listenTCP(0, server_factory,
+                                        interface='127.0.0.1')
+        self.addCleanup(server_port.stopListening)
+        self.port = server_port.getHost().port
+
+        self.addCleanup(self._closed, [relay_factory, server_factory])
+
+    def _closed(self, factories):
+        """Waits until every connection to the given factories has closed."""
+        def check():
+            if any(factory.protocols for factory in factories):
+                return task.deferLater(reactor, 0.01, check)
+            # Let the client side of the connections close too
+            return task.deferLater(reactor, 0, lambda: None)
+        return check()
+
+    def test_drive(self):
+        expressions = iter(['nested', 'unnamed'] * 3)
+        driving = loadgen.drive('127.0.0.1', self.port, expressions, [500],
+                                clients=2, count=6, rand=random.Random(0),
+                                domain='test.local')
+
+        def check(results):
+            self.assertEqual(6, len(results.latencies))
+            self.assertEqual(0, results.failures)
+            self.assertEqual(6, self.relay.stats.messages)
+            # Three members of nested and two of unnamed
+            self.assertEqual(15, self.relay.stats.recipients)
+
+            summary = results.summary(self.relay.stats)
+            self.assertEqual(6, summary['messages'])
+            self.assertEqual(15, summary['recipients'])
+            self.assertTrue(summary['latency_p50'] <= summary['latency_p99'])
+            self.assertTrue(summary['peak_rss_bytes'] > 0)
+        return driving.addCallback(check)
+
+    def test_failures(self):
+        expressions = iter(['nested', 'missing'])
+        driving = loadgen.drive('127.0.0.1', self.port, expressions, [500],
+                                clients=1, count=2, rand=random.Random(0),
+                                domain='test.local')
+
+        def check(results):
+            self.assertEqual(1, len(results.latencies))
+            self.assertEqual(1, results.failures)
+        return driving.addCallback(check)
+
+    def test_message(self):
+        msg = loadgen.message(1000, 7)
+        self.assertIn('Message-ID: <loadgen.7@example.com>\r\n', msg)
+        body = msg.split('\r\n\r\n', 1)[1]
+        self.assertTrue(900 < len(body) <= 1000)
+
+    def test_weighted_expressions(self):
+        expressions = loadgen.weighted_expressions([('a', 1), ('b', 0)],
+                                                   random.Random(0))
+        self.assertEqual(set(['a']), set(next(expressions)
+                                         for _ in range(20)))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
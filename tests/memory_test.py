@@ -0,0 +1,215 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import email.parser
+import json
+import nose
+import os
+import sys
+import weakref
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test import requesthelper
+
+from mailingset import memory
+from mailingset.hot import HotExpressions
+from mailingset.state import MailingSetState
+from mailingset.suppression import SuppressionList
+
+
+class FakeFactory(object):
+    """The parts of a SetSMTPFactory that are measured."""
+
+    def __init__(self, state, states=None):
+        self.state = state
+        self.states = states or {'test.local': state}
+        self.suppressed = SuppressionList()
+        self.hot = HotExpressions()
+        self.archive = None
+        self.messages = weakref.WeakSet()
+
+
+class FakeMessage(object):
+    """The parts of a SetMessage that are measured."""
+
+    def __init__(self, recipient_set, data):
+        self.recipient_set = recipient_set
+        self.msg_parser = email.parser.FeedParser()
+        self.msg_parser.feed(data)
+
+
+class MemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a factory to measure, with the state of the test lists."""
+        test_dir = os.path.dirname(__file__)
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'lists_dir', os.path.join(test_dir, 'lists'))
+        config.set('data', 'symbols_file',
+                os.path.join(test_dir, 'symbols.txt'))
+        self.factory = FakeFactory(MailingSetState(config))
+
+    def test_deep_size(self):
+        shared = 'x' * 1000
+        self.assertEqual(sys.getsizeof(shared), memory.deep_size(shared))
+        self.assertTrue(memory.deep_size([shared]) > 1000)
+        # The shared string is counted once
+        self.assertTrue(memory.deep_size([shared, shared]) <
+                memory.deep_size([shared]) + 1000)
+
+    def test_deep_size_attributes(self):
+        message = FakeMessage(set(), 'Subject: hi\n\n' + 'x' * 10000)
+        self.assertTrue(memory.deep_size(message) > 10000)
+        # Classes are not counted
+        self.assertEqual(0, memory.deep_size(FakeMessage))
+
+    def test_deep_size_seen(self):
+        seen = set()
+        value = ['x' * 1000]
+        memory.deep_size(value, seen)
+        self.assertEqual(0, memory.deep_size(value, seen))
+
+    def test_report(self):
+        result = memory.report(self.factory)
+        self.assertEqual(set(['empty', 'named', 'nested', 'unnamed']),
+                set(result['lists']))
+        self.assertTrue(result['lists']['nested'] >
+                result['lists']['empty'])
+        for name in ['memberships', 'aliases', 'symbols', 'names',
+                     'suppressed', 'hot']:
+            self.assertTrue(result[name] > 0)
+        self.assertEqual({'count': 0, 'recipients': 0, 'buffers': 0},
+                result['messages'])
+
+    def test_report_domains(self):
+        self.assertFalse('domains' in memory.report(self.factory))
+
+        # A second domain with the same lists costs only what is not shared
+        interned = {}
+        test_dir = os.path.dirname(__file__)
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'lists_dir', os.path.join(test_dir, 'lists'))
+        config.set('data', 'symbols_file',
+                os.path.join(test_dir, 'symbols.txt'))
+        first = MailingSetState(config, interned=interned)
+        second = MailingSetState(config, interned=interned)
+        factory = FakeFactory(first, {'test.local': first, 'other': second})
+        domains = memory.report(factory)['domains']
+        self.assertEqual(memory.deep_size(first), domains['test.local'])
+        self.assertTrue(domains['other'] < domains['test.local'])
+
+    def test_report_listening(self):
+        # The reactor reached from the suppression list leads to the listening
+        # port and its factory, which are not counted
+        listening = protocol.ServerFactory()
+        listening.held = 'x' * 1000000
+        port = reactor.listenTCP(0, listening, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        result = memory.report(self.factory)
+        self.assertTrue(result['suppressed'] < 10000)
+        self.assertTrue(result['hot'] < 10000)
+
+        self.factory.suppressed.add('a@test.local')
+        self.assertTrue(memory.report(self.factory)['suppressed'] >
+                result['suppressed'])
+
+    def test_report_messages(self):
+        message = FakeMessage(set(['a@test.local']), 'x' * 10000)
+        self.factory.messages.add(message)
+        messages = memory.report(self.factory)['messages']
+        self.assertEqual(1, messages['count'])
+        self.assertTrue(messages['recipients'] > 0)
+        self.assertTrue(messages['buffers'] > 10000)
+
+        del message
+        self.assertEqual(0, memory.report(self.factory)['messages']['count'])
+
+    def test_resource(self):
+        request = requesthelper.DummyRequest([''])
+        request.args = {'snapshot': ['1']}
+        finished = request.notifyFinish()
+        self.assertEqual(server.NOT_DONE_YET,
+                memory.MemoryResource(self.factory).render(request))
+
+        def check(_):
+            result = json.loads(''.join(request.written))
+            self.assertEqual(memory.report(self.factory)['lists'],
+                    result['lists'])
+            if memory.HeapSnapshots.available():
+                self.assertEqual([], result['growth'])
+            else:
+                self.assertEqual(None, result['growth'])
+        return finished.addCallback(check)
+
+    def test_resource_no_snapshot(self):
+        request = requesthelper.DummyRequest([''])
+        finished = request.notifyFinish()
+        memory.MemoryResource(self.factory).render(request)
+
+        def check(_):
+            self.assertFalse('growth' in json.loads(''.join(request.written)))
+        return finished.addCallback(check)
+
+    def test_resource_bad_limit(self):
+        for limit in ('x', '0'):
+            request = requesthelper.DummyRequest([''])
+            request.args = {'snapshot': ['1'], 'limit': [limit]}
+            body = memory.MemoryResource(self.factory).render(request)
+            self.assertEqual(400, request.responseCode)
+            self.assertEqual({'error': 'limit must be a positive integer'},
+                    json.loads(body))
+
+    def test_resource_disconnected(self):
+        started = []
+        def defer_to_thread(func, *args):
+            started.append((defer.Deferred(), func, args))
+            return started[-1][0]
+        self.patch(threads, 'deferToThread', defer_to_thread)
+        request = requesthelper.DummyRequest([''])
+        memory.MemoryResource(self.factory).render(request)
+        request.processingFailed(failure.Failure(Exception('Lost')))
+        (measured, func, args) = started[0]
+        measured.callback(func(*args))
+        self.assertEqual([], request.written)
+
+    def test_snapshots(self):
+        if not memory.HeapSnapshots.available():
+            raise unittest.SkipTest('tracemalloc is not available')
+        snapshots = memory.HeapSnapshots()
+        self.assertEqual([], snapshots.take())
+        kept = ['x' * 1000 for _ in range(1000)]
+        growth = snapshots.take(1)
+        self.assertEqual(1, len(growth))
+        self.assertTrue(growth[0]['size_diff'] > 0)
+        del kept
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
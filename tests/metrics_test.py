@@ -0,0 +1,107 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+
+from twisted.trial import unittest
+from twisted.web.test import requesthelper
+
+from mailingset import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a registry holding one metric of each kind."""
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('test_total', 'A counter')
+        self.labeled = self.registry.counter('test_labeled_total',
+                'A labeled counter', 'outcome')
+        self.gauge = self.registry.gauge('test_gauge', 'A gauge')
+        self.histogram = self.registry.histogram('test_seconds',
+                'A histogram', (0.1, 1))
+
+    def test_counter(self):
+        self.counter.inc()
+        self.counter.inc(amount=2)
+        self.assertEqual(3, self.counter.value())
+
+    def test_labeled_counter(self):
+        self.labeled.inc('good')
+        self.labeled.inc('bad')
+        self.labeled.inc('good')
+        self.assertEqual(2, self.labeled.value('good'))
+        self.assertEqual(0, self.labeled.value('ugly'))
+
+    def test_gauge(self):
+        self.gauge.inc()
+        self.gauge.inc()
+        self.gauge.dec()
+        self.assertEqual(1, self.gauge.value())
+        self.gauge.set(7)
+        self.assertEqual(7, self.gauge.value())
+
+    def test_histogram(self):
+        for value in [0.05, 0.1, 0.5, 2]:
+            self.histogram.observe(value)
+        self.assertEqual(4, self.histogram.count())
+        expected = [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4']
+        self.assertEqual(expected, self.histogram.samples())
+
+    def test_time(self):
+        elapsed = self.histogram.time()()
+        self.assertTrue(elapsed >= 0)
+        self.assertEqual(1, self.histogram.count())
+
+    def test_render(self):
+        self.counter.inc()
+        self.labeled.inc('good')
+        expected = '\n'.join([
+            '# HELP test_total A counter',
+            '# TYPE test_total counter',
+            'test_total 1',
+            '# HELP test_labeled_total A labeled counter',
+            '# TYPE test_labeled_total counter',
+            'test_labeled_total{outcome="good"} 1',
+            '# HELP test_gauge A gauge',
+            '# TYPE test_gauge gauge',
+            'test_gauge 0',
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 0',
+            'test_seconds_bucket{le="1"} 0',
+            'test_seconds_bucket{le="+Inf"} 0',
+            'test_seconds_sum 0',
+            'test_seconds_count 0']) + '\n'
+        self.assertEqual(expected, self.registry.render())
+
+    def test_resource(self):
+        self.counter.inc()
+        request = requesthelper.DummyRequest([''])
+        result = metrics.MetricsResource(self.registry).render(request)
+        self.assertTrue('test_total 1\n' in result)
+        self.assertEqual(['text/plain; version=0.0.4'],
+                request.responseHeaders.getRawHeaders('Content-Type'))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -17,6 +17,7 @@
 
 import nose
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from mailingset import parser
@@ -95,6 +96,10 @@ class ParserTest(unittest.TestCase):
         expected = ('Empty', set())
         self.assertEqual(result, expected)
 
+    def test_leaves(self):
+        result = parser.leaves('{alist_-_b.list}_&_c-list_|_')
+        self.assertEqual(['alist', 'b.list', 'c-list'], result)
+
     def test_fail_empty_result(self):
         expected = 'No recipients match this set expression'
         with helper.AssertFail(self, SyntaxError, expected):
@@ -150,6 +155,39 @@ class ParserTest(unittest.TestCase):
         with helper.AssertFail(self, SyntaxError, expected):
             parser.parse(resolve, '{alist_&_blist}}')
 
+    def test_parse_async(self):
+        pending = {}
+        def resolve_later(leaf):
+            """Resolves a leaf once the test fires its Deferred."""
+            pending[leaf] = defer.Deferred()
+            return pending[leaf]
+        parsed = parser.parse_async(resolve_later, 'alist_&_{blist_|_alist}')
+
+        # Every distinct leaf is looked up before any lookup finishes
+        self.assertEqual(set(['alist', 'blist']), set(pending))
+        self.assertNoResult(parsed)
+        pending['blist'].callback(blist)
+        pending['alist'].callback(alist)
+        expected = ('AA&(BB|AA)', alist[1] & (blist[1] | alist[1]))
+        self.assertEqual(expected, self.successResultOf(parsed))
+
+    def test_parse_async_sync_resolver(self):
+        parsed = parser.parse_async(resolve, 'alist')
+        self.assertEqual(('Alist', alist[1]), self.successResultOf(parsed))
+
+    def test_fail_parse_async(self):
+        def reject(leaf):
+            """Rejects every leaf."""
+            return defer.fail(SyntaxError('No such list or person: %s'
+                    % (leaf,)))
+        parsed = parser.parse_async(reject, 'alist_&_blist')
+        reason = self.failureResultOf(parsed, SyntaxError)
+        self.assertEqual('No such list or person: alist', str(reason.value))
+
+    def test_fail_parse_async_syntax(self):
+        parsed = parser.parse_async(resolve, '{alist_&_blist}}')
+        self.failureResultOf(parsed, SyntaxError)
+
 
 if __name__ == '__main__':
     nose.run(argv=['', __file__])
@@ -0,0 +1,141 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+import pstats
+import sys
+
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test import requesthelper
+
+from mailingset import profiler
+
+import helper
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a profiler driven by a fake clock."""
+        self.directory = helper.temp_path(self)
+        self.clock = task.Clock()
+        self.profiler = profiler.Profiler(self.directory, duration=5,
+                reactor=self.clock)
+
+    def test_cprofile(self):
+        done = self.profiler.start('cprofile')
+        sorted(range(100))
+        self.clock.advance(5)
+        path = self.successResultOf(done)
+        self.assertTrue(path.endswith('.pstats'))
+        self.assertEqual(self.directory, os.path.dirname(path))
+        pstats.Stats(path)
+        self.assertEqual(None, self.profiler.running)
+
+    def test_stacks(self):
+        from twisted.internet import reactor
+        sampler = profiler.Profiler(self.directory, duration=0.1,
+                interval=0.01, reactor=reactor)
+        def check_stacks(path):
+            """Checks that the stacks of the reactor were sampled."""
+            self.assertTrue(path.endswith('.stacks'))
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines)
+            for line in lines:
+                (stack, count) = line.rsplit(' ', 1)
+                self.assertTrue(int(count) > 0)
+        return sampler.start().addCallback(check_stacks)
+
+    def test_busy(self):
+        self.profiler.start('cprofile')
+        self.addCleanup(self.clock.advance, 5)
+        self.assertRaises(RuntimeError, self.profiler.start)
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, self.profiler.start, 'gprof')
+        self.assertRaises(ValueError, profiler.Profiler, self.directory,
+                mode='gprof')
+
+    def test_bad_duration(self):
+        self.assertRaises(ValueError, self.profiler.start, 'cprofile', -1)
+        self.assertRaises(ValueError, self.profiler.start, 'cprofile',
+                profiler.MAX_DURATION + 1)
+        self.assertEqual(None, self.profiler.running)
+
+    def test_fail_cprofile(self):
+        done = self.profiler.start('cprofile')
+        os.rmdir(self.directory)
+        self.clock.advance(5)
+        self.failureResultOf(done, IOError)
+        self.assertEqual(None, self.profiler.running)
+
+    def test_fail_stacks(self):
+        from twisted.internet import reactor
+        sampler = profiler.Profiler(os.path.join(self.directory, 'missing'),
+                duration=0.05, interval=0.01, reactor=reactor)
+        done = sampler.start()
+        os.rmdir(sampler._directory)
+        def check_idle(_):
+            """Checks that another profile may be started."""
+            self.assertEqual(None, sampler.running)
+            return sampler.start()
+        return self.assertFailure(done, IOError).addCallback(check_idle)
+
+    def test_collapse_stack(self):
+        stack = profiler.collapse_stack(sys._getframe())
+        self.assertTrue(stack.endswith(';profiler_test.py:test_collapse_stack'))
+
+    def test_write_stacks(self):
+        path = helper.temp_path(self)
+        profiler.write_stacks(path, {'a.py:f;b.py:g': 3, 'a.py:f': 1})
+        with open(path) as f:
+            self.assertEqual('a.py:f 1\na.py:f;b.py:g 3\n', f.read())
+
+    def test_resource(self):
+        request = requesthelper.DummyRequest([''])
+        request.args = {'mode': ['cprofile'], 'seconds': ['2']}
+        resource = profiler.ProfileResource(self.profiler)
+        self.assertEqual(server.NOT_DONE_YET, resource.render(request))
+        self.clock.advance(2)
+        self.assertEqual(1, request.finished)
+        (path,) = ''.join(request.written).split()
+        self.assertTrue(os.path.exists(path))
+
+    def test_resource_disconnected(self):
+        request = requesthelper.DummyRequest([''])
+        request.args = {'mode': ['cprofile'], 'seconds': ['2']}
+        profiler.ProfileResource(self.profiler).render(request)
+        request.processingFailed(failure.Failure(Exception('Lost')))
+        self.clock.advance(2)
+        self.assertEqual([], request.written)
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+    def test_resource_busy(self):
+        self.profiler.start('cprofile')
+        self.addCleanup(self.clock.advance, 5)
+        request = requesthelper.DummyRequest([''])
+        profiler.ProfileResource(self.profiler).render(request)
+        self.assertEqual(409, request.responseCode)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,183 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import json
+import nose
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test import requesthelper
+
+from mailingset import query
+from mailingset.service import SetSMTPFactory
+
+import helper
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a factory with the test lists and a large list."""
+        test_dir = os.path.dirname(__file__)
+        lists_path = helper.temp_path(self)
+        os.mkdir(lists_path)
+        for name in os.listdir(os.path.join(test_dir, 'lists')):
+            with open(os.path.join(test_dir, 'lists', name)) as source:
+                with open(os.path.join(lists_path, name), 'w') as copy:
+                    copy.write(source.read())
+        with open(os.path.join(lists_path, 'large'), 'w') as list_file:
+            for index in range(1234):
+                list_file.write('m%04d@test.local\n' % (index,))
+        symbols_path = helper.temp_path(self)
+        with open(os.path.join(test_dir, 'symbols.txt')) as source:
+            with open(symbols_path, 'w') as symbols_file:
+                symbols_file.write(source.read() + 'large:L\n')
+
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'lists_dir', lists_path)
+        config.set('data', 'symbols_file', symbols_path)
+        self.factory = SetSMTPFactory(config, None)
+        self.resource = query.QueryResource(self.factory)
+
+    def query(self, **args):
+        """Renders a query.
+
+        Returns:
+            A Deferred firing with a triple (code,body,writes) of the response
+            code, the decoded JSON body and the number of writes made.
+        """
+        request = requesthelper.DummyRequest([''])
+        request.args = dict((key, [value]) for (key, value) in args.items())
+        finished = request.notifyFinish()
+        result = self.resource.render(request)
+        if result != server.NOT_DONE_YET:
+            return defer.succeed(
+                    (request.responseCode, json.loads(result), 1))
+        def done(_):
+            body = ''.join(request.written)
+            return (request.responseCode or 200, json.loads(body),
+                    len(request.written))
+        return finished.addCallback(done)
+
+    @defer.inlineCallbacks
+    def test_query(self):
+        (code, body, _) = yield self.query(expr='named_|_unnamed')
+        self.assertEqual(200, code)
+        self.assertEqual({
+            'count': 3,
+            'domain': 'test.local',
+            'expression': 'named_|_unnamed',
+            'members': ['a@test.local', 'b@test.local', 'c@test.local'],
+            'next': None,
+            'tag': 'N|UN'}, body)
+
+    @defer.inlineCallbacks
+    def test_pages(self):
+        members = []
+        cursor = ''
+        pages = 0
+        while cursor is not None:
+            (code, body, writes) = yield self.query(expr='large', limit='500',
+                                                     cursor=cursor)
+            self.assertEqual(200, code)
+            self.assertEqual(1234, body['count'])
+            members.extend(body['members'])
+            cursor = body['next']
+            pages += 1
+        self.assertEqual(3, pages)
+        self.assertEqual(['m%04d@test.local' % (i,) for i in range(1234)],
+                         members)
+
+    @defer.inlineCallbacks
+    def test_streamed(self):
+        # The opening, a write per chunk of recipients, and the closing
+        (_, body, writes) = yield self.query(expr='large', limit='1234')
+        self.assertEqual(None, body['next'])
+        self.assertEqual(2 + 3, writes)
+
+    @defer.inlineCallbacks
+    def test_not_counted(self):
+        for _ in range(3):
+            yield self.query(expr='named')
+        yield self.query(expr='missing')
+        metrics = self.factory.metrics
+        self.assertEqual(0, metrics.parse_seconds.count())
+        self.assertEqual(0, metrics.hot_hits.value())
+        self.assertEqual(0, metrics.fast_rejected.value())
+        self.assertEqual(0, len(self.factory.hot._hits))
+
+    @defer.inlineCallbacks
+    def test_hot_not_counted(self):
+        self.factory.hot.record('test.local', 'named', 'N',
+                                set(['a@test.local']))
+        hits = dict(self.factory.hot._hits)
+        (code, body, _) = yield self.query(expr='named')
+        self.assertEqual(200, code)
+        self.assertEqual(['a@test.local'], body['members'])
+        self.assertEqual(hits, dict(self.factory.hot._hits))
+        self.assertEqual(0, self.factory.metrics.hot_hits.value())
+
+    @defer.inlineCallbacks
+    def test_empty(self):
+        (code, body, _) = yield self.query(expr='empty')
+        self.assertEqual(200, code)
+        self.assertEqual(0, body['count'])
+        self.assertEqual([], body['members'])
+
+    @defer.inlineCallbacks
+    def test_suppressed(self):
+        self.factory.suppressed.add('b@test.local')
+        (_, body, _) = yield self.query(expr='unnamed')
+        self.assertEqual(['a@test.local'], body['members'])
+
+    @defer.inlineCallbacks
+    def test_invalid(self):
+        (code, body, _) = yield self.query(expr='named_&_missing')
+        self.assertEqual(400, code)
+        self.assertEqual({'error': 'No such list or person: missing'}, body)
+
+    @defer.inlineCallbacks
+    def test_bad_arguments(self):
+        (code, body, _) = yield self.query()
+        self.assertEqual((400, {'error': 'Missing expr'}), (code, body))
+        (code, body, _) = yield self.query(expr='named', limit='0')
+        self.assertEqual(400, code)
+        (code, body, _) = yield self.query(expr='named', limit='x')
+        self.assertEqual(400, code)
+        (code, body, _) = yield self.query(expr='named', limit='10001')
+        self.assertEqual(400, code)
+        (code, body, _) = yield self.query(expr='named', domain='other.local')
+        self.assertEqual((404, {'error': 'Unknown domain: other.local'}),
+                         (code, body))
+
+    def test_page(self):
+        addrs = set('%s@test.local' % (c,) for c in 'edcba')
+        self.assertEqual(['a@test.local', 'b@test.local'],
+                         query.page(addrs, '', 2))
+        self.assertEqual(['c@test.local', 'd@test.local'],
+                         query.page(addrs, 'b@test.local', 2))
+        self.assertEqual([], query.page(addrs, 'e@test.local', 2))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,180 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import nose
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import resource
+from twisted.web import server
+
+from mailingset import resolver
+
+
+class DirectoryResource(resource.Resource):
+    """A stand-in for an HTTP directory service."""
+
+    isLeaf = True
+
+    def __init__(self, entries):
+        """
+        Args:
+            entries: A dict of leaf token to JSON-serializable entry.
+        """
+        resource.Resource.__init__(self)
+        self.entries = entries
+        self.requests = []
+
+    def render_GET(self, request):
+        name = request.postpath[-1]
+        self.requests.append(name)
+        if name == 'broken':
+            request.setResponseCode(500)
+            return 'Oops'
+        if name not in self.entries:
+            request.setResponseCode(404)
+            return 'Not found'
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.entries[name])
+
+
+class CachingResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a caching resolver around one whose lookups the test ends.
+        """
+        self.clock = task.Clock()
+        self.lookups = []
+        def lookup(val):
+            """Starts a lookup which the test finishes."""
+            self.lookups.append((val, defer.Deferred()))
+            return self.lookups[-1][1]
+        self.resolver = resolver.CachingResolver(lookup, ttl=10,
+                max_misses=2, reactor=self.clock)
+
+    def test_single_flight(self):
+        first = self.resolver('dogs')
+        second = self.resolver('Dogs')
+        self.assertEqual(1, len(self.lookups))
+        self.lookups[0][1].callback(('Dog', set(['a@b'])))
+        self.assertEqual(('Dog', set(['a@b'])), self.successResultOf(first))
+        self.assertEqual(('Dog', set(['a@b'])), self.successResultOf(second))
+
+    def test_ttl(self):
+        self.resolver('dogs')
+        self.lookups[0][1].callback(('Dog', set(['a@b'])))
+        self.clock.advance(9)
+        self.successResultOf(self.resolver('dogs'))
+        self.assertEqual(1, len(self.lookups))
+        self.clock.advance(1)
+        self.assertNoResult(self.resolver('dogs'))
+        self.assertEqual(2, len(self.lookups))
+
+    def test_expired_dropped(self):
+        for index in range(100):
+            self.resolver('list%d' % (index,))
+            self.lookups[-1][1].callback(('L', set(['a@b'])))
+        self.assertEqual(100, len(self.resolver._cache))
+        self.clock.advance(5)
+        self.resolver('dogs')
+        self.lookups[-1][1].callback(('Dog', set(['a@b'])))
+        self.clock.advance(5)
+        self.successResultOf(self.resolver('dogs'))
+        self.assertEqual(['dogs'], list(self.resolver._cache))
+        self.clock.advance(5)
+        self.assertNoResult(self.resolver('cats'))
+        self.assertEqual(0, len(self.resolver._cache))
+
+    def test_negative_cache(self):
+        first = self.resolver('cats')
+        self.lookups[0][1].errback(SyntaxError('No such list or person: cats'))
+        self.failureResultOf(first, SyntaxError)
+        self.failureResultOf(self.resolver('cats'), SyntaxError)
+        self.assertEqual(1, len(self.lookups))
+
+    def test_errors_not_cached(self):
+        first = self.resolver('cats')
+        self.lookups[0][1].errback(IOError('Directory is down'))
+        self.failureResultOf(first, IOError)
+        self.assertNoResult(self.resolver('cats'))
+        self.assertEqual(2, len(self.lookups))
+
+    def test_max_misses(self):
+        (cats, birds) = (self.resolver('cats'), self.resolver('birds'))
+        # Lookups in progress count toward the limit
+        self.failureResultOf(self.resolver('fish'), IOError)
+        self.lookups[0][1].errback(SyntaxError('No such list or person: cats'))
+        self.lookups[1][1].callback(('Bird', set(['a@b'])))
+        self.failureResultOf(cats, SyntaxError)
+        self.successResultOf(birds)
+        fish = self.resolver('fish')
+        self.lookups[2][1].errback(SyntaxError('No such list or person: fish'))
+        self.failureResultOf(fish, SyntaxError)
+        self.assertEqual(3, len(self.lookups))
+
+        # Cached leaves are still served while lookups are refused
+        self.failureResultOf(self.resolver('dogs'), IOError)
+        self.successResultOf(self.resolver('birds'))
+        self.failureResultOf(self.resolver('cats'), SyntaxError)
+        self.assertEqual(3, len(self.lookups))
+
+        self.clock.advance(60)
+        self.assertNoResult(self.resolver('dogs'))
+        self.assertEqual(4, len(self.lookups))
+
+    def test_no_max_misses(self):
+        self.resolver.max_misses = 0
+        for name in ('cats', 'birds', 'fish'):
+            missing = self.resolver(name)
+            self.lookups[-1][1].errback(SyntaxError('No such list or person'))
+            self.failureResultOf(missing, SyntaxError)
+        self.assertNoResult(self.resolver('dogs'))
+        self.assertEqual(4, len(self.lookups))
+
+class HTTPDirectoryResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        """Starts a local directory service and a resolver using it."""
+        self.directory = DirectoryResource({
+            'dogs': {'symbol': 'Dog', 'addrs': ['A@example.com',
+                                                'b@example.com']}})
+        port = reactor.listenTCP(0, server.Site(self.directory),
+                interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.resolver = resolver.HTTPDirectoryResolver(
+                'http://127.0.0.1:%d/lists/' % (port.getHost().port,))
+
+    def test_found(self):
+        def check(result):
+            """Checks the decoded entry."""
+            self.assertEqual(('Dog', set(['a@example.com', 'b@example.com'])),
+                    result)
+            self.assertEqual(['dogs'], self.directory.requests)
+        return self.resolver('Dogs').addCallback(check)
+
+    def test_not_found(self):
+        return self.assertFailure(self.resolver('cats'), SyntaxError)
+
+    def test_error(self):
+        return self.assertFailure(self.resolver('broken'), IOError)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
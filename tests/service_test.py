@@ -16,9 +16,11 @@
 
 
 import os
+import shutil
 
 import configparser
 import email
+import json
 import netaddr
 import nose
 import StringIO
@@ -27,13 +29,22 @@ from twisted.internet import address
 from twisted.internet import base
 from twisted.internet import defer
 from twisted.internet import error
+from twisted.internet import reactor
 from twisted.mail import smtp
 from twisted.protocols import loopback
+from twisted.python import log
 from twisted.test import proto_helpers
 from twisted.trial import unittest
+from twisted.web import resource
+from twisted.web import server
+from twisted.web import static
 
+from mailingset import resolver
+from mailingset import service
 from mailingset.service import SetSMTPFactory
 
+import helper
+
 
 # Print traceback at creation for delayed calls that are not cleaned up when a
 # test case finishes
@@ -158,6 +169,201 @@ class MailingSetTest(unittest.TestCase):
 
         return loopback.loopbackTCP(server, client)
 
+    def test_verp(self):
+        """Sends to a list with a separate envelope sender per recipient."""
+        client = self._client_proto('named@test.local')
+        relay = helper.RecordingRelay()
+        port = reactor.listenTCP(0, relay, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.config.set('outgoing', 'server', '127.0.0.1')
+        self.config.set('outgoing', 'port', str(port.getHost().port))
+        self.config.set('outgoing', 'verp', 'true')
+        self.config.set('outgoing', 'verp_concurrency', '1')
+        server = self._server_proto()
+
+        def check_sent(_):
+            """Checks that one connection carried both transactions."""
+            self.assertEqual([
+                    (1, 'mailingset+b=test.local@test.local', 'b@test.local'),
+                    (1, 'mailingset+c=test.local@test.local', 'c@test.local')],
+                    sorted(relay.transactions))
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_sent)
+        return done
+
+    def test_archive_dir(self):
+        """Sends to a list and archives the message locally."""
+        client = self._client_proto('named@test.local')
+        self.config.set('outgoing', 'archive_dir', helper.temp_path(self))
+        server = self._server_proto()
+        archive = server.factory.archive
+        self.addCleanup(server.factory.stopFactory)
+
+        def check_archive(_):
+            """Validates the archived copy of the message."""
+            (entry,) = archive.lookup('named')
+            text = archive.read(entry)
+            self.assertTrue('\nSubject: [Named] subject\n' in text)
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_archive)
+        return done
+
+    def test_metrics(self):
+        """Sends to a list and checks the metrics recorded along the way."""
+        client = self._client_proto('named@test.local')
+        server = self._server_proto()
+        metrics = server.factory.metrics
+
+        def check_metrics(_):
+            """Validates the metrics after the message has been sent."""
+            self.assertEqual(1, metrics.from_total.value('accepted'))
+            self.assertEqual(1, metrics.rcpt_total.value('accepted'))
+            self.assertEqual(1, metrics.parse_seconds.count())
+            self.assertEqual(1, metrics.recipients.count())
+            self.assertEqual(1, metrics.message_bytes.count())
+            self.assertEqual(1, metrics.munge_seconds.count())
+            self.assertEqual(1, metrics.send_seconds.count())
+            self.assertEqual(0, metrics.send_failures.value())
+            self.assertEqual(0, metrics.in_flight.value())
+            rendered = metrics.registry.render()
+            self.assertTrue('mailingset_recipients_bucket{le="10"} 1\n'
+                    in rendered)
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_metrics)
+        return done
+
+    def test_pool(self):
+        """Sends to a list with evaluation and serialization offloaded."""
+        client = self._client_proto('named@test.local')
+        self.config.add_section('pool')
+        self.config.set('pool', 'parse_threshold', '0')
+        self.config.set('pool', 'serialize_threshold', '0')
+        def validate(to_addrs, msg):
+            """Checks the recipients of the message."""
+            self.assertEqual(set(['b@test.local', 'c@test.local']),
+                    set(to_addrs))
+            self.assertEqual('[Named] subject', msg['Subject'])
+        server = self._server_proto(validate)
+        metrics = server.factory.metrics
+
+        def check_metrics(_):
+            """Checks that the message was accepted and sent."""
+            self.assertEqual(1, metrics.rcpt_total.value('accepted'))
+            self.assertEqual(1, metrics.parse_seconds.count())
+            self.assertEqual(1, metrics.send_seconds.count())
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_metrics)
+        return done
+
+    def test_fail_pool(self):
+        """Evaluates an empty expression on the worker pool."""
+        self.config.add_section('pool')
+        self.config.set('pool', 'parse_threshold', '0')
+        server = self._server_proto()
+        parsed = server.factory.parse('named_-_named')
+        self.assertTrue(isinstance(parsed, defer.Deferred))
+        return self.assertFailure(parsed, SyntaxError)
+
+    def test_directory(self):
+        """Resolves a leaf not defined locally with a directory service."""
+        lists = resource.Resource()
+        lists.putChild('dogs', static.Data(json.dumps(
+                {'symbol': 'Dog', 'addrs': ['d@example.com']}),
+                'application/json'))
+        root = resource.Resource()
+        root.putChild('lists', lists)
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.config.set('data', 'directory_url',
+                'http://127.0.0.1:%d/lists/' % (port.getHost().port,))
+        factory = self._server_proto().factory
+
+        def check(parsed):
+            """Checks that local and directory leaves were combined."""
+            expected = set(['b@test.local', 'c@test.local', 'd@example.com'])
+            self.assertEqual(('N|Dog', expected), parsed)
+            return self.assertFailure(factory.parse('named_|_cats'),
+                    SyntaxError)
+        return factory.parse('named_|_dogs').addCallback(check)
+
+    def test_directory_max_misses(self):
+        """Defers recipients once the directory has missed too often."""
+        def lookup(val):
+            """Knows nobody."""
+            raise SyntaxError('No such list or person: %s' % (val,))
+        server = self._server_proto()
+        server.factory.directory = resolver.CachingResolver(lookup,
+                max_misses=1)
+        responses = self._session(server, [
+            'HELO me.test',
+            'MAIL FROM:<sender@test.local>',
+            'RCPT TO:<spam1@test.local>',
+            'RCPT TO:<spam2@test.local>',
+            'RCPT TO:<spam1@test.local>',
+            'RCPT TO:<named@test.local>'])
+        self.assertTrue(responses[2].startswith('550 '))
+        self.assertTrue(responses[3].startswith('451 '))
+        self.assertTrue(responses[4].startswith('550 '))
+        self.assertTrue(responses[5].startswith('250 '))
+        metrics = server.factory.metrics
+        self.assertEqual(1, metrics.rcpt_total.value('directory_failed'))
+
+    def test_log_events(self):
+        """Sends to a list and checks the structured log events."""
+        client = self._client_proto('named@test.local')
+        self.config.add_section('log')
+        self.config.set('log', 'recipients_sample', '1')
+        server = self._server_proto()
+
+        events = {}
+        def observer(event_dict):
+            """Collects log events by the value of their event field."""
+            if 'event' in event_dict:
+                events[event_dict['event']] = event_dict
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+        def check_events(_):
+            """Validates the log events after the message has been sent."""
+            self.assertEqual(2, events['send']['count'])
+            self.assertEqual(set(['b@test.local', 'c@test.local']),
+                    events['recipients']['recipients'])
+            self.assertEqual('named', events['sent']['expression'])
+            self.assertTrue(events['sent']['send_seconds'] >= 0)
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_events)
+        return done
+
+    def test_trace(self):
+        """Sends to a list and checks the trace in the log and archive."""
+        client = self._client_proto('named@test.local')
+        self.config.set('outgoing', 'archive_dir', helper.temp_path(self))
+        self.config.set('outgoing', 'archive_trace_header', 'true')
+        server = self._server_proto()
+        archive = server.factory.archive
+        self.addCleanup(server.factory.stopFactory)
+
+        traces = []
+        def observer(event_dict):
+            """Collects trace log events."""
+            if event_dict.get('event') == 'trace':
+                traces.append(event_dict)
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+        def check_trace(_):
+            """Validates the logged trace and the archived header."""
+            (event,) = traces
+            stages = ['rcpt', 'parsed', 'data', 'received', 'munged',
+                      'serialized', 'sent', 'archived']
+            self.assertEqual(set(stages), set(event['stages']))
+            (entry,) = archive.lookup('named')
+            header = 'X-Mailingset-Trace: %s rcpt=' % (event['trace_id'],)
+            self.assertTrue(header in archive.read(entry))
+        done = loopback.loopbackTCP(server, client)
+        done.addCallback(check_trace)
+        return done
+
     def test_bad_source_ip(self):
         """Attempts connection from address outside the accept_from range.
 
@@ -185,6 +391,412 @@ class MailingSetTest(unittest.TestCase):
         expected = '550 Cannot receive from specified address'
         self.assertTrue(response.startswith(expected))
 
+    def _rcpt(self, server, from_addr, to_addr):
+        """Runs an SMTP interaction up to the RCPT command.
+
+        Args:
+            server: The server protocol, as returned by _server_proto.
+            from_addr: The sender address to give in the MAIL command.
+            to_addr: The recipient address to give in the RCPT command.
+
+        Returns:
+            The server's response to the RCPT command.
+        """
+        addr = address.IPv4Address('TCP', '127.0.0.1', 54321)
+        trans = proto_helpers.StringTransport(peerAddress=addr)
+        server.makeConnection(trans)
+
+        server.dataReceived('HELO me.test\r\n')
+        server.dataReceived('MAIL FROM: %s\r\n' % (from_addr,))
+        trans.clear()
+        server.dataReceived('RCPT TO: %s\r\n' % (to_addr,))
+        response = trans.value()
+
+        # Clean up protocol before doing anything that might raise exception
+        server.connectionLost(error.ConnectionDone())
+        return response
+
+    def test_fast_reject(self):
+        """Sends to an unknown list, which is rejected without full parsing."""
+        server = self._server_proto()
+        response = self._rcpt(server, 'sender@test.local',
+                'named_&_missing@test.local')
+
+        expected = '550 No such list or person: missing'
+        self.assertTrue(response.startswith(expected))
+        metrics = server.factory.metrics
+        self.assertEqual(1, metrics.fast_rejected.value())
+        self.assertEqual(0, metrics.parse_seconds.count())
+        self.assertEqual(1, metrics.rcpt_total.value('invalid'))
+
+    def test_members_only(self):
+        """Checks which senders the members-only policy lets through."""
+        self.config.set('incoming', 'members_only', 'true')
+        accepted = '250 Recipient address accepted'
+        rejected = '550 Sender is not a member'
+        cases = [
+            ('b@test.local', 'named', accepted),
+            ('a@test.local', 'named_|_unnamed', accepted),
+            ('a@test.local', 'named', rejected),
+            ('a@test.local', 'b', accepted),
+            ('sender@test.local', 'b', rejected)]
+        for (from_addr, local, expected) in cases:
+            server = self._server_proto()
+            response = self._rcpt(server, from_addr, local + '@test.local')
+            self.assertTrue(response.startswith(expected),
+                    '%s to %s: %s' % (from_addr, local, response))
+
+    def test_suppressed(self):
+        """Sends to a list with a suppressed member."""
+        client = self._client_proto('named@test.local')
+        self.config.set('data', 'suppression_file', helper.temp_path(self))
+
+        def validate(to_addrs, msg):
+            """Validates that the suppressed member is not a recipient."""
+            self.assertEqual(set(['c@test.local']), to_addrs)
+        server = self._server_proto(validate)
+        server.factory.suppressed.add('b@test.local')
+
+        return loopback.loopbackTCP(server, client)
+
+    def test_fail_all_suppressed(self):
+        """Rejects a set expression whose recipients are all suppressed."""
+        server = self._server_proto()
+        server.factory.suppressed.add('b@test.local')
+        response = self._rcpt(server, 'sender@test.local',
+                'named_&_unnamed@test.local')
+        expected = '550 All recipients are suppressed'
+        self.assertTrue(response.startswith(expected))
+
+    def test_bounce(self):
+        """Receives a bounce at a VERP envelope sender."""
+        server = self._server_proto()
+        addr = address.IPv4Address('TCP', '127.0.0.1', 54321)
+        trans = proto_helpers.StringTransport(peerAddress=addr)
+        server.makeConnection(trans)
+
+        server.dataReceived('HELO me.test\r\n')
+        server.dataReceived('MAIL FROM: <>\r\n')
+        trans.clear()
+        server.dataReceived(
+                'RCPT TO: mailingset+B=test.local@test.local\r\n')
+        response1 = trans.value()
+        server.dataReceived('DATA\r\n')
+        server.dataReceived('Content-Type: message/delivery-status\r\n')
+        server.dataReceived('\r\n')
+        server.dataReceived('Final-Recipient: rfc822; alias@remote.test\r\n')
+        server.dataReceived('Action: failed\r\n')
+        trans.clear()
+        server.dataReceived('.\r\n')
+        response2 = trans.value()
+
+        # Clean up protocol before doing anything that might raise exception
+        server.connectionLost(error.ConnectionDone())
+
+        self.assertEqual(response1, '250 Recipient address accepted\r\n')
+        self.assertEqual(response2, '250 Delivery in progress\r\n')
+        self.assertTrue('b@test.local' in server.factory.suppressed)
+
+    def test_reload(self):
+        """Adds a mailing list and reloads list definitions."""
+        lists_path = helper.temp_path(self)
+        shutil.copytree(self.config.get('data', 'lists_dir'), lists_path)
+        symbols_path = helper.temp_path(self)
+        shutil.copy(self.config.get('data', 'symbols_file'), symbols_path)
+        self.config.set('data', 'lists_dir', lists_path)
+        self.config.set('data', 'symbols_file', symbols_path)
+        factory = self._server_proto().factory
+
+        with open(os.path.join(lists_path, 'added'), 'w') as list_file:
+            list_file.write('d@test.local\n')
+        with open(symbols_path, 'a') as symbols_file:
+            symbols_file.write('added:AD\n')
+
+        self.assertRaises(SyntaxError, factory.parse, 'added')
+        factory.reload()
+        self.assertEqual(('Added', set(['d@test.local'])),
+                factory.parse('added'))
+
+    def test_reload_failure(self):
+        """Keeps the old list definitions if the new ones fail to load."""
+        factory = self._server_proto().factory
+        self.config.set('data', 'symbols_file', helper.temp_path(self))
+        factory.reload()
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual(('Named', set(['b@test.local', 'c@test.local'])),
+                factory.parse('named'))
+
+    def test_hot(self):
+        """Looks up the result of an expression evaluated before."""
+        factory = self._server_proto().factory
+        expected = ('Named', set(['b@test.local', 'c@test.local']))
+        self.assertEqual(expected, factory.parse('named'))
+        self.assertEqual(expected, factory.parse('named'))
+        self.assertEqual(1, factory.metrics.hot_hits.value())
+        self.assertEqual(2, factory.metrics.parse_seconds.count())
+
+        # Suppression still applies to materialized results
+        factory.suppressed.add('b@test.local')
+        self.assertEqual(('Named', set(['c@test.local'])),
+                factory.parse('named'))
+        self.assertEqual(2, factory.metrics.hot_hits.value())
+
+    def test_hot_warmed(self):
+        """Evaluates the hot expressions saved before a restart."""
+        self.config.set('data', 'hot_file', helper.temp_path(self))
+        factory = self._server_proto().factory
+        factory.parse('named_|_unnamed')
+        factory.stopFactory()
+
+        factory = self._server_proto().factory
+        def check(_):
+            self.assertEqual(1, len(factory.hot))
+            self.assertEqual(('N|UN', set(
+                    ['a@test.local', 'b@test.local', 'c@test.local'])),
+                    factory.parse('named_|_unnamed'))
+            self.assertEqual(1, factory.metrics.hot_hits.value())
+        return factory.warm().addCallback(check)
+
+    def test_hot_reload(self):
+        """Re-evaluates hot expressions whose lists changed on reload."""
+        lists_path = helper.temp_path(self)
+        shutil.copytree(self.config.get('data', 'lists_dir'), lists_path)
+        self.config.set('data', 'lists_dir', lists_path)
+        factory = self._server_proto().factory
+        factory.parse('named')
+        factory.parse('unnamed')
+
+        with open(os.path.join(lists_path, 'named'), 'a') as list_file:
+            list_file.write('d@test.local\n')
+        def check(_):
+            self.assertEqual(2, len(factory.hot))
+            self.assertEqual(('Named', set(
+                    ['b@test.local', 'c@test.local', 'd@test.local'])),
+                    factory.parse('named'))
+            self.assertEqual(('Unnamed', set(['a@test.local', 'b@test.local'])),
+                    factory.parse('unnamed'))
+            self.assertEqual(2, factory.metrics.hot_hits.value())
+        return factory.reload().addCallback(check)
+
+    def _add_domain(self, domain, lists):
+        """Configures an additional domain served alongside test.local.
+
+        Args:
+            domain: The domain.
+            lists: A dict of list name to pair (symbol,lines) of the symbol of
+                the list and the lines of its list file.
+        """
+        lists_path = helper.temp_path(self)
+        os.mkdir(lists_path)
+        symbols_path = helper.temp_path(self)
+        with open(symbols_path, 'w') as symbols_file:
+            for (listname, (symbol, lines)) in lists.items():
+                symbols_file.write('%s:%s\n' % (listname, symbol))
+                with open(os.path.join(lists_path, listname), 'w') as list_file:
+                    list_file.writelines(line + '\n' for line in lines)
+        section = 'domain ' + domain
+        self.config.add_section(section)
+        self.config.set(section, 'lists_dir', lists_path)
+        self.config.set(section, 'symbols_file', symbols_path)
+
+    def test_domains(self):
+        """Routes each recipient domain to the lists of that domain."""
+        self._add_domain('other.local', {
+                'team': ('T', ['Yy Zz <b@test.local>', 'e@other.local'])})
+        accepted = '250 Recipient address accepted'
+        cases = [
+            ('named@test.local', accepted),
+            ('team@other.local', accepted),
+            ('team@Other.Local', accepted),
+            ('zz@other.local', accepted),
+            ('team@test.local', '550 No such list or person: team'),
+            ('named@other.local', '550 No such list or person: named'),
+            ('named@elsewhere.local', '550 Incorrect domain')]
+        for (to_addr, expected) in cases:
+            server = self._server_proto()
+            response = self._rcpt(server, 'sender@test.local', to_addr)
+            self.assertTrue(response.startswith(expected),
+                    '%s: %s' % (to_addr, response))
+
+    def test_domains_shared(self):
+        """Stores an address that is a member in two domains once."""
+        self._add_domain('other.local', {
+                'team': ('T', ['Yy Zz <b@test.local>', 'e@other.local'])})
+        factory = self._server_proto().factory
+        self.assertEqual(set(['test.local', 'other.local']),
+                set(factory.states))
+        (_, named) = factory.parse('named')
+        (tag, team) = factory.parse('team', 'other.local')
+        self.assertEqual('Team', tag)
+        self.assertEqual(set(['b@test.local', 'e@other.local']), team)
+        shared = [addr for addr in named if addr == 'b@test.local']
+        self.assertTrue(any(addr is shared[0] for addr in team))
+
+    def test_domains_headers(self):
+        """Sets the List-* headers to the domain the message was sent to."""
+        self._add_domain('other.local', {'team': ('T', ['e@other.local'])})
+        client = self._client_proto('team@other.local')
+
+        def validate(to_addrs, msg):
+            """Validates the recipients and headers."""
+            self.assertEqual(set(['e@other.local']), to_addrs)
+            self.assertEqual('[Team] subject', msg['Subject'])
+            self.assertEqual('<team.mailingset.other.local>', msg['List-Id'])
+            self.assertEqual('<mailto:team@other.local>', msg['List-Post'])
+        server = self._server_proto(validate)
+
+        return loopback.loopbackTCP(server, client)
+
+    def test_domains_reload(self):
+        """Reloads the list definitions of every domain together."""
+        self._add_domain('other.local', {'team': ('T', ['e@other.local'])})
+        factory = self._server_proto().factory
+        states = factory.states
+        factory.reload()
+        self.assertFalse(factory.states['other.local'] is states['other.local'])
+        self.assertEqual(('Team', set(['e@other.local'])),
+                factory.parse('team', 'other.local'))
+
+    def _session(self, server, lines):
+        """Sends SMTP commands to a server and collects its responses.
+
+        Args:
+            server: The server protocol, as returned by _server_proto.
+            lines: The lines to send, without line endings.
+
+        Returns:
+            A list of the server's response to each line.
+        """
+        addr = address.IPv4Address('TCP', '127.0.0.1', 54321)
+        trans = proto_helpers.StringTransport(peerAddress=addr)
+        server.makeConnection(trans)
+
+        responses = []
+        for line in lines:
+            trans.clear()
+            server.dataReceived(line + '\r\n')
+            responses.append(trans.value())
+
+        # Clean up protocol before doing anything that might raise exception
+        server.connectionLost(error.ConnectionDone())
+        return responses
+
+    def test_size_advertised(self):
+        """Advertises the size limit in the reply to EHLO."""
+        # Without a limit, SIZE is advertised without one
+        (ehlo,) = self._session(self._server_proto(), ['EHLO me.test'])
+        self.assertTrue('-SIZE\r\n' in ehlo or ' SIZE\r\n' in ehlo)
+
+        self.config.set('incoming', 'max_size', '1000')
+        (ehlo,) = self._session(self._server_proto(), ['EHLO me.test'])
+        self.assertTrue('-SIZE 1000\r\n' in ehlo or ' SIZE 1000\r\n' in ehlo)
+
+    def test_size_declared(self):
+        """Rejects a declared size over the limit at the MAIL command."""
+        self.config.set('incoming', 'max_size', '1000')
+        server = self._server_proto()
+        responses = self._session(server, [
+            'EHLO me.test',
+            'MAIL FROM:<sender@test.local> SIZE=1001',
+            'MAIL FROM:<sender@test.local> SIZE=big',
+            'MAIL FROM:<sender@test.local> SIZE=1000',
+            'RCPT TO:<named@test.local>'])
+        self.assertTrue(responses[1].startswith('552 '))
+        self.assertTrue(responses[2].startswith('501 '))
+        self.assertTrue(responses[3].startswith('250 '))
+        self.assertTrue(responses[4].startswith('250 '))
+        self.assertEqual(1, server.factory.metrics.too_large.value('mail'))
+
+    def test_size_per_list(self):
+        """Rejects a declared size over the limit of a list at RCPT."""
+        self.config.add_section('list_max_size')
+        self.config.set('list_max_size', 'Named', '100')
+        server = self._server_proto()
+        responses = self._session(server, [
+            'EHLO me.test',
+            'MAIL FROM:<sender@test.local> SIZE=500',
+            'RCPT TO:<unnamed@test.local>',
+            'RCPT TO:<named_|_unnamed@test.local>'])
+        self.assertTrue(responses[2].startswith('250 '))
+        self.assertTrue(responses[3].startswith('552 '))
+        metrics = server.factory.metrics
+        self.assertEqual(1, metrics.too_large.value('rcpt'))
+        self.assertEqual(1, metrics.rcpt_total.value('too_large'))
+
+    def test_size_limit(self):
+        """Computes the size limit of set expressions."""
+        factory = self._server_proto().factory
+        self.assertEqual(0, factory.size_limit('named', 2))
+
+        self.config.set('incoming', 'max_size', '1000')
+        self.config.set('incoming', 'max_fanout_bytes', '1200')
+        self.config.add_section('list_max_size')
+        self.config.set('list_max_size', 'unnamed', '500')
+        factory = self._server_proto().factory
+        self.assertEqual(1000, factory.size_limit('named', 1))
+        self.assertEqual(600, factory.size_limit('named', 2))
+        self.assertEqual(500, factory.size_limit('named_|_unnamed', 2))
+        self.assertEqual(1, factory.size_limit('named', 10000))
+
+    def test_size_limit_domains(self):
+        """Applies the size limits of lists in the domain addressed."""
+        self._add_domain('other.local', {'named': ('N', ['e@other.local'])})
+        self.config.add_section('list_max_size')
+        self.config.set('list_max_size', 'named', '500')
+        self.config.add_section('list_max_size other.local')
+        self.config.set('list_max_size other.local', 'named', '300')
+        factory = self._server_proto().factory
+        self.assertEqual(500, factory.size_limit('named', 1))
+        self.assertEqual(500, factory.size_limit('named', 1, 'test.local'))
+        self.assertEqual(300, factory.size_limit('named', 1, 'Other.local'))
+
+    def test_size_limit_unknown_domain(self):
+        """Refuses size limits for a domain that is not served."""
+        self.config.add_section('list_max_size other.local')
+        expected = '[list_max_size other.local] names a domain not served'
+        with helper.AssertFail(self, RuntimeError, expected):
+            self._server_proto()
+
+    def test_size_data(self):
+        """Disconnects a client once its data exceeds the limit."""
+        self.config.set('incoming', 'max_size', '100')
+        sent = []
+        server = self._server_proto(lambda to_addrs, msg: sent.append(msg))
+        responses = self._session(server, [
+            'HELO me.test',
+            'MAIL FROM: sender@test.local',
+            'RCPT TO: named@test.local',
+            'DATA',
+            'Subject: large',
+            '',
+            'x' * 100])
+        self.assertEqual('', responses[5])
+        self.assertTrue(responses[6].startswith('552 '))
+        self.assertTrue(server.transport.disconnecting)
+        self.assertEqual([], sent)
+        metrics = server.factory.metrics
+        self.assertEqual(1, metrics.too_large.value('data'))
+        self.assertEqual(0, metrics.in_flight.value())
+
+    def test_failed_before_send(self):
+        """Stops counting a message as in flight if it fails before sending."""
+        def fail(message, msg):
+            raise ValueError('Bad header')
+        self.patch(service.SetMessage, '_munge_header', fail)
+        server = self._server_proto()
+        responses = self._session(server, [
+            'HELO me.test',
+            'MAIL FROM: sender@test.local',
+            'RCPT TO: named@test.local',
+            'DATA',
+            'Subject: subject',
+            '',
+            'body',
+            '.'])
+        self.assertTrue(responses[7].startswith('550 '))
+        self.assertEqual(0, server.factory.metrics.in_flight.value())
+        self.flushLoggedErrors(ValueError)
+
     def test_longhand(self):
         """Executes hard-coded SMTP interaction to check every server response.
         """
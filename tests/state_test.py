@@ -16,11 +16,13 @@
 
 
 import configparser
+import gzip
 import nose
 import os
 
 from twisted.trial import unittest
 
+from mailingset import state as state_module
 from mailingset.state import MailingSetState
 
 import helper
@@ -89,6 +91,42 @@ class StateTest(unittest.TestCase):
         expected = ('UN', set(['a@test.local', 'b@test.local']))
         self.assertEqual(expected, self.state('unnamed'))
 
+    def test_memberships(self):
+        expected = (frozenset(['named', 'unnamed']),
+                    frozenset(['named', 'nested', 'unnamed']))
+        self.assertEqual(expected, self.state.memberships('B@test.local'))
+
+    def test_memberships_nested_list(self):
+        expected = (frozenset(['nested']), frozenset())
+        self.assertEqual(expected, self.state.memberships('named@test.local'))
+
+    def test_memberships_missing(self):
+        expected = (frozenset(), frozenset())
+        self.assertEqual(expected, self.state.memberships('x@test.local'))
+
+    def test_is_list(self):
+        self.assertTrue(self.state.is_list('Nested'))
+        self.assertFalse(self.state.is_list('b'))
+
+    def test_prefilter(self):
+        # Ambiguous identifiers are let through to be rejected by __call__
+        self.state.prefilter(['Named', 'yy.zz', 'b', 'yy'])
+
+    def test_knows(self):
+        self.assertTrue(self.state.knows('Named'))
+        self.assertTrue(self.state.knows('yy'))
+        self.assertFalse(self.state.knows('missing'))
+
+    def test_upper_bound(self):
+        # Lists count their recipients, individuals one, and unknowns nothing
+        self.assertEqual(2 + 3 + 1, self.state.upper_bound(
+                ['named', 'Nested', 'yy.zz', 'missing']))
+
+    def test_fail_prefilter(self):
+        expected = 'No such list or person: missing'
+        with helper.AssertFail(self, SyntaxError, expected):
+            self.state.prefilter(['named', 'Missing', 'b'])
+
     def test_fail_missing(self):
         expected = 'No such list or person: missing'
         with helper.AssertFail(self, SyntaxError, expected):
@@ -100,5 +138,214 @@ class StateTest(unittest.TestCase):
             self.state('yy')
 
 
+class ParallelLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        """Writes a directory of many lists to load."""
+        self.dir = helper.temp_path(self)
+        os.mkdir(self.dir)
+        lists_path = os.path.join(self.dir, 'lists')
+        os.mkdir(lists_path)
+        symbols_path = os.path.join(self.dir, 'symbols.txt')
+        with open(symbols_path, 'w') as symbols_file:
+            for index in range(50):
+                listname = 'list%d' % index
+                symbols_file.write('%s:L%d\n' % (listname, index))
+                with open(os.path.join(lists_path, listname), 'w') as list_file:
+                    for member in range(index % 7, 60, 3):
+                        list_file.write('First%d Last%d <p%d@test.local>\n'
+                                        % (member, member % 5, member))
+                    if index >= 10:
+                        list_file.write('list%d@test.local\n' % (index // 10))
+
+        self.config = configparser.ConfigParser()
+        self.config.add_section('incoming')
+        self.config.set('incoming', 'domain', 'test.local')
+        self.config.add_section('data')
+        self.config.set('data', 'lists_dir', lists_path)
+        self.config.set('data', 'symbols_file', symbols_path)
+
+    def load(self, threads):
+        self.config.set('data', 'load_threads', str(threads))
+        return MailingSetState(self.config).components()
+
+    def test_same_as_sequential(self):
+        expected = self.load(1)
+        self.assertEqual(50, len(expected['lists']))
+        for threads in (2, 8, 100):
+            self.assertEqual(expected, self.load(threads))
+
+    def test_default_sequential(self):
+        expected = MailingSetState(self.config).components()
+        self.assertEqual(expected, self.load(1))
+
+    def test_fail_read(self):
+        # A list file that disappears while loading fails the load from any
+        # of the threads
+        class RacingState(MailingSetState):
+            def _list_lists(self):
+                return MailingSetState._list_lists(self) | set(['deleted'])
+        self.config.set('data', 'load_threads', '4')
+        self.assertRaises(IOError, RacingState, self.config)
+
+    def test_section_threads(self):
+        # A domain section may set its own number of threads, and otherwise
+        # uses the one in the data section
+        self.config.add_section('domain other.local')
+        for option in ('lists_dir', 'symbols_file'):
+            self.config.set('domain other.local', option,
+                    self.config.get('data', option))
+        self.config.set('data', 'load_threads', '3')
+        state = MailingSetState(self.config, 'domain other.local')
+        self.assertEqual(3, state._load_threads)
+        self.config.set('domain other.local', 'load_threads', '5')
+        state = MailingSetState(self.config, 'domain other.local')
+        self.assertEqual(5, state._load_threads)
+
+    def test_fail_threads(self):
+        expected = 'load_threads must be at least 1'
+        with helper.AssertFail(self, RuntimeError, expected):
+            self.load(0)
+
+
+class MembersFileTest(unittest.TestCase):
+
+    CSV = (
+        'list,name,address\n'
+        'empty,,\n'
+        'named,Yy Zz,b@test.local\n'
+        'named,"Ww Xx Yy",c@test.local\n'
+        'nested,,named@test.local\n'
+        'nested,,unnamed@test.local\n'
+        'unnamed,,a@test.local\n'
+        '\n'
+        'unnamed,,b@test.local\n')
+
+    JSONL = (
+        '{"list": "empty", "address": ""}\n'
+        '{"list": "named", "name": "Yy Zz", "address": "b@test.local"}\n'
+        '{"list": "named", "name": "Ww Xx Yy", "address": "c@test.local"}\n'
+        '{"list": "nested", "address": "named@test.local"}\n'
+        '{"list": "nested", "address": "unnamed@test.local"}\n'
+        '{"list": "unnamed", "name": null, "address": "a@test.local"}\n'
+        '{"list": "unnamed", "address": "b@test.local"}\n')
+
+    def setUp(self):
+        """Loads the reference state from the list directory."""
+        self.test_dir = os.path.dirname(__file__)
+        self.expected = MailingSetState(self._config(
+                lists_dir=os.path.join(self.test_dir, 'lists')))
+        self.dir = helper.temp_path(self)
+        os.mkdir(self.dir)
+
+    def _config(self, **data):
+        """Builds a config with the test symbols and the given data entries."""
+        config = configparser.ConfigParser()
+        config.add_section('incoming')
+        config.set('incoming', 'domain', 'test.local')
+        config.add_section('data')
+        config.set('data', 'symbols_file',
+                   os.path.join(self.test_dir, 'symbols.txt'))
+        for (key, value) in data.items():
+            config.set('data', key, value)
+        return config
+
+    def _load(self, filename, content, **data):
+        """Writes a membership file and loads the state from it."""
+        path = os.path.join(self.dir, filename)
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(path, 'wb') as members_file:
+            members_file.write(content)
+        return MailingSetState(self._config(members_file=path, **data))
+
+    def _path(self, extension):
+        """Absolute path of the membership file with the given extension."""
+        return os.path.abspath(os.path.join(self.dir, 'members.' + extension))
+
+    def assertSameState(self, state):
+        self.assertEqual(self.expected._lists, state._lists)
+        self.assertEqual(self.expected._aliases, state._aliases)
+        self.assertEqual(self.expected._symbols, state._symbols)
+
+    def test_csv(self):
+        self.assertSameState(self._load('members.csv', self.CSV))
+
+    def test_csv_without_header(self):
+        content = self.CSV.split('\n', 1)[1]
+        self.assertSameState(self._load('members.csv', content))
+
+    def test_csv_gz(self):
+        self.assertSameState(self._load('members.csv.gz', self.CSV))
+
+    def test_jsonl(self):
+        self.assertSameState(self._load('members.jsonl', self.JSONL))
+
+    def test_jsonl_at_once(self):
+        # A well-formed file is not decoded line by line
+        def scan(members_file, path):
+            raise AssertionError('Decoded line by line')
+        self.patch(state_module, '_scan_jsonl', scan)
+        self.assertSameState(self._load('members.jsonl', self.JSONL))
+
+    def test_jsonl_blank_line(self):
+        content = self.JSONL.replace('\n', '\n\n  \n', 1)
+        self.assertSameState(self._load('members.jsonl', content))
+
+    def test_jsonl_gz(self):
+        self.assertSameState(self._load('members.jsonl.gz', self.JSONL))
+
+    def test_address_line(self):
+        # An address column in list file format is split the same way
+        content = self.CSV.replace('named,Yy Zz,b@test.local',
+                                   'named,,Yy Zz <B@test.local>')
+        self.assertSameState(self._load('members.csv', content))
+
+    def test_address_line_named(self):
+        # The name column replaces a name in the address column
+        content = self.CSV.replace('named,Yy Zz,b@test.local',
+                                   'named,Yy Zz,Bb <B@test.local>')
+        self.assertSameState(self._load('members.csv', content))
+
+    def test_with_lists_dir(self):
+        # Lists split between both places are merged
+        lists_path = os.path.join(self.dir, 'lists')
+        os.mkdir(lists_path)
+        for name in ('empty', 'unnamed'):
+            with open(os.path.join(lists_path, name), 'w') as list_file:
+                list_file.write('a@test.local\n' if name == 'unnamed' else '')
+        content = '\n'.join(line for line in self.CSV.split('\n')
+                            if not line.startswith(('empty,',
+                                                    'unnamed,,a@')))
+        state = self._load('members.csv', content, lists_dir=lists_path)
+        self.assertSameState(state)
+
+    def test_fail_malformed_csv(self):
+        content = self.CSV + 'named,b@test.local\n'
+        expected = 'Malformed line 10 in members file: ' + self._path('csv')
+        with helper.AssertFail(self, RuntimeError, expected):
+            self._load('members.csv', content)
+
+    def test_fail_malformed_jsonl(self):
+        content = self.JSONL + '{"list": "named"}\n'
+        expected = 'Malformed line 8 in members file: ' + self._path('jsonl')
+        with helper.AssertFail(self, RuntimeError, expected):
+            self._load('members.jsonl', content)
+
+    def test_fail_jsonl_type(self):
+        for row in ('{"list": 5, "address": "a@test.local"}',
+                    '{"list": "named", "name": 5, "address": "a@test.local"}',
+                    '{"list": "named", "address": ["a@test.local"]}',
+                    '["named", "", "a@test.local"]'):
+            expected = ('Malformed line 8 in members file: ' +
+                        self._path('jsonl'))
+            with helper.AssertFail(self, RuntimeError, expected):
+                self._load('members.jsonl', self.JSONL + row + '\n')
+
+    def test_fail_extension(self):
+        expected = 'Unknown format of members file: ' + self._path('txt')
+        with helper.AssertFail(self, RuntimeError, expected):
+            self._load('members.txt', self.CSV)
+
+
 if __name__ == '__main__':
     nose.run(argv=['', __file__])
@@ -0,0 +1,132 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import email
+import email.message
+import itertools
+import nose
+
+from email.header import Header
+from twisted.trial import unittest
+
+from mailingset import subject
+from mailingset.mailman import subject_prefix
+
+
+# Pieces combined into the corpus of subjects
+REPLIES = ['', 'Re: ', 'RE: ', 're:', 'Re:  ', 'Fwd: ', 'AW: ', 'Re[2]: ',
+           'Re: Re: ', 'SV:']
+TAGS = ['', '[nest] ', '[nest]', '[Named] ', ' [nest] ', '[N|Dog] ',
+        '[list 7] ']
+TEXTS = [
+    'Dinner on Friday',
+    '',
+    ' ',
+    'Re: the meeting',
+    'Status update for the quarterly planning meeting on Thursday afternoon',
+    'x' * 60,
+    'y' * 66,
+    'z ' * 36,
+    'A subject which is long enough that the header will certainly be '
+    'folded across more than one line when it is encoded',
+    'Folded subject\n continued',
+    'Folded subject\n\tcontinued with a tab',
+    'Caf\xc3\xa9 in raw UTF-8',
+    '=?utf-8?q?Caf=C3=A9_on_Friday?=',
+    '=?utf-8?b?Q2Fmw6kgb24gRnJpZGF5?=',
+    '=?UTF-8?Q?Caf=C3=A9?= =?UTF-8?Q?_=E2=98=95?=',
+    '=?iso-8859-1?q?Caf=E9?= and =?utf-8?q?cr=C3=A8me_br=C3=BBl=C3=A9e?=',
+    'Plain =?iso-8859-1?q?Caf=E9?= plain',
+    '=?us-ascii?q?hello_world?=',
+    '=?utf-8?q?[nest]_d=C3=A9j=C3=A0_vu?=',
+    '=?bogus?q?unknown_charset?=',
+    'Price =? unknown',
+    '100% done',
+    'tab\there',
+    '[nest] twice [nest]',
+]
+# Lengths around where Header starts folding
+TEXTS.extend(('ab ' * 30)[:length] for length in range(70, 80))
+PREFIXES = ['[nest] ', '[N|Dog] ', '[a&{b-c}] ', '[list %d] ', ' ']
+
+
+def corpus():
+    """Yields every subject in the corpus."""
+    for (reply, tag, text) in itertools.product(REPLIES, TAGS, TEXTS):
+        yield reply + tag + text
+        yield tag + reply + text
+
+
+def tagged(process, prefix, subject_value):
+    """Tags a message and serializes it, or gives the type of error raised."""
+    msg = email.message.Message()
+    msg['Subject'] = subject_value
+    msg['From'] = 'a@test.local'
+    msg.set_payload('body\n')
+    try:
+        process(prefix, msg)
+        return msg.as_string()
+    except Exception as e:
+        return type(e)
+
+
+class SubjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tagger = subject.SubjectTagger()
+        self.mailman = subject_prefix.SubjectPrefix()
+
+    def assertSame(self, prefix, subject_value):
+        expected = tagged(self.mailman.process, prefix, subject_value)
+        actual = tagged(self.tagger.process, prefix, subject_value)
+        self.assertEqual(expected, actual, 'Differs for %r with %r' % (
+            subject_value, prefix))
+
+    def test_corpus(self):
+        count = 0
+        for subject_value in corpus():
+            for prefix in PREFIXES:
+                self.assertSame(prefix, subject_value)
+                count += 1
+        self.assertTrue(count > 10000)
+
+    def test_header(self):
+        for text in ['Dinner', 'Caf\xc3\xa9', 'x' * 100]:
+            self.assertSame('[nest] ', Header(text, 'utf-8'))
+            self.assertSame('[nest] ', Header('[nest] ' + text, 'utf-8'))
+
+    def test_plain(self):
+        msg = email.message_from_string('Subject: Re: Dinner\n\nbody\n')
+        self.tagger.process('[nest] ', msg)
+        self.assertEqual('[nest] Re: Dinner', str(msg['Subject']))
+
+    def test_already_tagged(self):
+        msg = email.message_from_string('Subject: [nest] Dinner\n\nbody\n')
+        self.tagger.process('[nest] ', msg)
+        self.assertEqual('[nest] Dinner', str(msg['Subject']))
+
+    def test_cache(self):
+        self.tagger.CACHE_SIZE = 2
+        for prefix in ['[a] ', '[b] ', '[a] ', '[c] ']:
+            msg = email.message_from_string('Subject: Dinner\n\nbody\n')
+            self.tagger.process(prefix, msg)
+            self.assertEqual(prefix + 'Dinner', str(msg['Subject']))
+        self.assertEqual(['[c] '], list(self.tagger._patterns))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,170 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from mailingset.suppression import SuppressionList
+
+import helper
+
+
+class SuppressionTest(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a suppression list backed by a fresh journal file."""
+        self.path = helper.temp_path(self)
+        self.clock = task.Clock()
+        self.suppressed = self._open()
+
+    def _open(self):
+        """Opens the journal file in self.path, driven by self.clock."""
+        return SuppressionList(self.path, reactor=self.clock)
+
+    def test_add(self):
+        self.suppressed.add('A@test.local')
+        self.assertTrue('a@test.local' in self.suppressed)
+        self.assertEqual(1, len(self.suppressed))
+
+    def test_discard(self):
+        self.suppressed.add('a@test.local')
+        self.suppressed.discard('a@test.local')
+        self.suppressed.discard('b@test.local')
+        self.assertFalse('a@test.local' in self.suppressed)
+        self.assertEqual(0, len(self.suppressed))
+
+    def test_subtract(self):
+        self.suppressed.add('b@test.local')
+        addrs = set(['a@test.local', 'b@test.local'])
+        self.assertEqual(set(['a@test.local']), self.suppressed.subtract(addrs))
+
+    def test_persisted(self):
+        self.suppressed.add('a@test.local')
+        self.suppressed.add('b@test.local')
+        self.suppressed.discard('a@test.local')
+        reopened = self._open()
+        self.assertEqual(set(['a@test.local']),
+                reopened.subtract(set(['a@test.local', 'b@test.local'])))
+
+    def test_bounce(self):
+        other = self._open()
+        self.assertEqual(1, self.suppressed.bounce('A@test.local'))
+        self.assertEqual(2, other.bounce('a@test.local'))
+        self.assertEqual(1, other.bounce('b@test.local'))
+        self.clock.advance(1)
+        self.assertEqual({'a@test.local': 2, 'b@test.local': 1},
+                         self.suppressed.bounces())
+
+        # Suppressing an address, or no longer suppressing it, resets its count
+        self.suppressed.add('a@test.local')
+        self.assertEqual({'b@test.local': 1}, self.suppressed.bounces())
+        self.suppressed.discard('a@test.local')
+        self.assertEqual(1, self.suppressed.bounce('a@test.local'))
+
+    def test_external_append(self):
+        with open(self.path, 'a') as journal:
+            journal.write('+a@test.local\nB@test.local\n+c@test')
+        self.clock.advance(1)
+        self.assertTrue('a@test.local' in self.suppressed)
+        self.assertTrue('b@test.local' in self.suppressed)
+
+        # The partial line is applied once it is complete
+        self.assertFalse('c@test.local' in self.suppressed)
+        with open(self.path, 'a') as journal:
+            journal.write('.local\n-a@test.local\n')
+        self.clock.advance(1)
+        self.assertTrue('c@test.local' in self.suppressed)
+        self.assertFalse('a@test.local' in self.suppressed)
+
+    def test_rewritten(self):
+        self.suppressed.add('a@test.local')
+        self.suppressed.add('b@test.local')
+        with open(self.path, 'w') as journal:
+            journal.write('c@test.local\n')
+        self.clock.advance(1)
+        self.assertEqual(set(['a@test.local', 'b@test.local']),
+                self.suppressed.subtract(set(['a@test.local', 'b@test.local'])))
+
+    def test_interval(self):
+        self.assertFalse('a@test.local' in self.suppressed)
+        with open(self.path, 'a') as journal:
+            journal.write('a@test.local\n')
+        self.assertFalse('a@test.local' in self.suppressed)
+        self.clock.advance(0.5)
+        self.assertFalse('a@test.local' in self.suppressed)
+        self.clock.advance(0.5)
+        self.assertTrue('a@test.local' in self.suppressed)
+
+    def test_replaced(self):
+        self.suppressed.add('a@test.local')
+        other = helper.temp_path(self)
+        with open(other, 'w') as journal:
+            journal.write('+b@test.local\n+c@test.local\n')
+        os.rename(other, self.path)
+        self.clock.advance(1)
+        self.assertEqual(set(['a@test.local']), self.suppressed.subtract(
+                set(['a@test.local', 'b@test.local', 'c@test.local'])))
+
+    def test_compact(self):
+        self.patch(SuppressionList, 'COMPACT_MIN', 10)
+        for _ in range(4):
+            self.suppressed.add('a@test.local')
+            self.suppressed.discard('a@test.local')
+        self.suppressed.add('c@test.local')
+        with open(self.path) as journal:
+            self.assertEqual(9, len(journal.readlines()))
+
+        # The line that reaches the limit compacts the journal
+        self.suppressed.add('d@test.local')
+        with open(self.path) as journal:
+            self.assertEqual('+c@test.local\n+d@test.local\n', journal.read())
+        self.assertEqual(2, len(self._open()))
+
+    def test_compact_bounces(self):
+        for _ in range(2):
+            self.suppressed.bounce('a@test.local')
+            self.suppressed.bounce('b@test.local')
+        self.suppressed.add('a@test.local')
+        self.suppressed.compact()
+        with open(self.path) as journal:
+            self.assertEqual('+a@test.local\n!b@test.local\n!b@test.local\n',
+                             journal.read())
+        self.assertEqual({'b@test.local': 2}, self._open().bounces())
+
+    def test_compact_appended(self):
+        self.suppressed.add('a@test.local')
+        other = self._open()
+        with open(self.path, 'a') as journal:
+            journal.write('+b@test.local\n')
+        other.compact()
+        self.clock.advance(1)
+        self.assertEqual(2, len(self.suppressed))
+        self.assertEqual(2, len(other))
+
+    def test_in_memory(self):
+        suppressed = SuppressionList()
+        suppressed.add('a@test.local')
+        self.assertTrue('a@test.local' in suppressed)
+        suppressed.discard('a@test.local')
+        self.assertFalse('a@test.local' in suppressed)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
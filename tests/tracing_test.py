@@ -0,0 +1,68 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+
+from twisted.python import log
+from twisted.trial import unittest
+
+from mailingset import tracing
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        """Starts a trace whose clock advances only when told to."""
+        self.now = 10.0
+        self.trace = tracing.Trace('0123456789abcdef', 'a_&_b',
+                clock=lambda: self.now)
+
+    def test_new_id(self):
+        trace_id = tracing.new_id()
+        self.assertEqual(16, len(trace_id))
+        self.assertNotEqual(trace_id, tracing.new_id())
+
+    def test_mark(self):
+        self.assertEqual(0, self.trace.mark('rcpt'))
+        self.now += 0.25
+        self.assertEqual(0.25, self.trace.mark('parsed'))
+        self.assertEqual([('rcpt', 0), ('parsed', 0.25)], self.trace.stages)
+
+    def test_header(self):
+        self.trace.mark('rcpt')
+        self.now += 1.5
+        self.trace.mark('sent')
+        self.assertEqual('0123456789abcdef rcpt=0.000 sent=1.500',
+                self.trace.header())
+
+    def test_emit(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+
+        self.trace.mark('rcpt')
+        self.trace.emit(message_id='<1@test>')
+        (event,) = [e for e in events if e.get('event') == 'trace']
+        self.assertEqual('0123456789abcdef', event['trace_id'])
+        self.assertEqual('<1@test>', event['message_id'])
+        self.assertEqual({'rcpt': 0}, event['stages'])
+        self.assertEqual('Trace 0123456789abcdef a_&_b: rcpt=0.000',
+                log.textFromEventDict(event))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,109 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.trial import unittest
+
+from mailingset import verp
+
+import helper
+
+
+class VerpTest(unittest.TestCase):
+
+    def test_encode(self):
+        result = verp.encode('mailingset@test.local', 'a@remote.test')
+        self.assertEqual('mailingset+a=remote.test@test.local', result)
+
+    def test_decode(self):
+        result = verp.decode('mailingset@test.local',
+                'MailingSet+A=Remote.test@test.local')
+        self.assertEqual('a@remote.test', result)
+
+    def test_round_trip(self):
+        sender = 'mailingset@test.local'
+        for recipient in ['a=b@remote.test', 'a+b@remote.test']:
+            encoded = verp.encode(sender, recipient)
+            self.assertEqual(recipient, verp.decode(sender, encoded))
+
+    def test_decode_not_verp(self):
+        sender = 'mailingset@test.local'
+        for address in ['mailingset@test.local',
+                        'mailingset+a=remote.test@other.local',
+                        'other+a=remote.test@test.local',
+                        'mailingset+remote.test@test.local',
+                        'mailingset+=remote.test@test.local',
+                        'mailingset+a=@test.local',
+                        'no-domain']:
+            self.assertEqual(None, verp.decode(sender, address))
+
+    def _listen(self, relay):
+        """Starts a relay on a free port, stopping it after the test.
+
+        Returns:
+            The port number.
+        """
+        port = reactor.listenTCP(0, relay, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    @defer.inlineCallbacks
+    def test_send(self):
+        relay = helper.RecordingRelay()
+        relay.rejected.add('c@remote.test')
+        port = self._listen(relay)
+        recipients = set('%s@remote.test' % (user,) for user in 'abcde')
+        failed = []
+        sent = yield verp.send('127.0.0.1', port, 'mailingset@test.local',
+                recipients, 'Subject: test\n\nbody\n',
+                lambda addr, reason: failed.append(addr), connections=2)
+        self.assertEqual(4, sent)
+        self.assertEqual(['c@remote.test'], failed)
+        self.assertEqual(2, relay.connections)
+        self.assertEqual(set([1, 2]),
+                set(connection for (connection, _, _) in relay.transactions))
+        self.assertEqual(sorted(recipients - set(failed)),
+                sorted(recipient for (_, _, recipient) in relay.transactions))
+        for (_, sender, recipient) in relay.transactions:
+            self.assertEqual(verp.encode('mailingset@test.local', recipient),
+                    sender)
+
+    @defer.inlineCallbacks
+    def test_send_unreachable(self):
+        port = reactor.listenTCP(0, helper.RecordingRelay(),
+                interface='127.0.0.1')
+        number = port.getHost().port
+        yield port.stopListening()
+        failed = []
+        sent = yield verp.send('127.0.0.1', number, 'mailingset@test.local',
+                ['a@remote.test', 'b@remote.test', 'c@remote.test'], 'body',
+                lambda addr, reason: failed.append(addr), connections=2)
+        self.assertEqual(0, sent)
+        self.assertEqual(['a@remote.test', 'b@remote.test', 'c@remote.test'],
+                sorted(failed))
+
+    def test_send_nobody(self):
+        sent = verp.send('127.0.0.1', 25, 'mailingset@test.local', [], 'body',
+                None)
+        self.assertEqual(0, self.successResultOf(sent))
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])
@@ -0,0 +1,143 @@
+# Mailing Set: set-algebraic operations on mailing lists
+# Copyright (C) 2015 by David Tolnay <dtolnay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import nose
+import os
+import socket
+import sys
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+from twisted.trial import unittest
+
+from mailingset import workers
+
+
+# Worker which greets each connection on the inherited socket with its index,
+# and reports SIGHUP and SIGUSR1 on stdout
+SERVING_WORKER = r'''
+import os, signal, socket, sys
+def reload_handler(signum, frame):
+    sys.stdout.write('reloaded\n')
+    sys.stdout.flush()
+signal.signal(signal.SIGHUP, reload_handler)
+def profile_handler(signum, frame):
+    sys.stdout.write('profiled\n')
+    sys.stdout.flush()
+signal.signal(signal.SIGUSR1, profile_handler)
+fd = int(os.environ['%s'])
+listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+listener.setblocking(True)
+sys.stdout.write('ready\n')
+sys.stdout.flush()
+while True:
+    try:
+        (conn, _) = listener.accept()
+    except socket.error:
+        continue
+    conn.sendall('worker %%s\n' %% (os.environ['%s'],))
+    conn.close()
+''' % (workers.WORKER_FD_ENV, workers.WORKER_ENV)
+
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        """Collects the log messages of the test."""
+        self.messages = []
+        def observer(event_dict):
+            """Collects log messages as text."""
+            self.messages.append(log.textFromEventDict(event_dict))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+    def _supervise(self, code, count=2):
+        """Starts a supervisor running Python code as its workers.
+
+        Args:
+            code: The Python source code of a worker.
+            count: The number of workers.
+
+        Returns:
+            The running Supervisor, which is stopped when the test finishes.
+        """
+        argv = lambda index: [sys.executable, '-c', code]
+        supervisor = workers.Supervisor(0, count, argv, interface='127.0.0.1',
+                restart_delay=0.05)
+        supervisor.startService()
+        self.addCleanup(supervisor.stopService)
+        return supervisor
+
+    def _wait_for(self, text, count):
+        """Waits until a message has been logged a number of times.
+
+        Args:
+            text: Text to look for in log messages.
+            count: Number of log messages that must contain the text.
+
+        Returns:
+            A Deferred firing once enough messages contain the text.
+        """
+        @defer.inlineCallbacks
+        def poll():
+            while len([m for m in self.messages if text in m]) < count:
+                yield task.deferLater(reactor, 0.02, lambda: None)
+        return poll()
+
+    def test_worker_path(self):
+        self.assertEqual('mailingset.log',
+                workers.worker_path('mailingset.log', None))
+        self.assertEqual('logs/mailingset-2.log',
+                workers.worker_path('logs/mailingset.log', 2))
+        self.assertEqual('archive-1', workers.worker_path('./archive/', 1))
+
+    def test_serve(self):
+        supervisor = self._supervise(SERVING_WORKER)
+        def connect(_):
+            """Connects to the shared port and reads the greeting."""
+            conn = socket.create_connection(supervisor.address)
+            greeting = conn.makefile().readline()
+            conn.close()
+            self.assertTrue(greeting in ['worker 0\n', 'worker 1\n'])
+        return self._wait_for(': ready', 2).addCallback(connect)
+
+    def test_reload(self):
+        supervisor = self._supervise(SERVING_WORKER)
+        done = self._wait_for(': ready', 2)
+        done.addCallback(lambda _: supervisor.reload())
+        done.addCallback(lambda _: self._wait_for(': reloaded', 2))
+        return done
+
+    def test_profile(self):
+        supervisor = self._supervise(SERVING_WORKER)
+        done = self._wait_for(': ready', 2)
+        done.addCallback(lambda _: supervisor.profile())
+        done.addCallback(lambda _: self._wait_for(': profiled', 2))
+        return done
+
+    def test_restart(self):
+        supervisor = self._supervise('pass', count=1)
+        def check(_):
+            """Checks that the worker was restarted."""
+            self.assertTrue(supervisor.restarts >= 2)
+        return self._wait_for('Started worker 0', 3).addCallback(check)
+
+
+if __name__ == '__main__':
+    nose.run(argv=['', __file__])